@@ -0,0 +1,5 @@
+# Load the Celery app with Django so shared_task .delay() and chords use
+# the configured broker and result backend
+from .celery import app as celery_app
+
+__all__ = ('celery_app',)
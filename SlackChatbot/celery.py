@@ -1,6 +1,7 @@
 import os
 from celery import Celery
-from django.conf import settings
+from celery.schedules import crontab
+from kombu import Exchange, Queue
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'SlackChatbot.settings')
@@ -14,9 +15,65 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
 
-# Ensure Celery uses the same database as Django
+# Interactive work (replies to mentions) has its own queue so a burst of
+# /analyze runs can't delay it. Run a dedicated worker per queue:
+#   celery -A SlackChatbot worker -Q interactive --concurrency=8
+#   celery -A SlackChatbot worker -Q batch --concurrency=2
+# A single worker with -Q interactive,batch serves both.
+INTERACTIVE_QUEUE = 'interactive'
+BATCH_QUEUE = 'batch'
+
+# Priorities are 0 (highest) to 9, as on the Redis transport. Within the
+# batch queue, runs that are already under way finish before new ones start.
+TASK_ROUTES = {
+    'chatbot.tasks.process_mention': {'queue': INTERACTIVE_QUEUE, 'priority': 0},
+    'chatbot.tasks.notify_analysis_failed': {'queue': INTERACTIVE_QUEUE, 'priority': 0},
+    'chatbot.tasks.reduce_channel_analysis': {'queue': BATCH_QUEUE, 'priority': 2},
+    'chatbot.tasks.fold_conversation_memory': {'queue': BATCH_QUEUE, 'priority': 3},
+    'chatbot.tasks.summarize_chunk': {'queue': BATCH_QUEUE, 'priority': 4},
+    'chatbot.tasks.analyze_channel_sentiment': {'queue': BATCH_QUEUE, 'priority': 6},
+    'celery.chord_unlock': {'queue': BATCH_QUEUE, 'priority': 2},
+    'chatbot.tasks.archive_conversation_history': {'queue': BATCH_QUEUE, 'priority': 8},
+}
+
+# Periodic tasks, sent by `celery -A SlackChatbot beat`
+BEAT_SCHEDULE = {
+    'archive-conversation-history': {
+        'task': 'chatbot.tasks.archive_conversation_history',
+        'schedule': crontab(hour=3, minute=30),
+    },
+}
+
+
+class RouteOptions:
+    """
+    Give every task the priority of its route and the soft and hard time
+    limits of its queue. Priorities have to be set on the task itself, the
+    task's default priority would win over the one of its route.
+    """
+
+    def annotate(self, task):
+        from django.conf import settings
+
+        route = TASK_ROUTES.get(task.name)
+        if route is None:
+            return None
+        soft, hard = settings.CELERY_QUEUE_TIME_LIMITS[route['queue']]
+        return {'priority': route['priority'],
+                'soft_time_limit': soft,
+                'time_limit': hard}
+
+
 app.conf.update(
-    CELERY_BROKER_URL=settings.CELERY_BROKER_URL,
-    CELERY_RESULT_BACKEND=settings.CELERY_RESULT_BACKEND,
-    DATABASES=settings.DATABASES
-) 
\ No newline at end of file
+    task_queues=(
+        Queue(INTERACTIVE_QUEUE, Exchange(INTERACTIVE_QUEUE),
+              routing_key=INTERACTIVE_QUEUE),
+        Queue(BATCH_QUEUE, Exchange(BATCH_QUEUE), routing_key=BATCH_QUEUE),
+    ),
+    task_default_queue=INTERACTIVE_QUEUE,
+    task_routes=TASK_ROUTES,
+    beat_schedule=BEAT_SCHEDULE,
+    task_annotations=[RouteOptions()],
+    task_queue_max_priority=9,
+    task_default_priority=5,
+)
@@ -35,6 +35,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chatbot.middleware.MetricsMiddleware',
+    'chatbot.middleware.TracingMiddleware',
+    # Verifies and dispatches Slack events ahead of the rest of the stack
+    'chatbot.middleware.SlackIngressMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,6 +79,13 @@ DATABASES = {
 
 WSGI_APPLICATION = 'SlackChatbot.wsgi.application'
 
+# 'asgi' when served by uvicorn workers (see entrypoint.sh). The async Slack
+# endpoint is only routed then: under WSGI each request runs on a throwaway
+# event loop that would cancel the mention handlers it starts.
+SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi')
+# Seconds an ASGI worker shutting down waits for mention handlers to finish
+ASYNC_MENTION_DRAIN_TIMEOUT = float(os.getenv('ASYNC_MENTION_DRAIN_TIMEOUT', 25))
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
@@ -106,7 +117,70 @@ AUTH_PASSWORD_VALIDATORS = [
 SLACK_CLIENT_ID = os.getenv('SLACK_CLIENT_ID')
 SLACK_CLIENT_SECRET = os.getenv('SLACK_CLIENT_SECRET')
 SLACK_SIGNING_SECRET = os.getenv('SLACK_SIGNING_SECRET')
+# Slack Web API root, overridden to point at a local stand-in for load tests
+SLACK_API_URL = os.getenv('SLACK_API_URL', 'https://slack.com/api/')
+# Reject Slack requests with a bad signature or a timestamp older than
+# SLACK_REQUEST_MAX_AGE seconds (replays)
+SLACK_VERIFY_SIGNATURES = os.getenv('SLACK_VERIFY_SIGNATURES', 'True').lower() == 'true'
+SLACK_REQUEST_MAX_AGE = int(os.getenv('SLACK_REQUEST_MAX_AGE', 300))
 GROQ_API_KEY = os.getenv('GROQ_API_KEY')
+# Leave unset for the real API, or point at a local stand-in
+GROQ_BASE_URL = os.getenv('GROQ_BASE_URL') or None
+# Connection pool shared by every GroqClient in a process
+GROQ_POOL_MAX_CONNECTIONS = int(os.getenv('GROQ_POOL_MAX_CONNECTIONS', 20))
+GROQ_POOL_MAX_KEEPALIVE = int(os.getenv('GROQ_POOL_MAX_KEEPALIVE', 10))
+GROQ_POOL_KEEPALIVE_EXPIRY = float(os.getenv('GROQ_POOL_KEEPALIVE_EXPIRY', 60))
+GROQ_CONNECT_TIMEOUT = float(os.getenv('GROQ_CONNECT_TIMEOUT', 5))
+GROQ_TIMEOUT = float(os.getenv('GROQ_TIMEOUT', 60))
+GROQ_MAX_RETRIES = int(os.getenv('GROQ_MAX_RETRIES', 2))
+GROQ_CHAT_MODEL = os.getenv('GROQ_CHAT_MODEL', 'mixtral-8x7b-32768')
+GROQ_VISION_MODEL = os.getenv('GROQ_VISION_MODEL', 'llama-3.2-11b-vision-preview')
+GROQ_MAX_COMPLETION_TOKENS = int(os.getenv('GROQ_MAX_COMPLETION_TOKENS', 1024))
+# Opt-in cache of completions keyed on normalized prompt, model and params.
+# MAX_ENTRIES bounds it in Redis as well as in the local fallback.
+GROQ_RESPONSE_CACHE_ENABLED = os.getenv('GROQ_RESPONSE_CACHE_ENABLED', 'False').lower() == 'true'
+GROQ_RESPONSE_CACHE_TTL = int(os.getenv('GROQ_RESPONSE_CACHE_TTL', 3600))
+GROQ_RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('GROQ_RESPONSE_CACHE_MAX_ENTRIES', 1000))
+# Context window (tokens) per model, used to size prompts
+GROQ_MODEL_CONTEXT_WINDOWS = {
+    'mixtral-8x7b-32768': 32768,
+    'llama-3.2-11b-vision-preview': 8192,
+    'llama-3.2-90b-vision-preview': 8192,
+    'llama-3.1-8b-instant': 131072,
+    'llama-3.3-70b-versatile': 131072,
+}
+GROQ_DEFAULT_CONTEXT_WINDOW = int(os.getenv('GROQ_DEFAULT_CONTEXT_WINDOW', 8192))
+# Model routing (see chatbot/routing.py): the models each kind of call
+# tries in order, skipping those the prompt doesn't fit (context window, or
+# the prompt cap of a small model). A call fails over to the next model on
+# outages, rate limits, retired models and after its deadline in seconds.
+GROQ_MODEL_ROUTES = {
+    'mention': os.getenv('GROQ_MENTION_MODELS',
+                         f"llama-3.1-8b-instant,{GROQ_CHAT_MODEL},llama-3.3-70b-versatile").split(','),
+    'analysis': os.getenv('GROQ_ANALYSIS_MODELS',
+                          f"{GROQ_CHAT_MODEL},llama-3.3-70b-versatile,llama-3.1-8b-instant").split(','),
+    'summary': os.getenv('GROQ_SUMMARY_MODELS',
+                         f"llama-3.1-8b-instant,{GROQ_CHAT_MODEL}").split(','),
+    'vision': os.getenv('GROQ_VISION_MODELS',
+                        f"{GROQ_VISION_MODEL},llama-3.2-90b-vision-preview").split(','),
+}
+GROQ_MODEL_MAX_PROMPT_TOKENS = {
+    'llama-3.1-8b-instant': int(os.getenv('GROQ_FAST_MODEL_MAX_PROMPT_TOKENS', 6000)),
+}
+GROQ_ROUTE_DEADLINES = {
+    'mention': float(os.getenv('GROQ_MENTION_DEADLINE', 20)),
+    'analysis': float(os.getenv('GROQ_ANALYSIS_DEADLINE', 90)),
+    'summary': float(os.getenv('GROQ_SUMMARY_DEADLINE', 60)),
+    'vision': float(os.getenv('GROQ_VISION_DEADLINE', 45)),
+}
+# Hedged requests: a call of these kinds still running after the
+# GROQ_HEDGE_PERCENTILE latency of its model (over the latest calls of the
+# process, once there are GROQ_HEDGE_MIN_SAMPLES) is sent a second time and
+# the first answer wins. Costs the tokens of the extra calls.
+GROQ_HEDGE_ENABLED = os.getenv('GROQ_HEDGE_ENABLED', 'False').lower() == 'true'
+GROQ_HEDGE_TASKS = os.getenv('GROQ_HEDGE_TASKS', 'mention').split(',')
+GROQ_HEDGE_PERCENTILE = float(os.getenv('GROQ_HEDGE_PERCENTILE', 95))
+GROQ_HEDGE_MIN_SAMPLES = int(os.getenv('GROQ_HEDGE_MIN_SAMPLES', 20))
 SLACK_SCOPES = [
     'app_mentions:read',
     'channels:history',
@@ -135,12 +209,66 @@ USE_TZ = True
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Prometheus metrics, served at /api/metrics/ to requests with METRICS_TOKEN
+# as a bearer token, and not at all without one. Set PROMETHEUS_MULTIPROC_DIR
+# (see gunicorn.conf.py), or PROMETHEUS_MULTIPROC_ROOT for containers
+# sharing a volume (see metrics_dir.sh), to aggregate gunicorn and Celery
+# processes.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() == 'true'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Trace spans of requests, mention replies and analyses (see
+# chatbot/tracing.py), exported to a JSONL file or an OTLP/HTTP collector.
+# A fraction TRACING_SAMPLE_RATE of traces is kept.
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'False').lower() == 'true'
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', 1.0))
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'jsonl')  # or 'otlp'
+TRACING_JSONL_PATH = os.getenv('TRACING_JSONL_PATH', 'traces.jsonl')
+TRACING_OTLP_ENDPOINT = os.getenv('TRACING_OTLP_ENDPOINT',
+                                  'http://localhost:4318/v1/traces')
+TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'slackbot')
+
 # Celery Configuration
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://redis:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://redis:6379/0')
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# Queues and routes are declared in SlackChatbot/celery.py. Workers take one
+# task at a time and ack it once done, so a long analysis doesn't hold
+# mentions hostage in a prefetch buffer and a lost worker's task is retried.
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv('CELERY_WORKER_PREFETCH_MULTIPLIER', 1))
+CELERY_TASK_ACKS_LATE = os.getenv('CELERY_TASK_ACKS_LATE', 'True').lower() == 'true'
+CELERY_TASK_REJECT_ON_WORKER_LOST = CELERY_TASK_ACKS_LATE
+# (soft, hard) time limits in seconds for the tasks of each queue
+CELERY_QUEUE_TIME_LIMITS = {
+    'interactive': (int(os.getenv('CELERY_INTERACTIVE_SOFT_TIME_LIMIT', 60)),
+                    int(os.getenv('CELERY_INTERACTIVE_TIME_LIMIT', 90))),
+    'batch': (int(os.getenv('CELERY_BATCH_SOFT_TIME_LIMIT', 900)),
+              int(os.getenv('CELERY_BATCH_TIME_LIMIT', 1200))),
+}
+# Redis emulates priorities with one list per step; unacked tasks are
+# redelivered after the visibility timeout, which has to outlast the
+# longest hard time limit
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+    'visibility_timeout': 2 * max(hard for _, hard in CELERY_QUEUE_TIME_LIMITS.values()),
+}
+
+# Shared caches (event de-duplication etc.). 'redis' falls back to an
+# in-process LRU while Redis is unreachable, 'local' never uses Redis.
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'redis')
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', CELERY_BROKER_URL)
+
+# Per-process cache of workspace rows and their Slack clients
+WORKSPACE_CACHE_TTL = int(os.getenv('WORKSPACE_CACHE_TTL', 300))
+WORKSPACE_CACHE_MAX_ENTRIES = int(os.getenv('WORKSPACE_CACHE_MAX_ENTRIES', 1000))
+
+# How long a Slack event_id is remembered to drop retried deliveries
+SLACK_EVENT_DEDUP_TTL = int(os.getenv('SLACK_EVENT_DEDUP_TTL', 3600))
+SLACK_EVENT_DEDUP_MAX_ENTRIES = int(os.getenv('SLACK_EVENT_DEDUP_MAX_ENTRIES', 10000))
 
 # Database URL for Celery tasks
 CELERY_DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///db.sqlite3')
@@ -148,5 +276,87 @@ if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
     CELERY_DATABASE_URL = f"postgresql://{DATABASES['default']['USER']}:{DATABASES['default']['PASSWORD']}@{DATABASES['default']['HOST']}:{DATABASES['default']['PORT']}/{DATABASES['default']['NAME']}"
 
 
+# Channel history fetching: page size per conversations.history call and
+# ceilings on how much of a window is read
+SLACK_HISTORY_PAGE_SIZE = int(os.getenv('SLACK_HISTORY_PAGE_SIZE', 200))
+SLACK_HISTORY_MAX_MESSAGES = int(os.getenv('SLACK_HISTORY_MAX_MESSAGES', 5000))
+SLACK_HISTORY_MAX_BYTES = int(os.getenv('SLACK_HISTORY_MAX_BYTES', 2000000))
+# How many 429s in a row a Slack call waits out before giving up
+SLACK_MAX_RATE_LIMIT_RETRIES = int(os.getenv('SLACK_MAX_RATE_LIMIT_RETRIES', 3))
+
+# Rate limits shared by all web and Celery workers (Redis token buckets,
+# in-process ones while Redis is down). Calls wait for a token, or fail
+# with RateLimitExceeded if that would take over RATE_LIMIT_MAX_WAIT.
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 30))
+# Requests per minute per workspace, after Slack's Web API tiers
+SLACK_RATE_LIMITS = {
+    'chat.postMessage': 60,  # Special tier, ~1 per second
+    'chat.update': 50,  # Tier 3
+    'conversations.history': 50,  # Tier 3
+    'conversations.replies': 50,  # Tier 3
+    'files.info': 100,  # Tier 4
+}
+SLACK_DEFAULT_RATE_LIMIT = 20  # Tier 2
+# Requests per minute to Groq across all workers
+GROQ_RATE_LIMIT_PER_MINUTE = int(os.getenv('GROQ_RATE_LIMIT_PER_MINUTE', 30))
+
+# Reply to app_mention events from a Celery task so Slack gets its ack
+# within the 3 second deadline. Set to False to reply inside the request.
+SLACK_ASYNC_MENTIONS = os.getenv('SLACK_ASYNC_MENTIONS', 'True').lower() == 'true'
+
+# Tokens of past conversation packed into a mention prompt (capped by the
+# model's context window), and how many rows are considered
+MENTION_CONTEXT_TOKEN_BUDGET = int(os.getenv('MENTION_CONTEXT_TOKEN_BUDGET', 4000))
+MENTION_CONTEXT_MAX_ROWS = int(os.getenv('MENTION_CONTEXT_MAX_ROWS', 50))
+# Rolling summary memory per thread (and per channel outside threads). Once
+# over MEMORY_FOLD_THRESHOLD_TOKENS of turns aren't summarized, a background
+# task folds all but the newest MEMORY_TAIL_TOKENS of them into the summary,
+# MEMORY_FOLD_CHUNK_TOKENS per Groq call, and prompts carry the summary
+# instead of those turns. Only the newest MEMORY_FOLD_MAX_ROWS unsummarized
+# turns are folded, older ones never made it into a prompt anyway. One fold
+# per thread is queued at a time, the claim expiring after
+# MEMORY_FOLD_CLAIM_TTL seconds should its task be lost.
+MEMORY_ENABLED = os.getenv('MEMORY_ENABLED', 'True').lower() == 'true'
+MEMORY_FOLD_THRESHOLD_TOKENS = int(os.getenv('MEMORY_FOLD_THRESHOLD_TOKENS', 2000))
+MEMORY_TAIL_TOKENS = int(os.getenv('MEMORY_TAIL_TOKENS', 800))
+MEMORY_FOLD_CHUNK_TOKENS = int(os.getenv('MEMORY_FOLD_CHUNK_TOKENS', 6000))
+MEMORY_FOLD_MAX_ROWS = int(os.getenv('MEMORY_FOLD_MAX_ROWS', 200))
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv('MEMORY_SUMMARY_MAX_TOKENS', 400))
+MEMORY_FOLD_CLAIM_TTL = int(os.getenv('MEMORY_FOLD_CLAIM_TTL', 300))
+
+# Stream mention replies into Slack: post a placeholder, then chat.update
+# it at most every SLACK_STREAM_UPDATE_INTERVAL seconds. Only for replies
+# from Celery, the async (SERVER_MODE=asgi) endpoint posts them whole.
+SLACK_STREAM_REPLIES = os.getenv('SLACK_STREAM_REPLIES', 'False').lower() == 'true'
+SLACK_STREAM_UPDATE_INTERVAL = float(os.getenv('SLACK_STREAM_UPDATE_INTERVAL', 1.5))
+SLACK_STREAM_PLACEHOLDER = os.getenv('SLACK_STREAM_PLACEHOLDER', '✍️ Thinking...')
+
 # Analysis Settings
 ANALYSIS_TIME_WINDOW_HOURS = int(os.getenv('ANALYSIS_TIME_WINDOW_HOURS', 1))
+# Token size of the chunks a channel analysis is split into; windows
+# bigger than one chunk are summarized in parallel by the Celery workers
+ANALYSIS_CHUNK_TOKENS = int(os.getenv('ANALYSIS_CHUNK_TOKENS', 6000))
+# How long cached partial analyses are kept for incremental /analyze runs
+ANALYSIS_PARTIAL_RETENTION_HOURS = int(os.getenv('ANALYSIS_PARTIAL_RETENTION_HOURS', 168))
+# Images shared in analyzed channels: download ceiling, downscaling before
+# the vision call, and the cache of vision results
+SLACK_FILE_DOWNLOAD_TIMEOUT = float(os.getenv('SLACK_FILE_DOWNLOAD_TIMEOUT', 30))
+VISION_IMAGE_MAX_BYTES = int(os.getenv('VISION_IMAGE_MAX_BYTES', 20 * 1024 * 1024))
+VISION_IMAGE_MAX_DIMENSION = int(os.getenv('VISION_IMAGE_MAX_DIMENSION', 1024))
+VISION_IMAGE_QUALITY = int(os.getenv('VISION_IMAGE_QUALITY', 85))
+# Most recent images analyzed per run, and how many are fetched at once
+VISION_MAX_IMAGES = int(os.getenv('VISION_MAX_IMAGES', 5))
+VISION_MAX_CONCURRENCY = int(os.getenv('VISION_MAX_CONCURRENCY', 4))
+VISION_CACHE_TTL = int(os.getenv('VISION_CACHE_TTL', 7 * 24 * 3600))
+VISION_CACHE_MAX_ENTRIES = int(os.getenv('VISION_CACHE_MAX_ENTRIES', 1000))
+# Rows per bulk insert / lookup when persisting Slack messages
+INGESTION_BATCH_SIZE = int(os.getenv('INGESTION_BATCH_SIZE', 500))
+
+# Retention: conversation history older than RETENTION_DAYS (or the
+# workspace's retention_days, 0 keeps everything) is moved to gzipped JSONL
+# files under RETENTION_ARCHIVE_DIR, RETENTION_BATCH_SIZE rows per file,
+# and counted in per-channel daily rollups
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 90))
+RETENTION_ARCHIVE_DIR = os.getenv('RETENTION_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 5000))
@@ -0,0 +1,382 @@
+import bisect
+import io
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+from PIL import Image
+
+from SlackChatbot.celery import app as celery_app
+
+from chatbot.clients import GroqClient, SlackClient
+
+
+class FakeServer:
+    """
+    Local HTTP stand-in for a third party API, run on a background thread.
+
+    latency is added to every response and error_rate is the fraction of
+    requests answered with an error (send_error). The set of client ports seen tells how
+    many TCP connections callers actually opened.
+    """
+
+    def __init__(self, latency=0, error_rate=0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.connections = set()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                with server._lock:
+                    server.requests += 1
+                    server.connections.add(self.client_address)
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.error_rate and random.random() < server.error_rate:
+                    server.send_error(self)
+                    return
+                server.handle(self, body)
+
+            do_GET = do_POST
+
+            def send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The caller gave up waiting (timeouts, hedged calls)
+                    pass
+
+        return Handler
+
+    def handle(self, request, body):
+        raise NotImplementedError
+
+    def send_error(self, request):
+        request.send_json(500, {'error': 'fake server error'})
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeGroqServer(FakeServer):
+    """
+    Answers chat completions like the Groq (OpenAI compatible) API.
+
+    Per model, failing_models answer with a 503 and model_latency adds
+    seconds. A tail_rate fraction of requests takes tail_latency seconds
+    more. models counts requests per model.
+    """
+
+    reply = "This is a canned reply from the fake Groq server."
+
+    def __init__(self, *args, failing_models=(), model_latency=None,
+                 tail_rate=0, tail_latency=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failing_models = set(failing_models)
+        self.model_latency = model_latency or {}
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.models = {}
+
+    def handle(self, request, body):
+        payload = json.loads(body or b'{}')
+        model = payload.get('model', 'fake')
+        with self._lock:
+            self.models[model] = self.models.get(model, 0) + 1
+        delay = self.model_latency.get(model, 0)
+        if self.tail_rate and random.random() < self.tail_rate:
+            delay += self.tail_latency
+        if delay:
+            time.sleep(delay)
+        if model in self.failing_models:
+            request.send_json(503, {'error': {'message': f"{model} is unavailable"}})
+            return
+        prompt_tokens = len(json.dumps(payload.get('messages', []))) // 4
+        completion_tokens = len(self.reply) // 4
+        request.send_json(200, {
+            'id': f"chatcmpl-fake-{self.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.reply},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        })
+
+
+class FakeSlackServer(FakeServer):
+    """
+    Answers the Slack Web API methods the bot calls, with empty histories.
+
+    Errors are sent the way Slack throttles, as a 429 with Retry-After.
+    calls counts requests per API method.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = {}
+
+    def send_error(self, request):
+        request.send_json(429, {'ok': False, 'error': 'ratelimited'},
+                          headers={'Retry-After': '1'})
+
+    def handle(self, request, body):
+        method = urlparse(request.path).path.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method in ('chat.postMessage', 'chat.update'):
+            request.send_json(200, {'ok': True, 'channel': 'C0FAKE',
+                                    'ts': f"{time.time():.6f}"})
+        elif method in ('conversations.history', 'conversations.replies'):
+            request.send_json(200, {'ok': True, 'messages': [],
+                                    'has_more': False})
+        elif method == 'files.info':
+            request.send_json(200, {'ok': True, 'file': {}})
+        else:
+            request.send_json(200, {'ok': True})
+
+
+class FakeOtlpCollector(FakeServer):
+    """Accepts OTLP/HTTP JSON trace exports and keeps the spans in .spans"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spans = []
+
+    def handle(self, request, body):
+        payload = json.loads(body or b'{}')
+        with self._lock:
+            for resource_spans in payload.get('resourceSpans', []):
+                for scope_spans in resource_spans.get('scopeSpans', []):
+                    self.spans.extend(scope_spans.get('spans', []))
+        request.send_json(200, {})
+
+
+class FakeFileServer(FakeServer):
+    """Serves the same generated PNG for every path, standing in for Slack file downloads"""
+
+    def __init__(self, *args, width=1600, height=1200, **kwargs):
+        super().__init__(*args, **kwargs)
+        image = Image.radial_gradient('L').resize((width, height)).convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        self.png = output.getvalue()
+
+    def handle(self, request, body):
+        request.send_response(200)
+        request.send_header('Content-Type', 'image/png')
+        request.send_header('Content-Length', str(len(self.png)))
+        request.end_headers()
+        request.wfile.write(self.png)
+
+
+@contextmanager
+def offline_celery(eager):
+    """
+    Keep Celery off the network: tasks run inline when eager, otherwise
+    they're published to an in-memory broker nobody consumes.
+    """
+    conf = celery_app.conf
+    # Settings come from Django under the CELERY namespace, so the
+    # prefixed keys are the ones that win
+    overrides = {
+        'task_always_eager': eager,
+        'broker_url': 'memory://',
+        'result_backend': 'cache+memory://',
+    }
+    saved = {f"CELERY_{key.upper()}": conf[key] for key in overrides}
+    conf.update({f"CELERY_{key.upper()}": value
+                 for key, value in overrides.items()})
+    try:
+        yield
+    finally:
+        conf.update(saved)
+
+
+WORDS = ("the release looks great but the onboarding flow is confusing and "
+         "pricing feels high compared to last year support was quick to reply "
+         "dashboard loads slowly on mobile love the new export feature bug "
+         "report crash after update customers asked about discounts").split()
+
+
+def synthetic_channel_messages(count, hours=24, thread_ratio=0.1, bot_ratio=0.1,
+                               image_ratio=0.01, seed=None):
+    """
+    Generate count Slack messages spread over the last hours, newest first.
+
+    Roughly thread_ratio of them start threads, bot_ratio are bot messages
+    and image_ratio carry a png file.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    step = hours * 3600 / (count + 1)
+    messages = []
+    parents = []
+    for i in range(count):
+        ts = f"{now - (count - i) * step:.6f}"
+        if rng.random() < bot_ratio:
+            msg = {'type': 'message', 'subtype': 'bot_message',
+                   'bot_id': f"B{rng.randint(100, 999)}", 'ts': ts,
+                   'text': f"Deploy {i} finished"}
+        else:
+            msg = {'type': 'message', 'user': f"U{rng.randint(1000, 1200)}",
+                   'ts': ts,
+                   'text': ' '.join(rng.choices(WORDS, k=rng.randint(3, 60)))}
+            roll = rng.random()
+            if roll < thread_ratio:
+                msg.update(thread_ts=ts, reply_count=rng.randint(1, 20))
+                parents.append(ts)
+            elif parents and roll < thread_ratio * 1.5:
+                # Replies also sent to the channel show up in its history
+                msg.update(subtype='thread_broadcast', thread_ts=rng.choice(parents))
+            if rng.random() < image_ratio:
+                msg['files'] = [{'id': f"F{i:09d}", 'filetype': 'png',
+                                 'name': f"screenshot-{i}.png"}]
+        messages.append(msg)
+    messages.reverse()
+    return messages
+
+
+class FakeSlackWebClient:
+    """
+    In-process stand-in for slack_sdk's WebClient, serving a fixed channel
+    history with cursor pagination and recording everything posted.
+    """
+
+    def __init__(self, messages=(), latency=0, file_url='http://127.0.0.1:9/files'):
+        self.latency = latency
+        self.file_url = file_url
+        # Oldest first, with the ts as floats for bisecting
+        self.messages = sorted(messages, key=lambda msg: float(msg['ts']))
+        self.timestamps = [float(msg['ts']) for msg in self.messages]
+        self.posts = []
+        self.calls = {}
+
+    def _call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def conversations_history(self, channel, limit=100, oldest=0, latest=None,
+                              cursor=None, **kwargs):
+        self._call('conversations.history')
+        lo = bisect.bisect_right(self.timestamps, float(oldest))
+        hi = (bisect.bisect_right(self.timestamps, float(latest))
+              if latest is not None else len(self.messages))
+        # Newest first, the cursor being the offset from latest
+        offset = int(cursor or 0)
+        end = hi - offset
+        start = max(lo, end - limit)
+        page = self.messages[start:end][::-1]
+        has_more = start > lo
+        return {'ok': True, 'messages': page, 'has_more': has_more,
+                'response_metadata': {'next_cursor': str(offset + len(page))
+                                      if has_more else ''}}
+
+    def conversations_replies(self, channel, ts, **kwargs):
+        self._call('conversations.replies')
+        return {'ok': True, 'messages': [msg for msg in self.messages
+                                         if msg.get('thread_ts') == ts],
+                'has_more': False}
+
+    def chat_postMessage(self, channel, text, thread_ts=None, **kwargs):
+        self._call('chat.postMessage')
+        ts = f"{time.time():.6f}"
+        self.posts.append({'channel': channel, 'text': text,
+                           'thread_ts': thread_ts, 'ts': ts})
+        return {'ok': True, 'channel': channel, 'ts': ts}
+
+    def chat_update(self, channel, ts, text, **kwargs):
+        self._call('chat.update')
+        return {'ok': True, 'channel': channel, 'ts': ts, 'text': text}
+
+    def files_info(self, file, **kwargs):
+        self._call('files.info')
+        return {'ok': True, 'file': {
+            'id': file,
+            'url_private_download': f"{self.file_url}/{file}.png"}}
+
+
+class FakeSlackClient(SlackClient):
+    """SlackClient on a FakeSlackWebClient, see client.posts and client.calls"""
+
+    def __init__(self, messages=(), latency=0, file_url=None, team_id='TFAKE'):
+        kwargs = {'file_url': file_url} if file_url else {}
+        self.client = FakeSlackWebClient(messages, latency, **kwargs)
+        self.team_id = team_id
+
+
+class FakeGroqClient(GroqClient):
+    """
+    GroqClient answering every completion with a canned reply after latency
+    seconds, without any network. Counts calls and estimated prompt tokens.
+    """
+
+    reply = "Overall sentiment is mixed: people like the release, pricing draws complaints."
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = 0
+        self.prompt_tokens = 0
+        self._lock = threading.Lock()
+
+    def _create(self, timeout=None, max_retries=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += len(json.dumps(kwargs.get('messages', []))) // 4
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleNamespace(choices=[SimpleNamespace(
+            message=SimpleNamespace(role='assistant', content=self.reply))])
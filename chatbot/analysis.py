@@ -0,0 +1,182 @@
+import time
+from decimal import Decimal
+
+from django.conf import settings
+
+from .context import count_tokens
+from .models import AnalysisPartial, ChannelWatermark
+
+ANALYSIS_SYSTEM_PROMPT = "You are an expert at analyzing conversation sentiment. Analyze all messages in the following Slack conversation with equla importance and provide: \n1. Overall sentiment (positive/negative/neutral)\n2. Key themes or topics\n3. Any notable patterns in interaction\n4. Level of engagement\nBe concise but thorough."
+
+MERGE_SYSTEM_PROMPT = "You are an expert at analyzing conversation sentiment. You are given analyses of consecutive time slices of one Slack conversation, oldest first. Merge them into a single analysis of the whole conversation that weighs every slice by its message count and provides: \n1. Overall sentiment (positive/negative/neutral)\n2. Key themes or topics\n3. Any notable patterns in interaction\n4. Level of engagement\nBe concise but thorough."
+
+
+def slack_ts(value):
+    """Slack ts (seconds with 6 decimals) as a Decimal"""
+    return Decimal(str(value)).quantize(Decimal('0.000001'))
+
+
+def now_ts():
+    return slack_ts(time.time())
+
+
+def ts_before(value):
+    """
+    The Slack ts right before value: ranges exclude their start, so a range
+    starting there includes the message at value
+    """
+    return slack_ts(value) - Decimal('0.000001')
+
+
+def format_messages(stored_messages):
+    """Format messages for analysis, excluding bot messages"""
+    return "\n".join([
+        f"User {msg.user_id}: {msg.message_text}"
+        for msg in stored_messages
+        if not msg.is_bot_message  # Exclude bot messages
+    ])
+
+
+def get_cached_partials(workspace, channel_id, window_start):
+    """
+    Get the cached partial analyses that can be reused for a window.
+
+    Returns the chain of contiguous partials that ends at the channel's
+    watermark and lies entirely inside the window, oldest first. Anything
+    between window_start and the start of the chain (or after the
+    watermark) still has to be fetched and analyzed.
+    """
+    watermark = ChannelWatermark.objects.filter(
+        workspace=workspace, channel_id=channel_id).first()
+    if watermark is None or watermark.last_analyzed_ts <= window_start:
+        return []
+
+    chain = []
+    expected_end = watermark.last_analyzed_ts
+    for partial in AnalysisPartial.objects.filter(
+            workspace=workspace,
+            channel_id=channel_id,
+            range_start__gte=window_start,
+            range_end__lte=expected_end).order_by('-range_end', '-created_at'):
+        if partial.range_end > expected_end:
+            # Overlaps a partial already in the chain (concurrent runs)
+            continue
+        if partial.range_end < expected_end:
+            break
+        chain.append(partial)
+        expected_end = partial.range_start
+    return list(reversed(chain))
+
+
+def analyze_messages(groq_client, formatted_messages, image_analysis=""):
+    """Run the sentiment analysis prompt over formatted messages"""
+    text_prompt = [{
+        "role": "system",
+        "content": ANALYSIS_SYSTEM_PROMPT
+    }]
+
+    # If we have image analysis, include it in the context
+    if image_analysis:
+        text_prompt.append({
+            "role": "user",
+            "content": f"Images were shared in this conversation. Here's what was observed in them:\n\n{image_analysis}\n\nNow, analyze the following conversation in this context:\n\n{formatted_messages}"
+        })
+    else:
+        text_prompt.append({
+            "role": "user",
+            "content": f"Here's the conversation to analyze:\n\n{formatted_messages}"
+        })
+
+    return groq_client.get_response(text_prompt)
+
+
+def split_into_chunks(range_start, range_end, stored_messages, max_tokens):
+    """
+    Split the messages of a fetched slice into token-bounded chunks.
+
+    Chunks are contiguous and cover (range_start, range_end) together, so
+    each can be cached as its own partial. Returns a list of
+    (chunk_start, chunk_end, messages) with messages oldest first.
+    """
+    ordered = sorted(stored_messages, key=lambda msg: slack_ts(msg.message_ts))
+    chunks = []
+    current = []
+    tokens = 0
+    chunk_start = range_start
+    for msg in ordered:
+        cost = 0 if msg.is_bot_message else count_tokens(
+            f"User {msg.user_id}: {msg.message_text}")
+        if current and tokens + cost > max_tokens:
+            chunk_end = slack_ts(current[-1].message_ts)
+            chunks.append((chunk_start, chunk_end, current))
+            chunk_start = chunk_end
+            current = []
+            tokens = 0
+        current.append(msg)
+        tokens += cost
+    chunks.append((chunk_start, range_end, current))
+    return chunks
+
+
+def _merge(groq_client, summaries):
+    slices = "\n\n".join(
+        f"Slice {i} ({count} messages):\n{text}"
+        for i, (count, text) in enumerate(summaries, start=1))
+    return groq_client.get_response([{
+        "role": "system",
+        "content": MERGE_SYSTEM_PROMPT
+    }, {
+        "role": "user",
+        "content": f"Here are the analyses to merge:\n\n{slices}"
+    }])
+
+
+def merge_summaries(groq_client, summaries):
+    """
+    Merge (message_count, analysis) pairs, oldest first, into one analysis.
+
+    When they don't fit in one prompt they are merged in token-bounded
+    batches first, and the batch results are merged again.
+    """
+    if len(summaries) == 1:
+        return summaries[0][1]
+
+    batches = [[]]
+    tokens = 0
+    for count, text in summaries:
+        cost = count_tokens(text)
+        if len(batches[-1]) >= 2 and tokens + cost > settings.ANALYSIS_CHUNK_TOKENS:
+            batches.append([])
+            tokens = 0
+        batches[-1].append((count, text))
+        tokens += cost
+    if len(batches) == 1:
+        return _merge(groq_client, summaries)
+
+    return merge_summaries(groq_client, [
+        (sum(count for count, _ in batch),
+         batch[0][1] if len(batch) == 1 else _merge(groq_client, batch))
+        for batch in batches
+    ])
+
+
+def merge_partials(groq_client, partials):
+    """Merge partial analyses (oldest first) into one analysis"""
+    return merge_summaries(groq_client, [(p.message_count, p.summary_text)
+                                         for p in partials if p.summary_text])
+
+
+def advance_watermark(workspace, channel_id, last_analyzed_ts):
+    ChannelWatermark.objects.update_or_create(
+        workspace=workspace,
+        channel_id=channel_id,
+        defaults={'last_analyzed_ts': last_analyzed_ts})
+
+
+def prune_partials(workspace, channel_id):
+    """Drop cached partials too old to fall in any analysis window"""
+    AnalysisPartial.objects.filter(
+        workspace=workspace,
+        channel_id=channel_id,
+        range_end__lt=now_ts() -
+        settings.ANALYSIS_PARTIAL_RETENTION_HOURS * 3600).delete()
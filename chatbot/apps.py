@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class ChatbotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbot'
+
+    def ready(self):
+        from django.conf import settings
+
+        if settings.METRICS_ENABLED:
+            from .metrics import observe_stage
+            from .stages import add_stage_listener
+            add_stage_listener(observe_stage)
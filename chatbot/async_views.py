@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+
+from .clients import AsyncGroqClient, AsyncSlackClient, aclose_async_groq_clients
+from .context import abuild_mention_context, count_tokens
+from .dedup import get_event_deduplicator
+from .models import SlackWorkspace, ConversationHistory
+from .ratelimit import RateLimitExceeded, rate_limit_wait
+from .tasks import analyze_channel_sentiment, schedule_memory_fold
+from .routing import primary_model
+from .tracing import span
+from .workspaces import aget_workspace
+
+logger = logging.getLogger(__name__)
+
+# Strong references to mention handlers running in the background, the
+# event loop itself only keeps weak ones
+_mention_tasks = set()
+
+
+def parse_slack_body(body, content_type):
+    """Parse a Slack request body: JSON for events, form data for slash commands"""
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+    return json.loads(body or b'{}')
+
+
+async def slack_events_async(request):
+    """
+    Async variant of SlackEventsView, to be served under ASGI.
+
+    Mentions are answered by a coroutine on the server's event loop after
+    Slack has been acked, so a single process can hold many slow LLM calls
+    at once instead of pinning a worker per call.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    try:
+        # Verified and parsed by SlackIngressMiddleware
+        event_data = getattr(request, 'slack_payload', None)
+        if event_data is None:
+            event_data = parse_slack_body(request.body,
+                                          request.headers.get('Content-Type', ''))
+
+        # Handle different types of requests
+        if event_data.get('type') == 'url_verification':
+            # Handle URL verification challenge
+            return JsonResponse({'challenge': event_data['challenge']})
+
+        elif event_data.get('command') == '/analyze':
+            # Handle analyze command
+            return await handle_analyze_command(event_data)
+
+        elif event_data.get('type') == 'event_callback':
+            # Drop Slack retries of events we have already taken
+            event_id = event_data.get('event_id')
+            deduplicator = get_event_deduplicator()
+            if not await sync_to_async(deduplicator.claim)(event_id):
+                logger.info(
+                    f"Dropping duplicate event {event_id} "
+                    f"(retry {request.headers.get('X-Slack-Retry-Num')})")
+                return JsonResponse({'ok': True})
+
+            try:
+                return await process_event(event_data)
+            except Exception:
+                await sync_to_async(deduplicator.release)(event_id)
+                raise
+
+        return JsonResponse({'ok': True})
+
+    except Exception as e:
+        logger.error(f"Error: {type(e).__name__} - {str(e)}")
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+# Slack can't send a CSRF token. Django 4.2's csrf_exempt decorator doesn't
+# support coroutines, so mark the view the way it would.
+slack_events_async.csrf_exempt = True
+
+
+async def handle_analyze_command(command_data):
+    """Handle /analyze command"""
+    try:
+        workspace = await aget_workspace(team_id=command_data['team_id'])
+    except SlackWorkspace.DoesNotExist:
+        return JsonResponse({"error": "Workspace not found"}, status=404)
+
+    channel_id = command_data['channel_id']
+    slack_service = AsyncSlackClient(workspace.bot_token, team_id=workspace.team_id)
+    try:
+        hours = int(command_data.get('text', '1'))
+    except ValueError:
+        hours = 1
+
+    try:
+        # Schedule the analysis task
+        await sync_to_async(analyze_channel_sentiment.delay)(
+            workspace_id=str(workspace.uuid),
+            channel_id=channel_id,
+            hours=hours)
+
+        # Send immediate response to Slack, or answer the command with it
+        # when out of chat.postMessage tokens rather than wait
+        text = f"🔄 Analyzing channel messages from the last {hours} hour{'s' if hours > 1 else ''}... I'll post the results here shortly!"
+        try:
+            with rate_limit_wait(0):
+                await slack_service.send_message(
+                    channel=channel_id,
+                    text=text,
+                    thread_ts=command_data.get('thread_ts'))
+        except RateLimitExceeded:
+            return JsonResponse({'response_type': 'in_channel', 'text': text})
+    except Exception as e:
+        logger.error(f"Error processing analyze command: {e}")
+        text = f"Error starting analysis: {str(e)}"
+        try:
+            with rate_limit_wait(0):
+                await slack_service.send_message(
+                    channel=channel_id,
+                    text=text,
+                    thread_ts=command_data.get('thread_ts'))
+        except RateLimitExceeded:
+            return JsonResponse({'text': text})
+    return JsonResponse({'ok': True})
+
+
+async def process_event(event_data):
+    """Process regular Slack events"""
+    event = event_data['event']
+    try:
+        workspace = await aget_workspace(team_id=event_data['team_id'])
+    except SlackWorkspace.DoesNotExist:
+        logger.warning(f"Event for unknown workspace {event_data['team_id']}")
+        return JsonResponse({"error": "Workspace not found"}, status=404)
+
+    if event.get('type') == 'app_mention':
+        # Ack Slack now and reply from the event loop
+        task = asyncio.create_task(
+            handle_mention(event, workspace, event_data.get('event_id')))
+        _mention_tasks.add(task)
+        task.add_done_callback(_mention_tasks.discard)
+
+    return JsonResponse({'ok': True})
+
+
+async def handle_mention(event, workspace, event_id=None):
+    """
+    Build context, get an LLM reply and post it, all without blocking the loop.
+
+    Slack has been acked already and won't send the event again, so a
+    failure is answered with an error message instead. The event_id is
+    released if no reply was posted. Replies are posted whole,
+    SLACK_STREAM_REPLIES only applies to replies from Celery.
+    """
+    replied = False
+    slack_service = AsyncSlackClient(workspace.bot_token, team_id=workspace.team_id)
+    try:
+        with span('handle_mention', channel=event.get('channel')):
+            messages = await abuild_mention_context(workspace, event,
+                                                    primary_model('mention'))
+            response = await AsyncGroqClient().get_response(messages, task='mention')
+
+            # Save conversation, an analysis run may already have stored the message
+            with span('persist'):
+                await ConversationHistory.objects.aupdate_or_create(
+                    workspace=workspace,
+                    channel_id=event['channel'],
+                    message_ts=event['ts'],
+                    defaults={
+                        'thread_ts': event.get('thread_ts'),
+                        'user_id': event.get('user', ''),
+                        'message_text': event['text'],
+                        'message_type': event.get('subtype', 'text'),
+                        'response': response,
+                        'token_count': count_tokens(event['text']) + count_tokens(response),
+                    })
+
+            # Send response to Slack
+            await slack_service.send_message(channel=event['channel'],
+                                             text=response,
+                                             thread_ts=event.get('thread_ts'))
+            replied = True
+            await sync_to_async(schedule_memory_fold)(workspace, event)
+    except asyncio.CancelledError:
+        if not replied:
+            # The loop may be going away, don't await anything more
+            get_event_deduplicator().release(event_id)
+        raise
+    except Exception as e:
+        logger.error(f"Error handling mention: {e}")
+        if not replied:
+            await sync_to_async(get_event_deduplicator().release)(event_id)
+            try:
+                await slack_service.send_message(
+                    channel=event['channel'],
+                    text="❌ Sorry, something went wrong generating a reply.",
+                    thread_ts=event.get('thread_ts'))
+            except Exception as error:
+                logger.error(f"Error reporting a failed mention: {error}")
+
+
+async def drain_mentions(timeout):
+    """
+    Wait up to timeout seconds for the running mention handlers, then
+    cancel the rest. Returns how many were cancelled.
+    """
+    if not _mention_tasks:
+        return 0
+    _, pending = await asyncio.wait(set(_mention_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    return len(pending)
+
+
+async def lifespan(scope, receive, send):
+    """
+    ASGI lifespan protocol, which Django doesn't speak. On shutdown, lets
+    the mention handlers finish within ASYNC_MENTION_DRAIN_TIMEOUT and
+    closes the loop's Groq clients.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            cancelled = await drain_mentions(settings.ASYNC_MENTION_DRAIN_TIMEOUT)
+            if cancelled:
+                logger.warning(f"Cancelled {cancelled} unfinished mention(s) on shutdown")
+            await aclose_async_groq_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,181 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """Thread-safe in-process LRU cache with a TTL per entry"""
+
+    def __init__(self, max_entries=1000, default_ttl=300):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def _store(self, key, value, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._expire(key, time.monotonic())
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Store value only if key is absent, returns True if it was stored"""
+        with self._lock:
+            if self._expire(key, time.monotonic()) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """
+    Redis-backed cache with JSON values.
+
+    While Redis is unreachable every call is served by an in-process
+    LocalCache instead, and Redis is only retried after a short backoff so
+    an outage doesn't add a connect timeout to every call.
+
+    Keys written with set() are bounded to max_entries per namespace: a
+    sorted set indexes them by expiry, and the ones closest to expiring
+    are evicted first. The cache can share its Redis with the Celery broker
+    this way, where an allkeys-lru policy would evict queued tasks.
+    """
+
+    retry_after = 30
+
+    def __init__(self, url, namespace, max_entries=1000, default_ttl=300):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.client = redis.Redis.from_url(url,
+                                           socket_timeout=0.5,
+                                           socket_connect_timeout=0.5)
+        self.fallback = LocalCache(max_entries=max_entries,
+                                   default_ttl=default_ttl)
+        self._down_until = 0
+
+    def _key(self, key):
+        return f"slackbot:{self.namespace}:{key}"
+
+    def _call(self, op, *args, **kwargs):
+        """Run a Redis op, returning (ok, result)"""
+        if time.monotonic() < self._down_until:
+            return False, None
+        try:
+            return True, op(*args, **kwargs)
+        except redis.RedisError as e:
+            logger.warning(
+                f"Redis cache '{self.namespace}' unavailable, using local fallback: {e}"
+            )
+            self._down_until = time.monotonic() + self.retry_after
+            return False, None
+
+    def _index(self):
+        return f"slackbot:{self.namespace}:__index__"
+
+    def _set_bounded(self, key, value, ttl):
+        """SET key and evict past max_entries, returns the evicted keys"""
+        now = time.time()
+        index = self._index()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(key, value, ex=ttl)
+        pipe.zadd(index, {key: now + ttl})
+        pipe.zremrangebyscore(index, '-inf', now)
+        pipe.expire(index, ttl)
+        pipe.zcard(index)
+        excess = pipe.execute()[-1] - self.max_entries
+        if excess <= 0:
+            return []
+        evicted = [member for member, _ in self.client.zpopmin(index, excess)]
+        self.client.delete(*evicted)
+        return evicted
+
+    def get(self, key, default=None):
+        ok, raw = self._call(self.client.get, self._key(key))
+        if not ok:
+            return self.fallback.get(key, default)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        ok, _ = self._call(self._set_bounded, self._key(key), json.dumps(value),
+                           ttl)
+        if not ok:
+            self.fallback.set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Store value only if key is absent, returns True if it was stored"""
+        ttl = self.default_ttl if ttl is None else ttl
+        ok, stored = self._call(self.client.set, self._key(key),
+                                json.dumps(value), ex=ttl, nx=True)
+        if not ok:
+            return self.fallback.add(key, value, ttl)
+        return bool(stored)
+
+    def delete(self, key):
+        ok, _ = self._call(self.client.delete, self._key(key))
+        if ok:
+            self._call(self.client.zrem, self._index(), self._key(key))
+        self.fallback.delete(key)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(namespace, max_entries=1000, default_ttl=300):
+    """
+    Get the process-wide cache for a namespace.
+
+    Uses Redis at CACHE_REDIS_URL when CACHE_BACKEND is 'redis', otherwise
+    (or for 'local') a plain in-process LocalCache.
+    """
+    with _caches_lock:
+        if namespace not in _caches:
+            if settings.CACHE_BACKEND == 'redis' and settings.CACHE_REDIS_URL:
+                _caches[namespace] = RedisCache(settings.CACHE_REDIS_URL,
+                                                namespace,
+                                                max_entries=max_entries,
+                                                default_ttl=default_ttl)
+            else:
+                _caches[namespace] = LocalCache(max_entries=max_entries,
+                                                default_ttl=default_ttl)
+        return _caches[namespace]
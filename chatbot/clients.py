@@ -1,81 +1,453 @@
+import asyncio
 import groq
+import httpx
 from django.conf import settings
 import logging
 import hmac
 import hashlib
+import itertools
+import json
+import os
+import threading
+import weakref
 from slack_sdk import WebClient
+from slack_sdk.web.async_client import AsyncWebClient
 from slack_sdk.errors import SlackApiError
 from django.conf import settings
 import time
 from datetime import datetime, timedelta
+from asgiref.sync import sync_to_async
+
+from .cache import get_cache
+from .metrics import GROQ_RESPONSE_CACHE, track_groq_call, track_slack_call
+from .ratelimit import (
+    groq_rate_limit,
+    slack_rate_limit,
+    agroq_rate_limit,
+    aslack_rate_limit,
+)
+from .routing import (
+    FAILOVER_ERRORS,
+    acall_with_routing,
+    call_with_routing,
+    latency_tracker,
+    messages_tokens,
+    note_failover,
+    route,
+    route_deadline,
+)
 
 logger = logging.getLogger(__name__)
 
+_groq_clients = {}
+_groq_clients_lock = threading.Lock()
+# Per event loop, weakly, so a loop's clients go away with it
+_async_groq_clients = weakref.WeakKeyDictionary()
+
+
+def build_groq_client(api_key=None, base_url=None):
+    """Build a groq.Groq on a keep-alive httpx connection pool"""
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=settings.GROQ_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.GROQ_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=settings.GROQ_POOL_KEEPALIVE_EXPIRY),
+        timeout=httpx.Timeout(settings.GROQ_TIMEOUT,
+                              connect=settings.GROQ_CONNECT_TIMEOUT))
+    return groq.Groq(api_key=api_key or settings.GROQ_API_KEY,
+                     base_url=base_url or settings.GROQ_BASE_URL,
+                     max_retries=settings.GROQ_MAX_RETRIES,
+                     http_client=http_client)
+
+
+def get_groq_client(api_key=None):
+    """
+    Get the process-wide groq.Groq so every call reuses pooled connections.
+
+    Clients are keyed by pid as well, so a Celery or gunicorn child never
+    reuses sockets inherited from its parent across a fork.
+    """
+    key = (os.getpid(), api_key or settings.GROQ_API_KEY,
+           settings.GROQ_BASE_URL)
+    client = _groq_clients.get(key)
+    if client is None:
+        with _groq_clients_lock:
+            client = _groq_clients.get(key)
+            if client is None:
+                client = build_groq_client(api_key=api_key)
+                _groq_clients[key] = client
+    return client
+
+
+def get_async_groq_client():
+    """
+    Get the groq.AsyncGroq of the running event loop.
+
+    httpx.AsyncClient pools are bound to the loop they were created on, so
+    there is one pooled client per loop. Clients of loops that have been
+    closed (e.g. by async_to_sync) are dropped: their pooled connections
+    hold the loop, which would otherwise never be collected.
+    """
+    loop = asyncio.get_running_loop()
+    for old_loop in [old for old in list(_async_groq_clients) if old.is_closed()]:
+        _async_groq_clients.pop(old_loop, None)
+    clients = _async_groq_clients.setdefault(loop, {})
+    key = (settings.GROQ_API_KEY, settings.GROQ_BASE_URL)
+    client = clients.get(key)
+    if client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.GROQ_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.GROQ_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=settings.GROQ_POOL_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(settings.GROQ_TIMEOUT,
+                                  connect=settings.GROQ_CONNECT_TIMEOUT))
+        client = groq.AsyncGroq(api_key=settings.GROQ_API_KEY,
+                                base_url=settings.GROQ_BASE_URL,
+                                max_retries=settings.GROQ_MAX_RETRIES,
+                                http_client=http_client)
+        clients[key] = client
+    return client
+
+
+async def aclose_async_groq_clients():
+    """Close the Groq clients of the running loop, e.g. on ASGI shutdown"""
+    clients = _async_groq_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+
+def _normalize(content):
+    """Collapse whitespace in message content, including multi-part content"""
+    if isinstance(content, str):
+        return " ".join(content.split())
+    if isinstance(content, list):
+        return [_normalize(part) for part in content]
+    if isinstance(content, dict):
+        return {key: _normalize(value) for key, value in content.items()}
+    return content
+
+
+def response_cache_key(params):
+    """Hash of the normalized messages, model and sampling params of a completion"""
+    normalized = dict(params, messages=[
+        dict(message, content=_normalize(message.get('content')))
+        for message in params['messages']
+    ])
+    return hashlib.sha256(
+        json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+def response_cache():
+    return get_cache('groq-responses',
+                     max_entries=settings.GROQ_RESPONSE_CACHE_MAX_ENTRIES,
+                     default_ttl=settings.GROQ_RESPONSE_CACHE_TTL)
+
+
+class CacheStats:
+    """
+    Hit/miss counters of the Groq response cache in this process, also
+    exported as slackbot_groq_response_cache_total
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit):
+        GROQ_RESPONSE_CACHE.labels('hit' if hit else 'miss').inc()
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+
+response_cache_stats = CacheStats()
+
+
+def retry_after_seconds(error):
+    """Seconds Slack asked us to wait for a SlackApiError, None if it isn't a 429"""
+    response = getattr(error, 'response', None)
+    if response is None or response.status_code != 429:
+        return None
+    headers = {k.lower(): v for k, v in (response.headers or {}).items()}
+    return float(headers.get('retry-after', 1))
+
 
 class GroqClient:
 
     def __init__(self, api_key=None):
-        self.client = groq.Groq(api_key=settings.GROQ_API_KEY)
+        self.client = get_groq_client(api_key)
+
+    def _create(self, timeout=None, max_retries=None, **kwargs):
+        groq_rate_limit()
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        client = self.client
+        if max_retries is not None:
+            client = client.with_options(max_retries=max_retries)
+        with track_groq_call(kwargs.get('model')) as call:
+            started = time.perf_counter()
+            response = client.chat.completions.create(**kwargs)
+            call.record_usage(getattr(response, 'usage', None))
+        if not kwargs.get('stream'):
+            # Latency history for hedging, see chatbot.routing
+            latency_tracker.record(kwargs.get('model'), time.perf_counter() - started)
+        return response
+
+    def _complete(self, timeout=None, max_retries=None, **params):
+        """Create a completion and return its text, through the response cache if enabled"""
+        if not settings.GROQ_RESPONSE_CACHE_ENABLED:
+            return self._create(timeout=timeout, max_retries=max_retries,
+                                **params).choices[0].message.content
+
+        cache = response_cache()
+        key = response_cache_key(params)
+        content = cache.get(key)
+        if content is not None:
+            response_cache_stats.record(hit=True)
+            return content
+        response_cache_stats.record(hit=False)
+        content = self._create(timeout=timeout, max_retries=max_retries,
+                               **params).choices[0].message.content
+        cache.set(key, content)
+        return content
+
+    def _routed_complete(self, task, messages, model=None, timeout=None, **params):
+        """
+        Complete on model if given, else on the models routed for task, with
+        failover and hedging (see chatbot.routing)
+        """
+        if model:
+            return self._complete(messages=messages, model=model,
+                                  timeout=timeout, **params)
 
-    def get_response(self, messages, model="mixtral-8x7b-32768"):
-        """Get response from Groq API"""
+        def attempt(model, timeout, max_retries):
+            return self._complete(messages=messages, model=model, timeout=timeout,
+                                  max_retries=max_retries, **params)
+        return call_with_routing(attempt, task, messages, timeout)
+
+    def get_response(self, messages, model=None, timeout=None, max_tokens=None,
+                     task='analysis'):
+        """Get response from Groq API, from the models routed for task unless model is given"""
         try:
-            completion = self.client.chat.completions.create(
-                messages=messages,
-                model=model,
+            return self._routed_complete(
+                task, messages, model=model, timeout=timeout,
                 temperature=0.7,
-                max_tokens=1024)
-            return completion.choices[0].message.content
+                max_tokens=max_tokens or settings.GROQ_MAX_COMPLETION_TOKENS)
         except Exception as e:
             logger.error(f"Groq API error: {e}")
             raise
 
-    def get_vision_response(self, messages):
-        """Get response from Groq Vision API"""
+    def stream_response(self, messages, model=None, timeout=None, task='mention'):
+        """
+        Stream a response from Groq API, yielding text as it arrives.
+
+        Without model, fails over along the models routed for task until
+        one starts streaming; an error after that is raised.
+        """
+        models = [model] if model else route(task, messages_tokens(messages))
+        timeout = timeout or (None if model else route_deadline(task))
         try:
-            completion = self.client.chat.completions.create(
-                messages=messages,
-                model="llama-3.2-11b-vision-preview",
-                temperature=0.7,
-                max_tokens=1024)
-            return completion.choices[0].message.content
+            for i, current in enumerate(models):
+                last = i == len(models) - 1
+                try:
+                    stream = iter(self._create(
+                        messages=messages,
+                        model=current,
+                        temperature=0.7,
+                        max_tokens=settings.GROQ_MAX_COMPLETION_TOKENS,
+                        stream=True,
+                        timeout=timeout,
+                        max_retries=None if last else 0))
+                    first = next(stream, None)
+                except FAILOVER_ERRORS as e:
+                    if last:
+                        raise
+                    note_failover(task, current, e, models[i + 1])
+                    continue
+                if first is None:
+                    return
+                for chunk in itertools.chain([first], stream):
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+                return
+        except Exception as e:
+            logger.error(f"Groq API streaming error: {e}")
+            raise
+
+    def get_vision_response(self, messages, timeout=None, with_model=False):
+        """
+        Get response from Groq Vision API, on the models routed for vision.
+        With with_model, returns (model, response) with the model that answered.
+        """
+        def attempt(model, timeout, max_retries):
+            return model, self._complete(
+                messages=messages, model=model, timeout=timeout,
+                max_retries=max_retries, temperature=0.7,
+                max_tokens=settings.GROQ_MAX_COMPLETION_TOKENS)
+        try:
+            model, response = call_with_routing(attempt, 'vision', messages, timeout)
+            return (model, response) if with_model else response
         except Exception as e:
             logger.error(f"Groq Vision API error: {e}")
             raise
 
 class SlackClient:
 
-    def __init__(self, bot_token=None):
-        self.client = WebClient(token=bot_token) if bot_token else None
+    def __init__(self, bot_token=None, team_id=None):
+        self.client = WebClient(token=bot_token,
+                                base_url=settings.SLACK_API_URL) if bot_token else None
+        # Rate limit buckets are per workspace
+        self.team_id = team_id or (
+            hashlib.sha256(bot_token.encode()).hexdigest()[:12] if bot_token else None)
+
+    def _rate_limit(self, method):
+        slack_rate_limit(self.team_id, method)
 
     @staticmethod
     def verify_signature(request_body, timestamp, signature):
-        """Verify the request signature from Slack"""
-        base = f"v0:{timestamp}:{request_body}"
-        print(settings.SLACK_SIGNING_SECRET)
-        computed_signature = f"v0={hmac.new(settings.SLACK_SIGNING_SECRET.encode(), base.encode(), hashlib.sha256).hexdigest()}"
-        return hmac.compare_digest(computed_signature, signature)
+        """Verify the request signature from Slack over the raw body bytes"""
+        if not signature:
+            return False
+        if isinstance(request_body, str):
+            request_body = request_body.encode()
+        base = b"v0:" + str(timestamp).encode() + b":" + request_body
+        computed_signature = f"v0={hmac.new(settings.SLACK_SIGNING_SECRET.encode(), base, hashlib.sha256).hexdigest()}"
+        # Compared as bytes, compare_digest rejects non-ASCII str
+        return hmac.compare_digest(computed_signature.encode(), signature.encode())
 
     def send_message(self, channel, text, thread_ts=None):
         """Send a message to a Slack channel"""
         try:
-            response = self.client.chat_postMessage(channel=channel,
-                                                    text=text,
-                                                    thread_ts=thread_ts)
+            self._rate_limit('chat.postMessage')
+            with track_slack_call('chat.postMessage'):
+                response = self.client.chat_postMessage(channel=channel,
+                                                        text=text,
+                                                        thread_ts=thread_ts)
             return response
         except SlackApiError as e:
             logger.error(f"Error sending message: {e}")
             raise
 
+    def update_message(self, channel, ts, text):
+        """Replace the text of a message the bot posted"""
+        try:
+            self._rate_limit('chat.update')
+            with track_slack_call('chat.update'):
+                response = self.client.chat_update(channel=channel,
+                                                   ts=ts,
+                                                   text=text)
+            return response
+        except SlackApiError as e:
+            logger.error(f"Error updating message: {e}")
+            raise
+
     def get_file_info(self, file_id):
         """Get file information from Slack"""
         try:
-            response = self.client.files_info(file=file_id)
+            self._rate_limit('files.info')
+            with track_slack_call('files.info'):
+                response = self.client.files_info(file=file_id)
             return response['file']
         except SlackApiError as e:
             logger.error(f"Error getting file info: {e}")
             raise
 
+    def iter_conversation_history(self, channel, thread_ts=None, hours_ago=1,
+                                  oldest=None, latest=None, page_size=None,
+                                  max_messages=None, max_bytes=None):
+        """
+        Iterate over a channel's (or thread's) history one page at a time
+
+        Follows response_metadata.next_cursor, waits out 429 Retry-After
+        responses and stops once max_messages or max_bytes of message text
+        have been yielded, so callers can process pages as they arrive
+        without holding the whole window in memory.
+
+        Args:
+            channel (str): The channel ID to fetch messages from
+            thread_ts (str): If provided, fetch replies from this thread
+            hours_ago (int): Number of hours to look back (default: 1)
+            oldest (str): Slack ts to start from, overrides hours_ago
+            latest (str): Slack ts to stop at (default: now)
+            page_size (int): Messages per API call
+            max_messages (int): Ceiling on messages yielded overall
+            max_bytes (int): Ceiling on message text bytes yielded overall
+
+        Yields:
+            list: Pages of message objects from the conversation
+
+        Returns:
+            bool: True if a ceiling cut the history short, as the value of
+            the StopIteration. Slack pages newest first, so the oldest
+            messages are the ones missing.
+        """
+        page_size = page_size or settings.SLACK_HISTORY_PAGE_SIZE
+        max_messages = max_messages or settings.SLACK_HISTORY_MAX_MESSAGES
+        max_bytes = max_bytes or settings.SLACK_HISTORY_MAX_BYTES
+        if oldest is None:
+            # Calculate timestamp for X hours ago
+            oldest = int((datetime.now() - timedelta(hours=hours_ago)).timestamp())
+
+        params = {'channel': channel, 'limit': page_size, 'oldest': oldest}
+        if latest is not None:
+            params['latest'] = latest
+        if thread_ts:
+            method, fetch = 'conversations.replies', self.client.conversations_replies
+            params['ts'] = thread_ts
+        else:
+            method, fetch = 'conversations.history', self.client.conversations_history
+
+        yielded = 0
+        size = 0
+        cursor = None
+        rate_limited = 0
+        while True:
+            try:
+                self._rate_limit(method)
+                with track_slack_call(method):
+                    response = fetch(cursor=cursor, **params)
+            except SlackApiError as e:
+                wait = retry_after_seconds(e)
+                if wait is None or rate_limited >= settings.SLACK_MAX_RATE_LIMIT_RETRIES:
+                    logger.error(f"Error getting conversation history: {e}")
+                    raise
+                rate_limited += 1
+                logger.warning(f"Rate limited fetching history, retrying in {wait}s")
+                time.sleep(wait)
+                continue
+            rate_limited = 0
+
+            page = []
+            for msg in response['messages']:
+                msg_size = len(msg.get('text', '').encode())
+                if yielded >= max_messages or size + msg_size > max_bytes:
+                    break
+                page.append(msg)
+                yielded += 1
+                size += msg_size
+            if page:
+                yield page
+            if len(page) < len(response['messages']):
+                logger.warning(
+                    f"History for {channel} truncated at {yielded} messages / {size} bytes")
+                return True
+
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            if not cursor or not response.get('has_more', True):
+                return
+
     def get_conversation_history(self, channel, limit=100, thread_ts=None, hours_ago=1):
         """
         Get conversation history from a Slack channel
@@ -89,25 +461,87 @@ class SlackClient:
         Returns:
             list: List of message objects from the conversation
         """
+        messages = []
+        for page in self.iter_conversation_history(channel,
+                                                   thread_ts=thread_ts,
+                                                   hours_ago=hours_ago,
+                                                   max_messages=limit):
+            messages.extend(page)
+        return messages
+
+
+class AsyncGroqClient:
+    """GroqClient for async views, on the event loop's pooled AsyncGroq"""
+
+    def __init__(self):
+        self.client = get_async_groq_client()
+
+    async def _complete(self, timeout=None, max_retries=None, **params):
+        """Create a completion and return its text, through the response cache if enabled"""
+        if settings.GROQ_RESPONSE_CACHE_ENABLED:
+            cache = response_cache()
+            key = response_cache_key(params)
+            content = await sync_to_async(cache.get)(key)
+            response_cache_stats.record(hit=content is not None)
+            if content is not None:
+                return content
+
+        await agroq_rate_limit()
+        if timeout is not None:
+            params['timeout'] = timeout
+        client = self.client
+        if max_retries is not None:
+            client = client.with_options(max_retries=max_retries)
+        with track_groq_call(params['model']) as call:
+            started = time.perf_counter()
+            completion = await client.chat.completions.create(**params)
+            call.record_usage(completion.usage)
+        latency_tracker.record(params['model'], time.perf_counter() - started)
+        content = completion.choices[0].message.content
+
+        if settings.GROQ_RESPONSE_CACHE_ENABLED:
+            await sync_to_async(cache.set)(key, content)
+        return content
+
+    async def get_response(self, messages, model=None, timeout=None,
+                           max_tokens=None, task='analysis'):
+        """Get response from Groq API, from the models routed for task unless model is given"""
+        params = {
+            'messages': messages,
+            'temperature': 0.7,
+            'max_tokens': max_tokens or settings.GROQ_MAX_COMPLETION_TOKENS,
+        }
         try:
-            # Calculate timestamp for X hours ago
-            time_ago = int((datetime.now() - timedelta(hours=hours_ago)).timestamp())
-            
-            if thread_ts:
-                response = self.client.conversations_replies(
-                    channel=channel,
-                    ts=thread_ts,
-                    limit=limit,
-                    oldest=time_ago
-                )
-                return response['messages']
-            else:
-                response = self.client.conversations_history(
-                    channel=channel,
-                    limit=limit,
-                    oldest=time_ago
-                )
-                return response['messages']
+            if model:
+                return await self._complete(model=model, timeout=timeout, **params)
+
+            async def attempt(model, timeout, max_retries):
+                return await self._complete(model=model, timeout=timeout,
+                                            max_retries=max_retries, **params)
+            return await acall_with_routing(attempt, task, messages, timeout)
+        except Exception as e:
+            logger.error(f"Groq API error: {e}")
+            raise
+
+
+class AsyncSlackClient:
+    """SlackClient for async views, on slack_sdk's AsyncWebClient"""
+
+    def __init__(self, bot_token=None, team_id=None):
+        self.client = AsyncWebClient(
+            token=bot_token, base_url=settings.SLACK_API_URL) if bot_token else None
+        self.team_id = team_id or (
+            hashlib.sha256(bot_token.encode()).hexdigest()[:12] if bot_token else None)
+
+    async def send_message(self, channel, text, thread_ts=None):
+        """Send a message to a Slack channel"""
+        try:
+            await aslack_rate_limit(self.team_id, 'chat.postMessage')
+            with track_slack_call('chat.postMessage'):
+                response = await self.client.chat_postMessage(channel=channel,
+                                                              text=text,
+                                                              thread_ts=thread_ts)
+            return response
         except SlackApiError as e:
-            logger.error(f"Error getting conversation history: {e}")
+            logger.error(f"Error sending message: {e}")
             raise
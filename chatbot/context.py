@@ -0,0 +1,145 @@
+import math
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import ConversationHistory, ThreadSummary
+from .tracing import span
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Role and formatting overhead per chat message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text):
+    """
+    Estimate the number of tokens in text.
+
+    Groq doesn't expose the tokenizers, so this uses the usual ~4
+    characters per token estimate, rounded up to stay on the safe side.
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text) / 4)
+
+
+def conversation_tokens(conv):
+    """Tokens a stored row adds to a prompt, cached on the row at write time"""
+    if conv.token_count is not None:
+        return conv.token_count
+    return count_tokens(conv.message_text) + count_tokens(conv.response)
+
+
+def context_token_budget(model):
+    """Tokens of history that fit in a prompt for model"""
+    window = settings.GROQ_MODEL_CONTEXT_WINDOWS.get(
+        model, settings.GROQ_DEFAULT_CONTEXT_WINDOW)
+    return min(settings.MENTION_CONTEXT_TOKEN_BUDGET,
+               window - settings.GROQ_MAX_COMPLETION_TOKENS)
+
+
+def _summary_queryset(workspace, event):
+    """The memory summary of the mention's thread (see chatbot.memory)"""
+    return ThreadSummary.objects.filter(workspace=workspace,
+                                        channel_id=event['channel'],
+                                        thread_ts=event.get('thread_ts') or "",
+                                        summarized_until__isnull=False)
+
+
+def _history_querysets(workspace, event, summary=None):
+    """
+    Querysets of candidate history for a mention, in order of preference.
+    Turns already folded into summary are left out.
+    """
+    history = ConversationHistory.objects.filter(
+        workspace=workspace, channel_id=event['channel']).exclude(
+            message_ts=event['ts']).only('message_text', 'response',
+                                         'token_count', 'created_at')
+    until = summary.summarized_until if summary is not None else None
+    querysets = []
+    thread_ts = event.get('thread_ts')
+    if thread_ts:
+        in_thread = Q(thread_ts=thread_ts) | Q(message_ts=thread_ts)
+        thread_history = history.filter(in_thread)
+        if until is not None:
+            thread_history = thread_history.filter(created_at__gt=until)
+            history = history.exclude(in_thread, created_at__lte=until)
+        querysets.append(
+            thread_history.order_by('-created_at')[:settings.MENTION_CONTEXT_MAX_ROWS])
+    elif until is not None:
+        history = history.filter(created_at__gt=until)
+    querysets.append(
+        history.order_by('-created_at')[:settings.MENTION_CONTEXT_MAX_ROWS])
+    return querysets
+
+
+def _pack_context(event, model, candidates, summary=None):
+    """
+    Messages with the memory summary, if any, and as many candidate rows as
+    fit the model's token budget
+    """
+    budget = (context_token_budget(model) - count_tokens(SYSTEM_PROMPT) -
+              count_tokens(event['text']) - 2 * MESSAGE_OVERHEAD_TOKENS)
+
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if summary is not None and summary.summary_text:
+        content = f"Summary of the earlier conversation:\n{summary.summary_text}"
+        cost = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        if cost <= budget:
+            budget -= cost
+            messages.append({"role": "system", "content": content})
+
+    selected = []
+    seen = set()
+    for conv in candidates:
+        if conv.pk in seen:
+            continue
+        seen.add(conv.pk)
+        cost = conversation_tokens(conv) + 2 * MESSAGE_OVERHEAD_TOKENS
+        if cost > budget:
+            break
+        budget -= cost
+        selected.append(conv)
+    selected.sort(key=lambda conv: conv.created_at)
+
+    for conv in selected:
+        messages.append({"role": "user", "content": conv.message_text})
+        if conv.response:
+            messages.append({"role": "assistant", "content": conv.response})
+    messages.append({"role": "user", "content": event['text']})
+    return messages
+
+
+def build_mention_context(workspace, event, model):
+    """
+    Build the Groq messages for a mention.
+
+    With memory on, the thread's running summary comes first and only the
+    turns it doesn't cover are candidates. History from the same thread is
+    preferred, then the rest of the channel, newest first, for as long as it
+    fits the token budget of the model. The selected turns are returned
+    oldest first, between the system prompt(s) and the new message.
+    """
+    with span('history'):
+        summary = None
+        if settings.MEMORY_ENABLED:
+            summary = _summary_queryset(workspace, event).first()
+        candidates = []
+        for queryset in _history_querysets(workspace, event, summary):
+            candidates.extend(queryset)
+    with span('prompt', candidates=len(candidates), summary=summary is not None):
+        return _pack_context(event, model, candidates, summary)
+
+
+async def abuild_mention_context(workspace, event, model):
+    """build_mention_context with async ORM access"""
+    with span('history'):
+        summary = None
+        if settings.MEMORY_ENABLED:
+            summary = await _summary_queryset(workspace, event).afirst()
+        candidates = []
+        for queryset in _history_querysets(workspace, event, summary):
+            candidates.extend([conv async for conv in queryset])
+    with span('prompt', candidates=len(candidates), summary=summary is not None):
+        return _pack_context(event, model, candidates, summary)
@@ -0,0 +1,44 @@
+import logging
+
+from django.conf import settings
+
+from .cache import get_cache
+
+logger = logging.getLogger(__name__)
+
+
+class EventDeduplicator:
+    """
+    Remembers Slack event_ids so retried deliveries are dropped.
+
+    The store can be any cache with add/delete (see chatbot.cache), by
+    default the shared Redis cache with its in-process LRU fallback.
+    """
+
+    def __init__(self, store=None, ttl=None):
+        self.ttl = settings.SLACK_EVENT_DEDUP_TTL if ttl is None else ttl
+        self.store = store if store is not None else get_cache(
+            'slack-events',
+            max_entries=settings.SLACK_EVENT_DEDUP_MAX_ENTRIES,
+            default_ttl=self.ttl)
+
+    def claim(self, event_id):
+        """Returns True the first time an event_id is seen, False for repeats"""
+        if not event_id:
+            return True
+        return self.store.add(event_id, 1, ttl=self.ttl)
+
+    def release(self, event_id):
+        """Forget an event_id so a Slack retry gets processed again"""
+        if event_id:
+            self.store.delete(event_id)
+
+
+_deduplicator = None
+
+
+def get_event_deduplicator():
+    global _deduplicator
+    if _deduplicator is None:
+        _deduplicator = EventDeduplicator()
+    return _deduplicator
@@ -0,0 +1,166 @@
+import base64
+import contextvars
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from PIL import Image
+
+from .cache import get_cache
+from .routing import primary_model
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FILETYPES = ['png', 'jpg', 'jpeg']
+
+VISION_PROMPT = "Analyze this image in the context of a Slack conversation that is expressing the sentiment of a given product. What do you see? Keep it concise and under 350 words"
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def download_slack_file(url, bot_token, max_bytes):
+    """Stream a private Slack file into memory, refusing anything over max_bytes"""
+    with requests.get(url,
+                      headers={'Authorization': f"Bearer {bot_token}"},
+                      allow_redirects=True,
+                      stream=True,
+                      timeout=settings.SLACK_FILE_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length') or 0) > max_bytes:
+            raise ImageTooLarge(f"{url} is {response.headers['Content-Length']} bytes")
+        data = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                raise ImageTooLarge(f"{url} is over {max_bytes} bytes")
+        return bytes(data)
+
+
+def prepare_image(data):
+    """
+    Downscale and recompress an image for the vision model.
+
+    The longest side is capped at VISION_IMAGE_MAX_DIMENSION and the result
+    re-encoded as JPEG. Returns a base64 data URL.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((settings.VISION_IMAGE_MAX_DIMENSION,
+                     settings.VISION_IMAGE_MAX_DIMENSION))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=settings.VISION_IMAGE_QUALITY,
+               optimize=True)
+    encoded = base64.b64encode(output.getvalue()).decode('utf-8')
+    return f"data:image/jpeg;base64,{encoded}"
+
+
+def vision_cache():
+    return get_cache('vision',
+                     max_entries=settings.VISION_CACHE_MAX_ENTRIES,
+                     default_ttl=settings.VISION_CACHE_TTL)
+
+
+def analyze_slack_image(slack_client, groq_client, file, bot_token):
+    """
+    Get the vision analysis of an image shared in Slack.
+
+    Results are cached by content hash (and vision model), with the hash
+    of every Slack file id remembered too, so an image seen before costs
+    neither a download nor a vision call and a re-upload of the same
+    image costs only the download. Answers of a fallback model aren't
+    cached, the next look at the image goes to the primary one again.
+    """
+    cache = vision_cache()
+    model = primary_model('vision')
+    content_hash = cache.get(f"file:{file['id']}")
+    if content_hash:
+        analysis = cache.get(f"result:{model}:{content_hash}")
+        if analysis:
+            return analysis
+
+    # Get file info from Slack to get direct download URL
+    file_info = slack_client.get_file_info(file['id'])
+    direct_url = file_info.get('url_private_download', file_info.get('url_private'))
+    # Download the image using the bot token for authentication
+    data = download_slack_file(direct_url, bot_token,
+                               settings.VISION_IMAGE_MAX_BYTES)
+    content_hash = hashlib.sha256(data).hexdigest()
+    cache.set(f"file:{file['id']}", content_hash)
+    analysis = cache.get(f"result:{model}:{content_hash}")
+    if analysis:
+        return analysis
+
+    image_url = prepare_image(data)
+    # Use vision model for image analysis
+    vision_prompt = [{
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": VISION_PROMPT
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url
+                }
+            }
+        ]
+    }]
+    answered_by, analysis = groq_client.get_vision_response(vision_prompt,
+                                                            with_model=True)
+    if answered_by == model:
+        cache.set(f"result:{model}:{content_hash}", analysis)
+    return analysis
+
+
+def analyze_slack_images(slack_client, groq_client, messages, bot_token):
+    """
+    Analyze the images shared in messages concurrently.
+
+    Takes the most recent VISION_MAX_IMAGES png/jpg files and runs the file lookup, download and
+    vision call for each on a thread pool. Images that fail are logged and
+    skipped. Returns (file, analysis) pairs, most recent first.
+    """
+    files = []
+    seen = set()
+    for msg in sorted(messages, key=lambda msg: float(msg['ts']), reverse=True):
+        for file in msg.get('files', []):
+            if file.get('filetype') in IMAGE_FILETYPES and file['id'] not in seen:
+                seen.add(file['id'])
+                files.append(file)
+    files = files[:settings.VISION_MAX_IMAGES]
+    if not files:
+        return []
+
+    results = []
+    with ThreadPoolExecutor(max_workers=min(settings.VISION_MAX_CONCURRENCY,
+                                            len(files))) as pool:
+        # Each call runs in a copy of this context, to keep its trace spans
+        # under the caller's
+        futures = [
+            pool.submit(contextvars.copy_context().run, analyze_slack_image,
+                        slack_client, groq_client, file, bot_token)
+            for file in files
+        ]
+        for file, future in zip(files, futures):
+            try:
+                results.append((file, future.result()))
+            except Exception as e:
+                logger.error(f"Error analyzing image {file['id']}: {e}")
+    return results
+
+
+def combine_image_analyses(results):
+    """Merge per-image analyses into the text used in prompts and replies"""
+    if len(results) == 1:
+        return results[0][1]
+    return "\n\n".join(
+        f"Image {i} ({file.get('name') or file['id']}):\n{analysis}"
+        for i, (file, analysis) in enumerate(results, start=1))
@@ -0,0 +1,54 @@
+from django.conf import settings
+
+from .context import count_tokens
+from .models import ConversationHistory
+
+
+def is_bot_message(msg):
+    """Check for bot messages in multiple ways"""
+    return (
+        bool(msg.get('bot_id')) or  # Has bot_id
+        msg.get('subtype') == 'bot_message' or  # Explicit bot message
+        bool(msg.get('app_id'))  # Message from an app
+    )
+
+
+def store_slack_messages(workspace, channel_id, messages):
+    """
+    Persist Slack messages for a channel in bulk.
+
+    Messages without text are skipped. New rows go in with one bulk insert
+    that ignores messages already stored (unique on message_ts), then all
+    rows are read back with a single query. Returns the stored
+    ConversationHistory rows in the same order as messages.
+    """
+    rows = [
+        ConversationHistory(workspace=workspace,
+                            channel_id=channel_id,
+                            message_ts=msg['ts'],
+                            user_id=msg.get('user', ''),
+                            message_text=msg.get('text', ''),
+                            thread_ts=msg.get('thread_ts'),
+                            message_type=msg.get('type', 'text'),
+                            is_bot_message=is_bot_message(msg),
+                            token_count=count_tokens(msg.get('text', '')))
+        for msg in messages if msg.get('text')
+    ]
+    if not rows:
+        return []
+
+    ConversationHistory.objects.bulk_create(
+        rows,
+        batch_size=settings.INGESTION_BATCH_SIZE,
+        ignore_conflicts=True)
+
+    timestamps = [row.message_ts for row in rows]
+    stored = {}
+    for start in range(0, len(timestamps), settings.INGESTION_BATCH_SIZE):
+        stored.update(
+            (conv.message_ts, conv)
+            for conv in ConversationHistory.objects.filter(
+                workspace=workspace,
+                channel_id=channel_id,
+                message_ts__in=timestamps[start:start + settings.INGESTION_BATCH_SIZE]))
+    return [stored[ts] for ts in timestamps if ts in stored]
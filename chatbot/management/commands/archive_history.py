@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import SlackWorkspace
+from chatbot.retention import (archive_workspace, pending_archive_count,
+                               retention_cutoff)
+
+
+class Command(BaseCommand):
+    help = ("Archive conversation history older than each workspace's "
+            "retention horizon to gzipped JSONL files and roll it up per "
+            "channel and day. Safe to interrupt and run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--team-id', help="Only archive this workspace")
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help="Batches per channel at most in this run")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many rows would be archived")
+
+    def handle(self, *args, **options):
+        workspaces = SlackWorkspace.objects.order_by('team_id')
+        if options['team_id']:
+            workspaces = workspaces.filter(team_id=options['team_id'])
+            if not workspaces.exists():
+                raise CommandError(f"No workspace with team ID {options['team_id']}")
+
+        total = 0
+        for workspace in workspaces:
+            cutoff = retention_cutoff(workspace)
+            if cutoff is None:
+                self.stdout.write(f"{workspace.team_id}: kept forever")
+                continue
+            if options['dry_run']:
+                count = pending_archive_count(workspace)
+                self.stdout.write(f"{workspace.team_id}: {count} rows created "
+                                  f"before {cutoff:%Y-%m-%d %H:%M} to archive")
+            else:
+                channels = archive_workspace(workspace,
+                                             max_batches=options['max_batches'])
+                count = sum(channels.values())
+                self.stdout.write(f"{workspace.team_id}: archived {count} rows "
+                                  f"from {len(channels)} channel(s)")
+            total += count
+
+        verb = "to archive" if options['dry_run'] else "archived"
+        self.stdout.write(self.style.SUCCESS(f"{total} rows {verb}"))
@@ -0,0 +1,162 @@
+import json
+import resource
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from benchmarks.fakes import (FakeFileServer, FakeGroqClient, FakeSlackClient,
+                              offline_celery, synthetic_channel_messages)
+from chatbot.images import vision_cache
+from chatbot.models import ChannelAnalysis, SlackWorkspace
+from chatbot.stages import add_stage_listener, current_stage, remove_stage_listener
+from chatbot.tasks import analyze_channel_sentiment
+from chatbot.workspaces import invalidate_workspace
+
+STAGES = ['fetch', 'persist', 'images', 'prompt', 'llm', 'post']
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = ("Run analyze_channel_sentiment in-process on synthetic channels "
+            "behind fake Slack and Groq clients and report per-stage timings, "
+            "peak RSS and query counts")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, nargs='+',
+                            default=[1000, 10000],
+                            help="Channel sizes to run, smallest first")
+        parser.add_argument('--hours', type=int, default=24)
+        parser.add_argument('--thread-ratio', type=float, default=0.1)
+        parser.add_argument('--bot-ratio', type=float, default=0.1)
+        parser.add_argument('--image-ratio', type=float, default=0.001)
+        parser.add_argument('--slack-latency', type=float, default=0,
+                            help="Seconds added to every fake Slack call")
+        parser.add_argument('--groq-latency', type=float, default=0,
+                            help="Seconds added to every fake Groq call")
+        parser.add_argument('--chunk-tokens', type=int, default=None,
+                            help="Override ANALYSIS_CHUNK_TOKENS")
+        parser.add_argument('--tracemalloc', action='store_true',
+                            help="Also trace Python allocations (slow)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true',
+                            help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        overrides = {
+            'CACHE_BACKEND': 'local',
+            'RATE_LIMIT_ENABLED': False,
+            'GROQ_RESPONSE_CACHE_ENABLED': False,
+            'SLACK_HISTORY_MAX_BYTES': 2 ** 40,
+        }
+        if options['chunk_tokens']:
+            overrides['ANALYSIS_CHUNK_TOKENS'] = options['chunk_tokens']
+
+        reports = []
+        with FakeFileServer() as files, offline_celery(eager=True), \
+                override_settings(**overrides):
+            for count in sorted(options['messages']):
+                with override_settings(SLACK_HISTORY_MAX_MESSAGES=count + 1):
+                    reports.append(self.run(count, files.url, options))
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+        else:
+            for report in reports:
+                self.print_report(report)
+
+    def run(self, count, file_url, options):
+        messages = synthetic_channel_messages(count,
+                                              hours=options['hours'],
+                                              thread_ratio=options['thread_ratio'],
+                                              bot_ratio=options['bot_ratio'],
+                                              image_ratio=options['image_ratio'],
+                                              seed=options['seed'])
+        workspace = SlackWorkspace.objects.create(
+            team_id=f"TBENCH{uuid.uuid4().hex[:8].upper()}",
+            team_name='Benchmark',
+            bot_user_id='UBENCHBOT',
+            bot_token='xoxb-benchmark')
+        slack_client = FakeSlackClient(messages,
+                                       latency=options['slack_latency'],
+                                       file_url=f"{file_url}/files",
+                                       team_id=workspace.team_id)
+        groq_client = FakeGroqClient(latency=options['groq_latency'])
+        vision_cache().clear()
+
+        stages = defaultdict(lambda: {'seconds': 0.0, 'calls': 0, 'queries': 0})
+
+        def record_stage(name, started, duration):
+            stages[name]['seconds'] += duration
+            stages[name]['calls'] += 1
+
+        def count_query(execute, sql, params, many, context):
+            stages[current_stage() or 'other']['queries'] += 1
+            return execute(sql, params, many, context)
+
+        add_stage_listener(record_stage)
+        if options['tracemalloc']:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            with mock.patch('chatbot.tasks.get_slack_client',
+                            return_value=slack_client), \
+                    mock.patch('chatbot.tasks.GroqClient',
+                               return_value=groq_client), \
+                    connection.execute_wrapper(count_query):
+                # Through apply() so task signals (metrics, spans) fire
+                analyze_channel_sentiment.apply(
+                    args=(str(workspace.uuid), 'CBENCH', options['hours'])).get()
+            elapsed = time.perf_counter() - started
+            traced_peak = None
+            if options['tracemalloc']:
+                traced_peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            if options['tracemalloc']:
+                tracemalloc.stop()
+            remove_stage_listener(record_stage)
+            # The chord path returns before the reduce step has counted them
+            analyzed = ChannelAnalysis.objects.filter(
+                workspace=workspace).values_list('message_count', flat=True).last()
+            invalidate_workspace(workspace)
+            workspace.delete()
+
+        staged = sum(stages[name]['seconds'] for name in stages if name != 'other')
+        stages['other']['seconds'] = max(0.0, elapsed - staged)
+        return {
+            'messages': count,
+            'analyzed_messages': analyzed,
+            'elapsed_s': elapsed,
+            'stages': {name: stages[name] for name in STAGES + ['other'] if name in stages},
+            'queries': sum(stage['queries'] for stage in stages.values()),
+            'groq_calls': groq_client.calls,
+            'groq_prompt_tokens': groq_client.prompt_tokens,
+            'slack_calls': dict(slack_client.client.calls),
+            'peak_rss_mb': peak_rss_mb(),
+            'traced_peak_mb': traced_peak,
+        }
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['messages']} messages ({report['analyzed_messages']} analyzed) "
+            f"in {report['elapsed_s']:.2f}s, {report['queries']} queries, "
+            f"{report['groq_calls']} Groq calls (~{report['groq_prompt_tokens']} "
+            f"prompt tokens), peak RSS {report['peak_rss_mb']:.0f}MB"
+            + (f", traced peak {report['traced_peak_mb']:.1f}MB"
+               if report['traced_peak_mb'] is not None else ""))
+        self.stdout.write(f"  {'stage':<10}{'seconds':>10}{'share':>8}"
+                          f"{'calls':>8}{'queries':>9}")
+        for name, stats in report['stages'].items():
+            share = stats['seconds'] / report['elapsed_s'] * 100 if report['elapsed_s'] else 0
+            self.stdout.write(f"  {name:<10}{stats['seconds']:>10.3f}{share:>7.1f}%"
+                              f"{stats['calls']:>8}{stats['queries']:>9}")
+        self.stdout.write(f"  Slack calls: {report['slack_calls']}")
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from benchmarks.fakes import FakeGroqServer
+from chatbot.clients import GroqClient
+
+
+class Command(BaseCommand):
+    help = ("Call a local fake Groq server through GroqClient and report how "
+            "many connections the shared pool opened")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=20)
+        parser.add_argument('--latency', type=float, default=0,
+                            help="Seconds the fake server waits per call")
+
+    def handle(self, *args, **options):
+        with FakeGroqServer(latency=options['latency']) as server:
+            with override_settings(GROQ_BASE_URL=server.url,
+                                   GROQ_API_KEY='fake-key',
+                                   RATE_LIMIT_ENABLED=False):
+                messages = [{"role": "user", "content": "ping"}]
+                started = time.perf_counter()
+                for _ in range(options['calls']):
+                    # A fresh GroqClient per call, like every event and task
+                    GroqClient().get_response(messages)
+                elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{server.requests} calls over {len(server.connections)} "
+            f"connection(s) in {elapsed:.3f}s")
+        if len(server.connections) > 1:
+            self.stderr.write(
+                self.style.WARNING("Connections were not reused"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Connection pool reused"))
@@ -0,0 +1,87 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from benchmarks.fakes import FakeGroqServer
+from chatbot.clients import GroqClient
+from chatbot.management.commands.loadtest_events import percentile
+from chatbot.metrics import GROQ_FAILOVERS, GROQ_HEDGES
+from chatbot.routing import latency_tracker, route
+
+
+def counter_total(counter, **labels):
+    return sum(sample.value for metric in counter.collect()
+               for sample in metric.samples
+               if sample.name.endswith('_total')
+               and all(sample.labels.get(k) == v for k, v in labels.items()))
+
+
+class Command(BaseCommand):
+    help = ("Call a local fake Groq server through GroqClient's model routing, "
+            "with failing or slow models, and report which models answered, "
+            "failovers, hedges and latency")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--task', default='mention')
+        parser.add_argument('--calls', type=int, default=50)
+        parser.add_argument('--fail', nargs='*', default=[],
+                            help="Models the fake server answers with a 503")
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help="Seconds the fake server waits per call")
+        parser.add_argument('--tail-rate', type=float, default=0,
+                            help="Fraction of calls that are slow")
+        parser.add_argument('--tail-latency', type=float, default=1,
+                            help="Seconds added to slow calls")
+        parser.add_argument('--hedge', action='store_true',
+                            help="Hedge calls of --task")
+        parser.add_argument('--deadline', type=float, default=None,
+                            help="Override the deadline of --task")
+
+    def handle(self, *args, **options):
+        task = options['task']
+        server = FakeGroqServer(latency=options['latency'],
+                                failing_models=options['fail'],
+                                tail_rate=options['tail_rate'],
+                                tail_latency=options['tail_latency'])
+        overrides = {
+            'GROQ_API_KEY': 'fake-key',
+            'GROQ_RESPONSE_CACHE_ENABLED': False,
+            'RATE_LIMIT_ENABLED': False,
+            'GROQ_HEDGE_ENABLED': options['hedge'],
+            'GROQ_HEDGE_TASKS': [task],
+        }
+        if options['deadline']:
+            overrides['GROQ_ROUTE_DEADLINES'] = dict(settings.GROQ_ROUTE_DEADLINES,
+                                                     **{task: options['deadline']})
+
+        failovers = counter_total(GROQ_FAILOVERS, task=task)
+        hedges = counter_total(GROQ_HEDGES, task=task)
+        hedge_wins = counter_total(GROQ_HEDGES, task=task, winner='hedge')
+        latency_tracker.clear()
+        latencies = []
+        errors = 0
+        with server, override_settings(GROQ_BASE_URL=server.url, **overrides):
+            self.stdout.write(f"Route for {task}: {' -> '.join(route(task))}")
+            messages = [{"role": "user", "content": "ping"}]
+            for _ in range(options['calls']):
+                started = time.perf_counter()
+                try:
+                    GroqClient().get_response(messages, task=task)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        latencies.sort()
+        self.stdout.write(
+            f"{options['calls']} calls, {errors} errors, p50 "
+            f"{percentile(latencies, 50) * 1000:.0f}ms, p99 "
+            f"{percentile(latencies, 99) * 1000:.0f}ms, max "
+            f"{latencies[-1] * 1000:.0f}ms")
+        self.stdout.write(f"Requests per model: {server.models}")
+        self.stdout.write(
+            f"Failovers: {counter_total(GROQ_FAILOVERS, task=task) - failovers:.0f}, "
+            f"hedged: {counter_total(GROQ_HEDGES, task=task) - hedges:.0f} "
+            f"(hedge won "
+            f"{counter_total(GROQ_HEDGES, task=task, winner='hedge') - hedge_wins:.0f})")
@@ -0,0 +1,248 @@
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from benchmarks.fakes import FakeGroqServer, FakeSlackServer, offline_celery
+from chatbot.models import SlackWorkspace
+from chatbot.workspaces import invalidate_workspace
+
+SIGNING_SECRET = 'loadtest-signing-secret'
+CHANNELS = ['CLOAD0001', 'CLOAD0002', 'CLOAD0003', 'CLOAD0004']
+QUESTIONS = [
+    "how do people feel about the new release?",
+    "can you summarize what we decided about pricing?",
+    "any blockers mentioned for the launch?",
+    "what are the top complaints this week?",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0
+    rank = max(1, round(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def sign(body, timestamp):
+    base = f"v0:{timestamp}:{body}"
+    return "v0=" + hmac.new(SIGNING_SECRET.encode(), base.encode(),
+                            hashlib.sha256).hexdigest()
+
+
+class Command(BaseCommand):
+    help = ("Replay synthetic app_mention, /analyze and retried events against "
+            "the Slack events endpoint, with local fake Slack and Groq servers, "
+            "and report ack latency, throughput, queries and errors")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=float, default=20,
+                            help="Target requests per second")
+        parser.add_argument('--duration', type=float, default=10,
+                            help="Seconds to send for")
+        parser.add_argument('--concurrency', type=int, default=16,
+                            help="Requests in flight at most")
+        parser.add_argument('--mix', default='mention=0.7,analyze=0.1,retry=0.2',
+                            help="Weights of the payload kinds")
+        parser.add_argument('--path', default='/api/slack/events/')
+        parser.add_argument('--slack-latency', type=float, default=0.05)
+        parser.add_argument('--slack-error-rate', type=float, default=0)
+        parser.add_argument('--groq-latency', type=float, default=0.5)
+        parser.add_argument('--groq-error-rate', type=float, default=0)
+        parser.add_argument('--eager', action='store_true',
+                            help="Run Celery tasks inside the request")
+        parser.add_argument('--rate-limits', action='store_true',
+                            help="Keep the Slack and Groq rate limiters on")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--json', action='store_true',
+                            help="Print the report as JSON")
+        parser.add_argument('--keep-data', action='store_true',
+                            help="Keep the load test workspace and its rows")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        slack = FakeSlackServer(latency=options['slack_latency'],
+                                error_rate=options['slack_error_rate'])
+        groq = FakeGroqServer(latency=options['groq_latency'],
+                              error_rate=options['groq_error_rate'])
+        with slack, groq, offline_celery(options['eager']), override_settings(
+                SLACK_API_URL=f"{slack.url}/api/",
+                GROQ_BASE_URL=groq.url,
+                GROQ_API_KEY='fake-key',
+                GROQ_RESPONSE_CACHE_ENABLED=False,
+                SLACK_SIGNING_SECRET=SIGNING_SECRET,
+                SLACK_VERIFY_SIGNATURES=True,
+                CACHE_BACKEND='local',
+                RATE_LIMIT_ENABLED=options['rate_limits']):
+            workspace = SlackWorkspace.objects.create(
+                team_id=f"TLOAD{uuid.uuid4().hex[:8].upper()}",
+                team_name='Load test',
+                bot_user_id='ULOADBOT',
+                bot_token='xoxb-loadtest')
+            try:
+                plan = self.plan(workspace.team_id, options, rng)
+                started = time.perf_counter()
+                samples = self.replay(plan, options, started)
+                elapsed = time.perf_counter() - started
+            finally:
+                invalidate_workspace(workspace)
+                if not options['keep_data']:
+                    workspace.delete()
+
+        report = self.report(samples, elapsed, options)
+        report['fake_slack_calls'] = dict(slack.calls)
+        report['fake_groq_calls'] = groq.requests
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report)
+
+    def plan(self, team_id, options, rng):
+        """The (kind, body, content type, extra headers) to send, in order"""
+        weights = {}
+        for item in options['mix'].split(','):
+            kind, weight = item.split('=')
+            weights[kind.strip()] = float(weight)
+        kinds = list(weights)
+        count = max(1, int(options['rate'] * options['duration']))
+        base_ts = int(time.time())
+
+        plan = []
+        sent_events = []
+        for i in range(count):
+            kind = rng.choices(kinds, weights=[weights[k] for k in kinds])[0]
+            if kind == 'retry' and sent_events:
+                # Slack redelivers the same event_id with a retry header
+                body, retry_num = rng.choice(sent_events), rng.randint(1, 3)
+                plan.append(('retry', body, 'application/json',
+                             {'X-Slack-Retry-Num': str(retry_num),
+                              'X-Slack-Retry-Reason': 'http_timeout'}))
+            elif kind == 'analyze':
+                body = urlencode({
+                    'command': '/analyze',
+                    'team_id': team_id,
+                    'channel_id': rng.choice(CHANNELS),
+                    'user_id': f"U{rng.randint(1000, 9999)}",
+                    'text': str(rng.randint(1, 24)),
+                })
+                plan.append(('analyze', body,
+                             'application/x-www-form-urlencoded', {}))
+            else:
+                ts = f"{base_ts}.{i:06d}"
+                event = {
+                    'type': 'app_mention',
+                    'user': f"U{rng.randint(1000, 9999)}",
+                    'text': f"<@ULOADBOT> {rng.choice(QUESTIONS)}",
+                    'ts': ts,
+                    'channel': rng.choice(CHANNELS),
+                    'event_ts': ts,
+                }
+                if rng.random() < 0.3:
+                    event['thread_ts'] = f"{base_ts - 60}.000000"
+                body = json.dumps({
+                    'type': 'event_callback',
+                    'team_id': team_id,
+                    'event_id': f"Ev{uuid.uuid4().hex[:10].upper()}",
+                    'event_time': base_ts,
+                    'event': event,
+                })
+                sent_events.append(body)
+                plan.append(('mention', body, 'application/json', {}))
+        return plan
+
+    def replay(self, plan, options, started):
+        """Send the plan open loop at the target rate, returns one sample per request"""
+        local = threading.local()
+        interval = 1 / options['rate']
+
+        def send(i, kind, body, content_type, extra_headers):
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lag = max(0, -delay)
+            if not hasattr(local, 'client'):
+                local.client = Client(raise_request_exception=False)
+            timestamp = str(int(time.time()))
+            headers = {
+                'X-Slack-Request-Timestamp': timestamp,
+                'X-Slack-Signature': sign(body, timestamp),
+                **extra_headers,
+            }
+            with CaptureQueriesContext(connection) as queries:
+                sent = time.perf_counter()
+                response = local.client.post(options['path'], body,
+                                             content_type=content_type,
+                                             headers=headers)
+                latency = time.perf_counter() - sent
+            return {
+                'kind': kind,
+                'status': response.status_code,
+                'latency': latency,
+                'queries': len(queries),
+                'lag': lag,
+            }
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            futures = [pool.submit(send, i, *item) for i, item in enumerate(plan)]
+            return [future.result() for future in futures]
+
+    def report(self, samples, elapsed, options):
+        def summary(group):
+            latencies = sorted(sample['latency'] for sample in group)
+            queries = [sample['queries'] for sample in group]
+            errors = sum(1 for sample in group if sample['status'] >= 400)
+            return {
+                'requests': len(group),
+                'errors': errors,
+                'error_rate': errors / len(group) if group else 0,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': (latencies[-1] if latencies else 0) * 1000,
+                'queries_mean': sum(queries) / len(queries) if queries else 0,
+                'queries_max': max(queries, default=0),
+            }
+
+        report = summary(samples)
+        report.update({
+            'elapsed_s': elapsed,
+            'target_rate': options['rate'],
+            'throughput': len(samples) / elapsed if elapsed else 0,
+            'max_lag_ms': max((s['lag'] for s in samples), default=0) * 1000,
+            'statuses': dict(Counter(str(s['status']) for s in samples)),
+            'kinds': {
+                kind: summary([s for s in samples if s['kind'] == kind])
+                for kind in sorted({s['kind'] for s in samples})
+            },
+        })
+        return report
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['requests']} requests in {report['elapsed_s']:.2f}s: "
+            f"{report['throughput']:.1f} req/s (target {report['target_rate']:.1f}), "
+            f"max schedule lag {report['max_lag_ms']:.0f}ms")
+        self.stdout.write(f"{'kind':<10}{'n':>6}{'err%':>7}{'p50':>9}{'p95':>9}"
+                          f"{'p99':>9}{'max':>9}{'q avg':>7}{'q max':>7}")
+        rows = list(report['kinds'].items()) + [('all', report)]
+        for kind, stats in rows:
+            self.stdout.write(
+                f"{kind:<10}{stats['requests']:>6}{stats['error_rate'] * 100:>6.1f}%"
+                f"{stats['p50_ms']:>7.1f}ms{stats['p95_ms']:>7.1f}ms"
+                f"{stats['p99_ms']:>7.1f}ms{stats['max_ms']:>7.1f}ms"
+                f"{stats['queries_mean']:>7.1f}{stats['queries_max']:>7}")
+        self.stdout.write(f"Statuses: {report['statuses']}")
+        self.stdout.write(f"Fake Slack calls: {report['fake_slack_calls']}, "
+                          f"fake Groq calls: {report['fake_groq_calls']}")
@@ -0,0 +1,147 @@
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .cache import get_cache
+from .context import conversation_tokens, count_tokens
+from .models import ConversationHistory, ThreadSummary
+
+FOLD_SYSTEM_PROMPT = "You maintain the memory of a Slack conversation between users and an assistant. You are given the current summary of the conversation (possibly empty) and the turns that followed it, oldest first. Rewrite the summary so it also covers those turns: keep the facts, decisions, open questions and user preferences needed to continue the conversation, drop small talk. Reply with the summary only."
+
+
+def memory_thread(event):
+    """Key of the summary a mention reads and feeds, '' outside threads"""
+    return event.get('thread_ts') or ""
+
+
+def conversation_rows(workspace, channel_id, thread_ts):
+    """Stored turns of a thread (with its parent), or of the whole channel"""
+    rows = ConversationHistory.objects.filter(workspace=workspace,
+                                              channel_id=channel_id)
+    if thread_ts:
+        rows = rows.filter(Q(thread_ts=thread_ts) | Q(message_ts=thread_ts))
+    return rows
+
+
+def unsummarized_rows(workspace, channel_id, thread_ts, summary=None):
+    """Turns newer than the ones folded into summary"""
+    rows = conversation_rows(workspace, channel_id, thread_ts)
+    if summary is not None and summary.summarized_until is not None:
+        rows = rows.filter(created_at__gt=summary.summarized_until)
+    return rows
+
+
+def get_summary(workspace, channel_id, thread_ts):
+    return ThreadSummary.objects.filter(workspace=workspace,
+                                        channel_id=channel_id,
+                                        thread_ts=thread_ts).first()
+
+
+def needs_fold(workspace, channel_id, thread_ts):
+    """Whether the turns not summarized yet are over the fold threshold"""
+    summary = get_summary(workspace, channel_id, thread_ts)
+    tokens = 0
+    for conv in unsummarized_rows(
+            workspace, channel_id, thread_ts, summary).order_by(
+                '-created_at').only('message_text', 'response', 'token_count')[
+                    :settings.MEMORY_FOLD_MAX_ROWS]:
+        tokens += conversation_tokens(conv)
+        if tokens > settings.MEMORY_FOLD_THRESHOLD_TOKENS:
+            return True
+    return False
+
+
+_fold_claims = None
+
+
+def fold_claims():
+    """Threads with a fold queued or running, shared by all workers"""
+    global _fold_claims
+    if _fold_claims is None:
+        _fold_claims = get_cache('memory-folds',
+                                 default_ttl=settings.MEMORY_FOLD_CLAIM_TTL)
+    return _fold_claims
+
+
+def claim_fold(workspace, channel_id, thread_ts):
+    """
+    Returns True if no fold of the thread is queued or running yet, and
+    claims it. Concurrent folds would each pay for Groq calls, and all but
+    one be thrown away.
+    """
+    return fold_claims().add(f"{workspace.uuid}:{channel_id}:{thread_ts}", 1,
+                             ttl=settings.MEMORY_FOLD_CLAIM_TTL)
+
+
+def release_fold(workspace, channel_id, thread_ts):
+    fold_claims().delete(f"{workspace.uuid}:{channel_id}:{thread_ts}")
+
+
+def format_turns(rows):
+    lines = []
+    for conv in rows:
+        lines.append(f"User {conv.user_id}: {conv.message_text}")
+        if conv.response:
+            lines.append(f"Assistant: {conv.response}")
+    return "\n".join(lines)
+
+
+def _fold(groq_client, summary_text, rows):
+    return groq_client.get_response([{
+        "role": "system",
+        "content": FOLD_SYSTEM_PROMPT
+    }, {
+        "role": "user",
+        "content": f"Current summary:\n{summary_text or '(none)'}\n\nTurns that followed:\n{format_turns(rows)}"
+    }], max_tokens=settings.MEMORY_SUMMARY_MAX_TOKENS, task='summary')
+
+
+def fold_memory(groq_client, workspace, channel_id, thread_ts):
+    """
+    Fold all but the newest MEMORY_TAIL_TOKENS of the unsummarized turns of
+    a thread into its summary.
+
+    Turns go to Groq in chunks of MEMORY_FOLD_CHUNK_TOKENS, each call
+    rewriting the summary so far. The summary is only saved if no other
+    fold moved it meanwhile. Returns the number of turns folded.
+    """
+    summary, _ = ThreadSummary.objects.get_or_create(workspace=workspace,
+                                                     channel_id=channel_id,
+                                                     thread_ts=thread_ts)
+    rows = list(unsummarized_rows(workspace, channel_id, thread_ts,
+                                  summary).order_by('-created_at')
+                [:settings.MEMORY_FOLD_MAX_ROWS])
+    rows.reverse()
+
+    # Keep the newest turns verbatim, they make up the prompt's tail
+    tail_tokens = 0
+    split = len(rows)
+    while split and tail_tokens + conversation_tokens(
+            rows[split - 1]) <= settings.MEMORY_TAIL_TOKENS:
+        split -= 1
+        tail_tokens += conversation_tokens(rows[split])
+    folded = rows[:split]
+    if not folded:
+        return 0
+
+    summary_text = summary.summary_text
+    chunk = []
+    chunk_tokens = 0
+    for conv in folded:
+        cost = conversation_tokens(conv)
+        if chunk and chunk_tokens + cost > settings.MEMORY_FOLD_CHUNK_TOKENS:
+            summary_text = _fold(groq_client, summary_text, chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(conv)
+        chunk_tokens += cost
+    summary_text = _fold(groq_client, summary_text, chunk)
+
+    updated = ThreadSummary.objects.filter(
+        pk=summary.pk, summarized_until=summary.summarized_until).update(
+            summary_text=summary_text,
+            summarized_until=folded[-1].created_at,
+            message_count=F('message_count') + len(folded),
+            token_count=count_tokens(summary_text),
+            updated_at=timezone.now())
+    return len(folded) if updated else 0
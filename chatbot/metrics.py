@@ -0,0 +1,183 @@
+import glob
+import os
+import time
+from contextlib import contextmanager
+
+from celery.signals import (before_task_publish, task_postrun, task_prerun,
+                            worker_process_shutdown)
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Histogram, generate_latest, multiprocess)
+
+from .tracing import span
+
+# With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py), every gunicorn
+# and Celery process writes its samples to files in that directory and the
+# metrics endpoint adds them up, so any worker can serve the whole picture.
+# Containers sharing a volume each get a directory under
+# PROMETHEUS_MULTIPROC_ROOT (see metrics_dir.sh), the endpoint adds up all
+# of them.
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                   120, 300)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+GROQ_LATENCY = Histogram('slackbot_groq_request_seconds',
+                         'Latency of Groq chat completion calls',
+                         ['model', 'outcome'], buckets=LATENCY_BUCKETS)
+GROQ_TOKENS = Counter('slackbot_groq_tokens',
+                      'Tokens used by Groq chat completions',
+                      ['model', 'kind'])
+GROQ_FAILOVERS = Counter('slackbot_groq_failovers',
+                         'Groq calls that failed over to the next model of their route',
+                         ['task', 'model'])
+GROQ_HEDGES = Counter('slackbot_groq_hedged_requests',
+                      'Hedged Groq calls, by which of the two answered first',
+                      ['task', 'winner'])
+GROQ_RESPONSE_CACHE = Counter('slackbot_groq_response_cache',
+                              'Lookups in the Groq response cache, by hit or miss',
+                              ['result'])
+SLACK_LATENCY = Histogram('slackbot_slack_request_seconds',
+                          'Latency of Slack Web API calls',
+                          ['method', 'outcome'], buckets=LATENCY_BUCKETS)
+SLACK_RATE_LIMITED = Counter('slackbot_slack_rate_limited',
+                             'Slack Web API calls answered with a 429',
+                             ['method'])
+HTTP_LATENCY = Histogram('slackbot_http_request_seconds',
+                         'Latency of HTTP requests', ['view', 'status'],
+                         buckets=LATENCY_BUCKETS)
+DB_QUERIES = Histogram('slackbot_db_queries_per_request',
+                       'ORM queries run by an HTTP request', ['view'],
+                       buckets=QUERY_COUNT_BUCKETS)
+DB_TIME = Histogram('slackbot_db_seconds_per_request',
+                    'Time spent in ORM queries by an HTTP request', ['view'],
+                    buckets=LATENCY_BUCKETS)
+STAGE_DURATION = Histogram('slackbot_analysis_stage_seconds',
+                           'Duration of the stages of a channel analysis',
+                           ['stage'], buckets=LATENCY_BUCKETS)
+TASK_QUEUE_WAIT = Histogram('slackbot_celery_queue_wait_seconds',
+                            'Time Celery tasks spent queued before starting',
+                            ['task', 'queue'], buckets=LATENCY_BUCKETS)
+TASK_DURATION = Histogram('slackbot_celery_task_seconds',
+                          'Run time of Celery tasks', ['task', 'state'],
+                          buckets=LATENCY_BUCKETS)
+
+
+class ContainersCollector:
+    """Sum of the multiprocess metrics files of every container under root"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def collect(self):
+        files = glob.glob(os.path.join(self.root, '*', '*.db'))
+        return multiprocess.MultiProcessCollector.merge(files, accumulate=True)
+
+
+def render_metrics():
+    """The current metrics in Prometheus text format, with their content type"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_ROOT'):
+        registry = CollectorRegistry()
+        registry.register(ContainersCollector(os.environ['PROMETHEUS_MULTIPROC_ROOT']))
+    elif os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class _GroqCall:
+
+    def __init__(self, model):
+        self.model = model
+        self.span = None
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        GROQ_TOKENS.labels(self.model, 'prompt').inc(usage.prompt_tokens or 0)
+        GROQ_TOKENS.labels(self.model, 'completion').inc(usage.completion_tokens or 0)
+        if self.span is not None:
+            self.span.set_attribute('prompt_tokens', usage.prompt_tokens)
+            self.span.set_attribute('completion_tokens', usage.completion_tokens)
+
+
+@contextmanager
+def track_groq_call(model):
+    """
+    Time and trace a Groq call, call record_usage() on the result to count
+    its tokens
+    """
+    call = _GroqCall(model or 'unknown')
+    outcome = 'error'
+    start = time.perf_counter()
+    try:
+        with span('groq.chat', model=call.model) as call.span:
+            yield call
+        outcome = 'ok'
+    finally:
+        GROQ_LATENCY.labels(call.model, outcome).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def track_slack_call(method):
+    """Time and trace a Slack Web API call, counting it if Slack rate limited it"""
+    outcome = 'error'
+    start = time.perf_counter()
+    try:
+        with span(f"slack.{method}"):
+            yield
+        outcome = 'ok'
+    except Exception as e:
+        response = getattr(e, 'response', None)
+        if getattr(response, 'status_code', None) == 429:
+            outcome = 'rate_limited'
+            SLACK_RATE_LIMITED.labels(method).inc()
+        raise
+    finally:
+        SLACK_LATENCY.labels(method, outcome).observe(time.perf_counter() - start)
+
+
+def observe_request(view, status, seconds, queries=None, query_seconds=None):
+    HTTP_LATENCY.labels(view, str(status)).observe(seconds)
+    if queries is not None:
+        DB_QUERIES.labels(view).observe(queries)
+        DB_TIME.labels(view).observe(query_seconds)
+
+
+def observe_stage(name, started, duration):
+    """Stage listener, see chatbot.stages"""
+    STAGE_DURATION.labels(name).observe(duration)
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    # Custom headers end up as attributes of the task's request
+    if headers is not None:
+        headers.setdefault('published_at', time.time())
+
+
+@task_prerun.connect
+def start_task_timer(task=None, **kwargs):
+    request = task.request
+    request.metrics_started = time.perf_counter()
+    published_at = getattr(request, 'published_at', None)
+    if published_at:
+        queue = (request.delivery_info or {}).get('routing_key') or 'unknown'
+        TASK_QUEUE_WAIT.labels(task.name, queue).observe(
+            max(0, time.time() - published_at))
+
+
+@task_postrun.connect
+def stop_task_timer(task=None, state=None, **kwargs):
+    started = getattr(task.request, 'metrics_started', None)
+    if started is not None:
+        TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(
+            time.perf_counter() - started)
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid=None, **kwargs):
+    # Gunicorn workers are handled by child_exit in gunicorn.conf.py
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,234 @@
+import logging
+import time
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve, reverse
+
+from .clients import SlackClient
+from .metrics import observe_request
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+def verify_slack_request(body, timestamp, signature):
+    """
+    Check a request really comes from Slack.
+
+    The timestamp has to be within SLACK_REQUEST_MAX_AGE seconds, so a
+    captured request can't be replayed later, and the signature has to
+    match the raw body. Returns an error message, or None if it's valid.
+    """
+    if not settings.SLACK_SIGNING_SECRET:
+        logger.error("SLACK_SIGNING_SECRET is not set, rejecting Slack request")
+        return "Signing secret not configured"
+    if not timestamp or not signature:
+        return "Missing signature headers"
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        return "Invalid timestamp"
+    if age > settings.SLACK_REQUEST_MAX_AGE:
+        return "Stale request"
+    if not SlackClient.verify_signature(body, timestamp, signature):
+        return "Invalid signature"
+    return None
+
+
+class SlackIngressMiddleware:
+    """
+    Fast path for the Slack events endpoints.
+
+    Sits first in MIDDLEWARE. For Slack's POSTs it reads the raw body once,
+    verifies the signature and timestamp, answers url_verification itself
+    and calls the events view directly with the parsed payload on
+    request.slack_payload, skipping the session, CSRF, auth and message
+    middleware these requests never use. Bad requests are rejected before
+    any DB access. Everything else passes through untouched.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        self._views = None
+
+    def views(self):
+        """Events views by path, resolved on first use once URLs are loaded"""
+        if self._views is None:
+            from .async_views import slack_events_async
+            from .views import SlackEventsView
+            self._views = {reverse('slack_events'): SlackEventsView.as_view()}
+            if settings.SERVER_MODE == 'asgi':
+                self._views[reverse('slack_events_async')] = slack_events_async
+        return self._views
+
+    def ingest(self, request):
+        """Returns (response, view): an early response, or the view to dispatch to"""
+        view = self.views().get(request.path)
+        if view is None or request.method != 'POST':
+            return None, None
+
+        body = request.body
+        if settings.SLACK_VERIFY_SIGNATURES:
+            error = verify_slack_request(
+                body, request.headers.get('X-Slack-Request-Timestamp'),
+                request.headers.get('X-Slack-Signature'))
+            if error:
+                logger.warning(f"Rejected Slack request to {request.path}: {error}")
+                return JsonResponse({'error': error}, status=401), None
+
+        from .async_views import parse_slack_body
+        try:
+            payload = parse_slack_body(body, request.headers.get('Content-Type', ''))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid payload'}, status=400), None
+        if payload.get('type') == 'url_verification':
+            return JsonResponse({'challenge': payload.get('challenge')}), None
+
+        request.slack_payload = payload
+        return None, view
+
+    @staticmethod
+    def rendered(response):
+        # The handler only renders template (and DRF) responses for views it
+        # called itself
+        if hasattr(response, 'render') and callable(response.render):
+            response = response.render()
+        return response
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response, view = self.ingest(request)
+        if response is not None:
+            return response
+        if view is None:
+            return self.get_response(request)
+        if iscoroutinefunction(view):
+            return self.rendered(async_to_sync(view)(request))
+        return self.rendered(view(request))
+
+    async def __acall__(self, request):
+        if request.path not in self.views():
+            return await self.get_response(request)
+        response, view = await sync_to_async(self.ingest)(request)
+        if response is not None:
+            return response
+        if view is None:
+            return await self.get_response(request)
+        if iscoroutinefunction(view):
+            return self.rendered(await view(request))
+        return await sync_to_async(lambda: self.rendered(view(request)))()
+
+
+class QueryCounter:
+    """connection.execute_wrapper() counting queries and the time they take"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def view_name(request):
+    """Low cardinality label for the view that served a request"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        # Views called by SlackIngressMiddleware were never resolved
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return 'not_found'
+    return match.view_name
+
+
+class MetricsMiddleware:
+    """
+    Record the latency of every request, and its ORM query count and time.
+
+    Queries are counted on the request thread's connection, so requests to
+    async views (whose queries run on other threads) only get a latency.
+    Goes first in MIDDLEWARE to see requests SlackIngressMiddleware answers.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+        queries = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        observe_request(view_name(request), response.status_code,
+                        time.perf_counter() - start, queries.count,
+                        queries.seconds)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.METRICS_ENABLED:
+            return await self.get_response(request)
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        observe_request(view_name(request), response.status_code,
+                        time.perf_counter() - start)
+        return response
+
+
+class TracingMiddleware:
+    """Open the root span of every request, see chatbot.tracing"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def annotate(current, request, response):
+        if current is not None:
+            current.set_attribute('view', view_name(request))
+            current.set_attribute('status', response.status_code)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with span('http.request', method=request.method,
+                  path=request.path) as current:
+            response = self.get_response(request)
+            self.annotate(current, request, response)
+        return response
+
+    async def __acall__(self, request):
+        with span('http.request', method=request.method,
+                  path=request.path) as current:
+            response = await self.get_response(request)
+            self.annotate(current, request, response)
+        return response
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.19 on 2026-10-17 18:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0002_conversationhistory_response'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationhistory',
+            name='message_type',
+            field=models.CharField(default='text', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='ChannelAnalysis',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel_id', models.CharField(max_length=32)),
+                ('analysis_text', models.TextField()),
+                ('message_count', models.IntegerField()),
+                ('time_window_hours', models.IntegerField()),
+                ('image_url', models.URLField(blank=True, null=True)),
+                ('workspace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatbot.slackworkspace')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
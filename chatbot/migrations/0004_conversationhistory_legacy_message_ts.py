@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def rename_legacy_message_ts(apps, schema_editor):
+    """
+    Mentions used to be stored with the literal 'text' as message_ts.
+    Give those rows a distinct placeholder so a unique constraint on
+    (workspace, channel_id, message_ts) can be added.
+    """
+    ConversationHistory = apps.get_model('chatbot', 'ConversationHistory')
+    legacy = []
+    for conv in ConversationHistory.objects.filter(
+            message_ts='text').only('uuid').iterator():
+        conv.message_ts = f"legacy-{conv.uuid.hex[:24]}"
+        legacy.append(conv)
+        if len(legacy) >= 1000:
+            ConversationHistory.objects.bulk_update(legacy, ['message_ts'])
+            legacy = []
+    if legacy:
+        ConversationHistory.objects.bulk_update(legacy, ['message_ts'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_conversationhistory_message_type_channelanalysis'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_legacy_message_ts,
+                             migrations.RunPython.noop),
+    ]
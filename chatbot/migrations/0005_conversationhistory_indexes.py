@@ -0,0 +1,21 @@
+# Generated by Django 4.2.19 on 2026-10-17 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_conversationhistory_legacy_message_ts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['workspace', 'channel_id', '-created_at'], name='convhist_channel_recent_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversationhistory',
+            constraint=models.UniqueConstraint(fields=('workspace', 'channel_id', 'message_ts'), name='convhist_unique_message_ts'),
+        ),
+    ]
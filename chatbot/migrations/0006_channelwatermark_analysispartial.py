@@ -0,0 +1,48 @@
+# Generated by Django 4.2.19 on 2026-10-17 18:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_conversationhistory_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelWatermark',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel_id', models.CharField(max_length=32)),
+                ('last_analyzed_ts', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('workspace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatbot.slackworkspace')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnalysisPartial',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel_id', models.CharField(max_length=32)),
+                ('range_start', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('range_end', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('summary_text', models.TextField(default='')),
+                ('message_count', models.IntegerField(default=0)),
+                ('workspace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatbot.slackworkspace')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='channelwatermark',
+            constraint=models.UniqueConstraint(fields=('workspace', 'channel_id'), name='watermark_unique_channel'),
+        ),
+        migrations.AddIndex(
+            model_name='analysispartial',
+            index=models.Index(fields=['workspace', 'channel_id', 'range_end'], name='partial_channel_range_idx'),
+        ),
+    ]
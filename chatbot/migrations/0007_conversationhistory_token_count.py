@@ -0,0 +1,22 @@
+# Generated by Django 4.2.19 on 2026-10-17 18:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_channelwatermark_analysispartial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationhistory',
+            name='token_count',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['workspace', 'channel_id', 'thread_ts', '-created_at'], name='convhist_thread_recent_idx'),
+        ),
+    ]
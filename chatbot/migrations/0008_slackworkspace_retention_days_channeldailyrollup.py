@@ -0,0 +1,40 @@
+# Generated by Django 4.2.19 on 2026-10-17 18:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0007_conversationhistory_token_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slackworkspace',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ChannelDailyRollup',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel_id', models.CharField(max_length=32)),
+                ('day', models.DateField()),
+                ('message_count', models.IntegerField(default=0)),
+                ('bot_message_count', models.IntegerField(default=0)),
+                ('token_count', models.IntegerField(default=0)),
+                ('participants', models.JSONField(default=list)),
+                ('participant_count', models.IntegerField(default=0)),
+                ('workspace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatbot.slackworkspace')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='channeldailyrollup',
+            constraint=models.UniqueConstraint(fields=('workspace', 'channel_id', 'day'), name='rollup_unique_channel_day'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.19 on 2026-10-17 18:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_slackworkspace_retention_days_channeldailyrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadSummary',
+            fields=[
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel_id', models.CharField(max_length=32)),
+                ('thread_ts', models.CharField(blank=True, default='', max_length=32)),
+                ('summary_text', models.TextField(default='')),
+                ('summarized_until', models.DateTimeField(blank=True, null=True)),
+                ('message_count', models.IntegerField(default=0)),
+                ('token_count', models.IntegerField(default=0)),
+                ('workspace', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatbot.slackworkspace')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='threadsummary',
+            constraint=models.UniqueConstraint(fields=('workspace', 'channel_id', 'thread_ts'), name='summary_unique_thread'),
+        ),
+    ]
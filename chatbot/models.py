@@ -18,6 +18,9 @@ class SlackWorkspace(BaseModel):
     team_name = models.CharField(max_length=255)
     bot_user_id = models.CharField(max_length=32)
     bot_token = models.CharField(max_length=255)
+    # Days of conversation history kept in the database before it's
+    # archived, RETENTION_DAYS when unset and forever when 0
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
 
 
 class ConversationHistory(BaseModel):
@@ -30,6 +33,43 @@ class ConversationHistory(BaseModel):
     message_text = models.TextField()
     is_bot_message = models.BooleanField(default=False)
     response = models.TextField(default="")
+    # Prompt tokens of message_text plus response, counted at write time
+    token_count = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Recent history for a channel (mention context)
+            models.Index(fields=['workspace', 'channel_id', '-created_at'],
+                         name='convhist_channel_recent_idx'),
+            # Recent history for a thread (mention context in threads)
+            models.Index(fields=['workspace', 'channel_id', 'thread_ts', '-created_at'],
+                         name='convhist_thread_recent_idx'),
+        ]
+        constraints = [
+            # One row per Slack message, lets ingestion upsert on conflict
+            models.UniqueConstraint(
+                fields=['workspace', 'channel_id', 'message_ts'],
+                name='convhist_unique_message_ts'),
+        ]
+
+
+class ThreadSummary(BaseModel):
+    """Running summary of the older turns of a thread, or of a channel outside threads"""
+    workspace = models.ForeignKey(SlackWorkspace, on_delete=models.CASCADE)
+    channel_id = models.CharField(max_length=32)
+    # Empty for the channel's history as a whole
+    thread_ts = models.CharField(max_length=32, default="", blank=True)
+    summary_text = models.TextField(default="")
+    # created_at of the newest turn folded into the summary
+    summarized_until = models.DateTimeField(null=True, blank=True)
+    message_count = models.IntegerField(default=0)
+    token_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['workspace', 'channel_id', 'thread_ts'],
+                                    name='summary_unique_thread'),
+        ]
 
 
 class ChannelAnalysis(BaseModel):
@@ -39,3 +79,51 @@ class ChannelAnalysis(BaseModel):
     message_count = models.IntegerField()
     time_window_hours = models.IntegerField()
     image_url = models.URLField(null=True, blank=True)  # For storing S3 image URL
+
+
+class ChannelDailyRollup(BaseModel):
+    """Activity of a channel on one (UTC) day, kept once its messages are archived"""
+    workspace = models.ForeignKey(SlackWorkspace, on_delete=models.CASCADE)
+    channel_id = models.CharField(max_length=32)
+    day = models.DateField()
+    message_count = models.IntegerField(default=0)
+    bot_message_count = models.IntegerField(default=0)
+    token_count = models.IntegerField(default=0)
+    # Sorted user IDs of the people (not bots) who posted
+    participants = models.JSONField(default=list)
+    participant_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['workspace', 'channel_id', 'day'],
+                                    name='rollup_unique_channel_day'),
+        ]
+
+
+class ChannelWatermark(BaseModel):
+    """Slack ts up to which a channel has been analyzed"""
+    workspace = models.ForeignKey(SlackWorkspace, on_delete=models.CASCADE)
+    channel_id = models.CharField(max_length=32)
+    last_analyzed_ts = models.DecimalField(max_digits=20, decimal_places=6)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['workspace', 'channel_id'],
+                                    name='watermark_unique_channel'),
+        ]
+
+
+class AnalysisPartial(BaseModel):
+    """Cached analysis of the messages in (range_start, range_end) of a channel"""
+    workspace = models.ForeignKey(SlackWorkspace, on_delete=models.CASCADE)
+    channel_id = models.CharField(max_length=32)
+    range_start = models.DecimalField(max_digits=20, decimal_places=6)
+    range_end = models.DecimalField(max_digits=20, decimal_places=6)
+    summary_text = models.TextField(default="")
+    message_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['workspace', 'channel_id', 'range_end'],
+                         name='partial_channel_range_idx'),
+        ]
@@ -0,0 +1,194 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call would have to wait longer than allowed for a token"""
+
+    def __init__(self, message, wait=None):
+        super().__init__(message)
+        # Seconds until a token would have been available
+        self.wait = wait
+
+
+# Longest wait for a token in the current context, None for the
+# RATE_LIMIT_MAX_WAIT default. See rate_limit_wait().
+_max_wait = contextvars.ContextVar('rate_limit_max_wait', default=None)
+
+
+@contextmanager
+def rate_limit_wait(max_wait):
+    """
+    Cap the waits for a token inside the block, 0 to raise
+    RateLimitExceeded right away instead of sleeping. HTTP requests and
+    interactive tasks use it to shed or reschedule a call rather than hold
+    a worker; None restores the default.
+    """
+    token = _max_wait.set(max_wait)
+    try:
+        yield
+    finally:
+        _max_wait.reset(token)
+
+
+class LocalTokenBuckets:
+    """Token buckets kept in this process, the stand-in when Redis is unavailable"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        """Take a token, returns 0 on success or the seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            return wait
+
+
+# Refill and take a token atomically, using Redis' clock so every worker
+# agrees on time. Returns the wait in seconds as a string (Lua numbers
+# would be truncated to integers).
+TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisTokenBuckets:
+    """Token buckets shared by every gunicorn and Celery worker through Redis"""
+
+    retry_after = 30
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url,
+                                           socket_timeout=0.5,
+                                           socket_connect_timeout=0.5)
+        self.script = self.client.register_script(TAKE_TOKEN_SCRIPT)
+        self.fallback = LocalTokenBuckets()
+        self._down_until = 0
+
+    def take(self, key, rate, capacity):
+        if time.monotonic() >= self._down_until:
+            try:
+                return float(self.script(keys=[f"slackbot:ratelimit:{key}"],
+                                         args=[rate, capacity]))
+            except redis.RedisError as e:
+                logger.warning(
+                    f"Redis rate limiter unavailable, using local buckets: {e}")
+                self._down_until = time.monotonic() + self.retry_after
+        return self.fallback.take(key, rate, capacity)
+
+
+class RateLimiter:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def acquire(self, key, per_minute, burst=None, max_wait=None):
+        """
+        Wait for a token from the bucket key, refilled at per_minute.
+
+        Raises RateLimitExceeded instead of waiting past max_wait (default
+        the one of rate_limit_wait(), else RATE_LIMIT_MAX_WAIT), so callers
+        shed load rather than pile up.
+        """
+        if not settings.RATE_LIMIT_ENABLED:
+            return
+        for wait in self._waits(key, per_minute, burst, max_wait):
+            time.sleep(wait)
+
+    async def aacquire(self, key, per_minute, burst=None, max_wait=None):
+        """Like acquire, but waits without blocking the event loop"""
+        if not settings.RATE_LIMIT_ENABLED:
+            return
+        for wait in self._waits(key, per_minute, burst, max_wait):
+            await asyncio.sleep(wait)
+
+    def _waits(self, key, per_minute, burst, max_wait):
+        """Yield the waits needed until a token is taken"""
+        rate = per_minute / 60
+        capacity = burst or max(1, per_minute // 10)
+        if max_wait is None:
+            max_wait = _max_wait.get()
+        if max_wait is None:
+            max_wait = settings.RATE_LIMIT_MAX_WAIT
+        waited = 0
+        while True:
+            wait = self.buckets.take(key, rate, capacity)
+            if not wait:
+                return
+            if waited + wait > max_wait:
+                raise RateLimitExceeded(
+                    f"Rate limit for {key} would need {waited + wait:.1f}s",
+                    wait=waited + wait)
+            yield wait
+            waited += wait
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            if settings.CACHE_BACKEND == 'redis' and settings.CACHE_REDIS_URL:
+                _limiter = RateLimiter(RedisTokenBuckets(settings.CACHE_REDIS_URL))
+            else:
+                _limiter = RateLimiter(LocalTokenBuckets())
+        return _limiter
+
+
+def slack_rate_limit(team_id, method):
+    """Wait for a token of the per-workspace bucket of a Slack Web API method"""
+    per_minute = settings.SLACK_RATE_LIMITS.get(method,
+                                                settings.SLACK_DEFAULT_RATE_LIMIT)
+    get_rate_limiter().acquire(f"slack:{team_id}:{method}", per_minute)
+
+
+def groq_rate_limit():
+    """Wait for a token of the Groq budget shared by all workers"""
+    get_rate_limiter().acquire('groq', settings.GROQ_RATE_LIMIT_PER_MINUTE)
+
+
+async def aslack_rate_limit(team_id, method):
+    per_minute = settings.SLACK_RATE_LIMITS.get(method,
+                                                settings.SLACK_DEFAULT_RATE_LIMIT)
+    await get_rate_limiter().aacquire(f"slack:{team_id}:{method}", per_minute)
+
+
+async def agroq_rate_limit():
+    await get_rate_limiter().aacquire('groq', settings.GROQ_RATE_LIMIT_PER_MINUTE)
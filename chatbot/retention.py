@@ -0,0 +1,175 @@
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone as django_timezone
+
+from .models import ChannelDailyRollup, ConversationHistory
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Conversation history older than a workspace's retention horizon is moved
+# out of the database in batches of RETENTION_BATCH_SIZE rows per channel,
+# oldest first. A batch is written to a gzipped JSONL file named after its
+# first row, then its rows are added to the channel's daily rollups and
+# deleted in one transaction. A run that dies half way is resumed by the
+# next one: an unfinished batch is picked again and rewrites the same file.
+
+
+def retention_days(workspace):
+    """Days of history a workspace keeps, 0 meaning forever"""
+    if workspace.retention_days is not None:
+        return workspace.retention_days
+    return settings.RETENTION_DAYS
+
+
+def retention_cutoff(workspace, now=None):
+    """Rows created before this are archived, None if nothing is"""
+    days = retention_days(workspace)
+    if not days:
+        return None
+    return (now or django_timezone.now()) - timedelta(days=days)
+
+
+def message_day(conv):
+    """UTC day a message was posted, from its Slack ts when it has one"""
+    try:
+        posted = datetime.fromtimestamp(float(conv.message_ts), tz=timezone.utc)
+    except ValueError:
+        # Legacy mentions stored without a real ts
+        posted = conv.created_at
+    return posted.astimezone(timezone.utc).date()
+
+
+def archive_path(workspace, channel_id, first_row):
+    """
+    File of the batch starting at first_row. Only depends on that row, so a
+    retried batch lands on the file an interrupted attempt left behind.
+    """
+    created = first_row.created_at.astimezone(timezone.utc)
+    name = f"{created:%Y%m%dT%H%M%S%f}-{first_row.uuid.hex[:12]}.jsonl.gz"
+    return os.path.join(settings.RETENTION_ARCHIVE_DIR, workspace.team_id,
+                        channel_id, f"{created:%Y-%m}", name)
+
+
+def serialize_row(conv):
+    return {
+        'uuid': str(conv.uuid),
+        'channel_id': conv.channel_id,
+        'thread_ts': conv.thread_ts,
+        'message_ts': conv.message_ts,
+        'user_id': conv.user_id,
+        'message_type': conv.message_type,
+        'message_text': conv.message_text,
+        'is_bot_message': conv.is_bot_message,
+        'response': conv.response,
+        'token_count': conv.token_count,
+        'created_at': conv.created_at.isoformat(),
+        'updated_at': conv.updated_at.isoformat(),
+    }
+
+
+def write_archive(path, rows):
+    """
+    Write rows to path as gzipped JSONL. The file is written aside and
+    renamed into place, so it's either complete or absent.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.partial"
+    # mtime=0 keeps the bytes of a rewritten batch identical
+    with open(partial, 'wb') as raw, \
+            gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+        for conv in rows:
+            f.write(json.dumps(serialize_row(conv), ensure_ascii=False).encode())
+            f.write(b'\n')
+    with open(partial, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+
+def add_to_rollups(workspace, channel_id, rows):
+    """Count rows in the channel's daily rollups. Run inside a transaction."""
+    days = defaultdict(lambda: {'messages': 0, 'bot_messages': 0,
+                                'tokens': 0, 'participants': set()})
+    for conv in rows:
+        counts = days[message_day(conv)]
+        counts['messages'] += 1
+        counts['tokens'] += conv.token_count or 0
+        if conv.is_bot_message:
+            counts['bot_messages'] += 1
+        elif conv.user_id:
+            counts['participants'].add(conv.user_id)
+
+    existing = {
+        rollup.day: rollup
+        for rollup in ChannelDailyRollup.objects.select_for_update().filter(
+            workspace=workspace, channel_id=channel_id, day__in=list(days))
+    }
+    for day, counts in days.items():
+        rollup = existing.get(day) or ChannelDailyRollup(
+            workspace=workspace, channel_id=channel_id, day=day)
+        rollup.message_count += counts['messages']
+        rollup.bot_message_count += counts['bot_messages']
+        rollup.token_count += counts['tokens']
+        participants = sorted(counts['participants'].union(rollup.participants))
+        rollup.participants = participants
+        rollup.participant_count = len(participants)
+        rollup.save()
+
+
+def archive_channel(workspace, channel_id, cutoff, max_batches=None):
+    """Archive the channel's rows created before cutoff, returns how many"""
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        rows = list(ConversationHistory.objects.filter(
+            workspace=workspace,
+            channel_id=channel_id,
+            created_at__lt=cutoff).order_by('created_at', 'uuid')
+            [:settings.RETENTION_BATCH_SIZE])
+        if not rows:
+            break
+        with span('retention.batch', channel=channel_id, rows=len(rows)):
+            path = archive_path(workspace, channel_id, rows[0])
+            write_archive(path, rows)
+            with transaction.atomic():
+                add_to_rollups(workspace, channel_id, rows)
+                ConversationHistory.objects.filter(
+                    uuid__in=[conv.uuid for conv in rows]).delete()
+        archived += len(rows)
+        batches += 1
+        logger.info(f"Archived {len(rows)} messages of {workspace.team_id}/"
+                    f"{channel_id} to {path}")
+    return archived
+
+
+def archive_workspace(workspace, now=None, max_batches=None):
+    """
+    Archive the workspace's history older than its retention horizon.
+    Returns the number of rows archived per channel.
+    """
+    cutoff = retention_cutoff(workspace, now)
+    if cutoff is None:
+        return {}
+    channels = ConversationHistory.objects.filter(
+        workspace=workspace, created_at__lt=cutoff).values_list(
+            'channel_id', flat=True).distinct()
+    return {
+        channel_id: archive_channel(workspace, channel_id, cutoff, max_batches)
+        for channel_id in sorted(channels)
+    }
+
+
+def pending_archive_count(workspace, now=None):
+    """Rows of the workspace past its retention horizon"""
+    cutoff = retention_cutoff(workspace, now)
+    if cutoff is None:
+        return 0
+    return ConversationHistory.objects.filter(
+        workspace=workspace, created_at__lt=cutoff).count()
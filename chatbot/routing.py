@@ -0,0 +1,230 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import groq
+from django.conf import settings
+
+from .context import MESSAGE_OVERHEAD_TOKENS, count_tokens
+from .metrics import GROQ_FAILOVERS, GROQ_HEDGES
+
+logger = logging.getLogger(__name__)
+
+# Errors a call on another model, or another call on the same one, may not
+# hit: outages, timeouts, per-model rate limits, retired models. Bad
+# requests would fail everywhere and are raised right away.
+FAILOVER_ERRORS = (
+    groq.APIConnectionError,  # Includes APITimeoutError
+    groq.RateLimitError,
+    groq.InternalServerError,
+    groq.NotFoundError,
+)
+
+
+def messages_tokens(messages):
+    """Estimated prompt tokens of chat messages, images not counted"""
+    tokens = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            content = " ".join(part.get('text', '') for part in content
+                               if part.get('type') == 'text')
+        tokens += count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+def fits(model, prompt_tokens):
+    """Whether a prompt of prompt_tokens can go to model"""
+    window = settings.GROQ_MODEL_CONTEXT_WINDOWS.get(
+        model, settings.GROQ_DEFAULT_CONTEXT_WINDOW)
+    if prompt_tokens + settings.GROQ_MAX_COMPLETION_TOKENS > window:
+        return False
+    limit = settings.GROQ_MODEL_MAX_PROMPT_TOKENS.get(model)
+    return limit is None or prompt_tokens <= limit
+
+
+def route(task, prompt_tokens=0):
+    """
+    Models to try for a task type, in order: its GROQ_MODEL_ROUTES chain
+    without the models the prompt is too big for. The whole chain when
+    none is left, the API has the last word.
+    """
+    chain = settings.GROQ_MODEL_ROUTES.get(task) or [settings.GROQ_CHAT_MODEL]
+    return [model for model in chain if fits(model, prompt_tokens)] or list(chain)
+
+
+def primary_model(task):
+    """The model a small prompt for task goes to, used to size prompts"""
+    return route(task)[0]
+
+
+def route_deadline(task):
+    """Seconds a call for task gets on one model before failing over"""
+    return settings.GROQ_ROUTE_DEADLINES.get(task)
+
+
+class LatencyTracker:
+    """Latencies of the latest successful calls per model in this process"""
+
+    def __init__(self, size=200):
+        self._samples = defaultdict(lambda: deque(maxlen=size))
+        self._lock = threading.Lock()
+
+    def record(self, model, seconds):
+        with self._lock:
+            self._samples[model].append(seconds)
+
+    def percentile(self, model, pct, min_samples=1):
+        """Nearest-rank percentile, None with fewer than min_samples samples"""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        rank = max(1, round(pct / 100 * len(samples)))
+        return samples[min(rank, len(samples)) - 1]
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+latency_tracker = LatencyTracker()
+
+
+def hedge_delay(task, model):
+    """
+    Seconds after which a call still running gets a hedged twin, None when
+    it doesn't: hedging is off for task or there's no latency history yet
+    """
+    if not settings.GROQ_HEDGE_ENABLED or task not in settings.GROQ_HEDGE_TASKS:
+        return None
+    return latency_tracker.percentile(model, settings.GROQ_HEDGE_PERCENTILE,
+                                      settings.GROQ_HEDGE_MIN_SAMPLES)
+
+
+def note_failover(task, model, error, next_model):
+    logger.warning(f"Groq {model} failed for {task} ({type(error).__name__}: "
+                   f"{error}), falling back to {next_model}")
+    GROQ_FAILOVERS.labels(task, model).inc()
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def hedge_executor():
+    """Threads running hedged calls, recreated after a fork"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.GROQ_POOL_MAX_CONNECTIONS,
+                thread_name_prefix='groq-hedge')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _hedged(call, task, delay):
+    """
+    Run call() and, if it hasn't returned after delay seconds, a second one.
+    The first to succeed wins. The loser can't be interrupted and finishes
+    in the background.
+    """
+    pool = hedge_executor()
+    primary = pool.submit(contextvars.copy_context().run, call)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+
+    hedge = pool.submit(contextvars.copy_context().run, call)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                GROQ_HEDGES.labels(task, 'primary' if future is primary else 'hedge').inc()
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_with_routing(attempt, task, messages, timeout=None):
+    """
+    Call attempt(model, timeout, max_retries) on the models routed for
+    task until one succeeds.
+
+    Each model gets timeout (default: the task's deadline). All but the
+    last get no SDK retries and fail over right away instead. Calls slower
+    than the model's hedging percentile are hedged.
+    """
+    models = route(task, messages_tokens(messages))
+    timeout = timeout or route_deadline(task)
+    for i, model in enumerate(models):
+        last = i == len(models) - 1
+        max_retries = None if last else 0
+
+        def call(model=model, max_retries=max_retries):
+            return attempt(model, timeout, max_retries)
+
+        try:
+            delay = hedge_delay(task, model)
+            if delay is None:
+                return call()
+            return _hedged(call, task, delay)
+        except FAILOVER_ERRORS as e:
+            if last:
+                raise
+            note_failover(task, model, e, models[i + 1])
+
+
+async def _ahedged(call, task, delay):
+    """_hedged on the event loop, where the loser can be cancelled"""
+    primary = asyncio.ensure_future(call())
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+
+    hedge = asyncio.ensure_future(call())
+    pending = {primary, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    GROQ_HEDGES.labels(task, 'primary' if future is primary else 'hedge').inc()
+                    return future.result()
+                error = future.exception()
+        raise error
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def acall_with_routing(attempt, task, messages, timeout=None):
+    """call_with_routing for a coroutine function attempt"""
+    models = route(task, messages_tokens(messages))
+    timeout = timeout or route_deadline(task)
+    for i, model in enumerate(models):
+        last = i == len(models) - 1
+        max_retries = None if last else 0
+
+        def call(model=model, max_retries=max_retries):
+            return attempt(model, timeout, max_retries)
+
+        try:
+            delay = hedge_delay(task, model)
+            if delay is None:
+                return await call()
+            return await _ahedged(call, task, delay)
+        except FAILOVER_ERRORS as e:
+            if last:
+                raise
+            note_failover(task, model, e, models[i + 1])
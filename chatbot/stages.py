@@ -0,0 +1,55 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from .tracing import span
+
+_listeners = []
+_local = threading.local()
+
+
+def add_stage_listener(listener):
+    """
+    Call listener(name, started, duration) after every stage.
+
+    started is a time.time() timestamp and duration in seconds.
+    """
+    _listeners.append(listener)
+
+
+def remove_stage_listener(listener):
+    _listeners.remove(listener)
+
+
+def current_stage():
+    """Name of the innermost stage running on this thread, if any"""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def stage(name):
+    """
+    Mark a stage of a pipeline (fetch, persist, llm, ...) for listeners,
+    and trace it as a span.
+
+    With no listener registered and tracing off this costs a list check
+    and a no-op span.
+    """
+    with span(name):
+        if not _listeners:
+            yield
+            return
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(name)
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            for listener in list(_listeners):
+                listener(name, started, duration)
@@ -0,0 +1,82 @@
+import logging
+import time
+
+from django.conf import settings
+from slack_sdk.errors import SlackApiError
+
+from .clients import retry_after_seconds
+from .ratelimit import RateLimitExceeded, rate_limit_wait
+
+logger = logging.getLogger(__name__)
+
+
+def stream_reply(slack_client, groq_client, messages, channel, thread_ts=None,
+                 model=None, task='mention', placeholder_ts=None):
+    """
+    Post a placeholder (or reuse placeholder_ts) and fill it in with
+    chat.update as the reply streams.
+
+    Intermediate updates are sent at most every SLACK_STREAM_UPDATE_INTERVAL
+    seconds (chat.update is a Tier 3 method) and are skipped while Slack
+    has us rate limited or our own limiter has no token for them. The final
+    text is always written. Returns the full reply text.
+
+    A RateLimitExceeded (no Groq token) leaves the placeholder as it is and
+    carries its ts as placeholder_ts, for a retry to fill it in.
+    """
+    interval = settings.SLACK_STREAM_UPDATE_INTERVAL
+    started = time.monotonic()
+    ts = placeholder_ts or slack_client.send_message(
+        channel=channel,
+        text=settings.SLACK_STREAM_PLACEHOLDER,
+        thread_ts=thread_ts)['ts']
+
+    parts = []
+    next_update = 0
+    first_visible = None
+    try:
+        for delta in groq_client.stream_response(messages, model=model,
+                                                   task=task):
+            parts.append(delta)
+            now = time.monotonic()
+            if now < next_update:
+                continue
+            try:
+                with rate_limit_wait(0):
+                    slack_client.update_message(channel, ts, ''.join(parts) + ' ▍')
+                next_update = now + interval
+                if first_visible is None:
+                    first_visible = now - started
+            except RateLimitExceeded:
+                next_update = now + interval
+            except SlackApiError as e:
+                wait = retry_after_seconds(e)
+                if wait is None:
+                    raise
+                next_update = now + max(wait, interval)
+    except RateLimitExceeded as e:
+        e.placeholder_ts = ts
+        raise
+    except Exception:
+        with rate_limit_wait(None):
+            slack_client.update_message(
+                channel, ts, "❌ Sorry, something went wrong generating a reply.")
+        raise
+
+    # The reply is complete, wait for a token to write it if need be
+    text = ''.join(parts) or "(empty response)"
+    with rate_limit_wait(None):
+        try:
+            slack_client.update_message(channel, ts, text)
+        except SlackApiError as e:
+            wait = retry_after_seconds(e)
+            if wait is None:
+                raise
+            time.sleep(wait)
+            slack_client.update_message(channel, ts, text)
+
+    logger.info(
+        f"Streamed reply to {channel}: first visible token after "
+        f"{first_visible if first_visible is not None else 0:.2f}s, "
+        f"complete after {time.monotonic() - started:.2f}s")
+    return text
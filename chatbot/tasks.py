@@ -1,102 +1,219 @@
-from celery import shared_task
+from celery import chord, shared_task
 from django.conf import settings
-from .models import SlackWorkspace, ConversationHistory, ChannelAnalysis
-from .clients import SlackClient, GroqClient
+from .models import (ConversationHistory, ChannelAnalysis, AnalysisPartial,
+                     SlackWorkspace)
+from .analysis import (
+    now_ts,
+    slack_ts,
+    ts_before,
+    format_messages,
+    split_into_chunks,
+    get_cached_partials,
+    analyze_messages,
+    merge_partials,
+    advance_watermark,
+    prune_partials,
+)
+from .clients import GroqClient
+from .context import build_mention_context, count_tokens
+from .images import analyze_slack_images, combine_image_analyses
+from .ingestion import store_slack_messages
+from .memory import (claim_fold, fold_memory, memory_thread, needs_fold,
+                     release_fold)
+from .ratelimit import RateLimitExceeded, rate_limit_wait
+from .retention import archive_workspace
+from .routing import primary_model
+from .stages import stage
+from .streaming import stream_reply
+from .tracing import span
+from .workspaces import get_workspace, get_slack_client
 import logging
 from datetime import datetime, timedelta
-import requests
-import base64
 
 logger = logging.getLogger(__name__)
 
+
+@shared_task(bind=True)
+def process_mention(self, workspace_id, event, placeholder_ts=None):
+    """
+    Build context, get an LLM reply and post it for an app_mention event.
+
+    Out of Slack or Groq rate limit tokens, the task is retried once they
+    are available again instead of sleeping on an interactive worker. A
+    retry after the reply was saved only sends it.
+    """
+    workspace = get_workspace(uuid=workspace_id)
+    slack_client = get_slack_client(workspace)
+
+    saved = ConversationHistory.objects.filter(
+        workspace=workspace, channel_id=event['channel'],
+        message_ts=event['ts']).exclude(response="").first()
+    if saved is not None:
+        response = saved.response
+    else:
+        groq_client = GroqClient()
+        message_type = event.get('subtype', 'text')
+        # Prepare messages for Groq from as much history as fits the model
+        # small mention prompts are routed to
+        messages = build_mention_context(workspace, event, primary_model('mention'))
+
+        try:
+            with rate_limit_wait(0):
+                if settings.SLACK_STREAM_REPLIES:
+                    # Post a placeholder and update it as the completion streams in
+                    response = stream_reply(slack_client,
+                                            groq_client,
+                                            messages,
+                                            channel=event['channel'],
+                                            thread_ts=event.get('thread_ts'),
+                                            task='mention',
+                                            placeholder_ts=placeholder_ts)
+                else:
+                    response = groq_client.get_response(messages, task='mention')
+        except RateLimitExceeded as e:
+            raise retry_mention(self, e, slack_client, workspace_id, event,
+                                getattr(e, 'placeholder_ts', placeholder_ts))
+
+        # Save conversation, an analysis run may already have stored the message
+        with span('persist'):
+            ConversationHistory.objects.update_or_create(
+                workspace=workspace,
+                channel_id=event['channel'],
+                message_ts=event['ts'],
+                defaults={
+                    'thread_ts': event.get('thread_ts'),
+                    'user_id': event.get('user', ''),
+                    'message_text': event['text'],
+                    'message_type': message_type,
+                    'response': response,
+                    'token_count': count_tokens(event['text']) + count_tokens(response),
+                })
+
+    if not settings.SLACK_STREAM_REPLIES:
+        # Send response to Slack
+        try:
+            with rate_limit_wait(0):
+                slack_client.send_message(channel=event['channel'],
+                                          text=response,
+                                          thread_ts=event.get('thread_ts'))
+        except RateLimitExceeded as e:
+            raise retry_mention(self, e, slack_client, workspace_id, event,
+                                placeholder_ts)
+
+    schedule_memory_fold(workspace, event)
+
+
+def retry_mention(task, exc, slack_client, workspace_id, event, placeholder_ts):
+    """
+    Retry process_mention once exc's rate limit has a token again. Out of
+    retries, the placeholder says so if Slack has a token for that.
+    """
+    if task.request.retries >= task.max_retries and placeholder_ts:
+        try:
+            with rate_limit_wait(0):
+                slack_client.update_message(
+                    event['channel'], placeholder_ts,
+                    "❌ Sorry, I'm too busy to reply right now.")
+        except RateLimitExceeded:
+            logger.warning(f"Dropped the reply to {event['channel']}/{event['ts']} "
+                           f"without a notice, out of Slack tokens")
+    return task.retry(exc=exc, countdown=exc.wait,
+                      args=(workspace_id, event),
+                      kwargs={'placeholder_ts': placeholder_ts})
+
+
+def schedule_memory_fold(workspace, event):
+    """Queue a fold of the mention's thread memory if it has grown too long"""
+    thread_ts = memory_thread(event)
+    if (settings.MEMORY_ENABLED
+            and needs_fold(workspace, event['channel'], thread_ts)
+            and claim_fold(workspace, event['channel'], thread_ts)):
+        fold_conversation_memory.delay(str(workspace.uuid), event['channel'],
+                                       thread_ts)
+
+
+@shared_task
+def fold_conversation_memory(workspace_id, channel_id, thread_ts=""):
+    """
+    Fold the older turns of a thread into its running summary, then let
+    the next mention queue another fold
+    """
+    workspace = get_workspace(uuid=workspace_id)
+    try:
+        with span('memory.fold', channel=channel_id):
+            folded = fold_memory(GroqClient(), workspace, channel_id, thread_ts)
+    finally:
+        release_fold(workspace, channel_id, thread_ts)
+    logger.info(f"Folded {folded} turns of {channel_id}/{thread_ts or '-'} into memory")
+    return folded
+
+
 @shared_task
 def analyze_channel_sentiment(workspace_id, channel_id, hours=1):
     try:
         # Get workspace
-        workspace = SlackWorkspace.objects.get(uuid=workspace_id)
+        workspace = get_workspace(uuid=workspace_id)
         
         # Initialize clients
-        slack_client = SlackClient(workspace.bot_token)
+        slack_client = get_slack_client(workspace)
         groq_client = GroqClient()
         
-        # Get conversation history
-        messages = slack_client.get_conversation_history(
-            channel=channel_id, 
-            limit=100,
-            hours_ago=hours
-        )
-        
-        # Store messages in database
-        stored_messages = []
-        for msg in messages:
-            if msg.get('text'):  # Only store messages with text
-                # Check for bot messages in multiple ways
-                is_bot = (
-                    bool(msg.get('bot_id')) or  # Has bot_id
-                    msg.get('subtype') == 'bot_message' or  # Explicit bot message
-                    bool(msg.get('app_id'))  # Message from an app
-                )
-                
-                conv, created = ConversationHistory.objects.get_or_create(
-                    workspace=workspace,
-                    channel_id=channel_id,
-                    message_ts=msg['ts'],
-                    defaults={
-                        'user_id': msg.get('user', ''),
-                        'message_text': msg.get('text', ''),
-                        'thread_ts': msg.get('thread_ts'),
-                        'message_type': msg.get('type', 'text'),
-                        'is_bot_message': is_bot
-                    }
-                )
-                stored_messages.append(conv)
-
-        # Handle images if present
-        image_url = None
-        for msg in reversed(messages):  # Look for most recent image
-            if msg.get('files'):
-                for file in msg['files']:
-                    if file['filetype'] in ['png', 'jpg', 'jpeg']:
-                        try:
-                            # Get file info from Slack to get direct download URL
-                            file_info = slack_client.get_file_info(file['id'])
-                            direct_url = file_info.get('url_private_download', file_info.get('url_private'))
-                            # Download the image using the bot token for authentication
-                            response = requests.get(
-                                direct_url,
-                                headers={'Authorization': f"Bearer {workspace.bot_token}"},
-                                allow_redirects=True  # Follow redirects
-                            )
-                            
-                            print(f"Downloading from URL: {direct_url}")
-                            print(f"Response status: {response.status_code}")
-                            print(f"Response headers: {response.headers}")
-                            
-                            if response.status_code == 200:
-                                mime_type = file['mimetype']
-                                base64_image = base64.b64encode(response.content).decode('utf-8')
-                                image_url = f"data:{mime_type};base64,{base64_image}"
-                                print(f"Image MIME type: {mime_type}")
-                                break
-                        except Exception as e:
-                            logger.error(f"Error downloading image: {e}")
-                            continue
-                if image_url:
-                    break
-
-        # Format messages for analysis, excluding bot messages
-        formatted_messages = "\n".join([
-            f"User {msg.user_id}: {msg.message_text}"
-            for msg in stored_messages
-            if not msg.is_bot_message  # Exclude bot messages
-        ])
+        # Reuse cached partial analyses for the part of the window that was
+        # already analyzed, and only fetch what lies outside of them
+        latest = now_ts()
+        window_start = latest - hours * 3600
+        cached_partials = get_cached_partials(workspace, channel_id, window_start)
+        if cached_partials:
+            ranges = [(cached_partials[-1].range_end, latest)]
+            if cached_partials[0].range_start > window_start:
+                ranges.insert(0, (window_start, cached_partials[0].range_start))
+        else:
+            ranges = [(window_start, latest)]
 
-        # Add a check to ensure we have messages to analyze
-        if not formatted_messages.strip():
-            slack_client.send_message(
+        # Get conversation history page by page, storing each page as it
+        # arrives and only keeping the messages that carry files
+        new_ranges = []
+        messages_with_files = []
+        for range_start, range_end in ranges:
+            stored_messages = []
+            oldest_fetched = None
+            truncated = False
+            pages = slack_client.iter_conversation_history(
                 channel=channel_id,
-                text=f"⚠️ No user messages found in the last {hours} hour{'s' if hours > 1 else ''} to analyze."
-            )
+                oldest=str(range_start),
+                latest=str(range_end))
+            while True:
+                with stage('fetch'):
+                    try:
+                        page = next(pages)
+                    except StopIteration as stop:
+                        truncated = bool(stop.value)
+                        break
+                with stage('persist'):
+                    stored_messages.extend(
+                        store_slack_messages(workspace, channel_id, page))
+                # Pages go from the newest messages to the oldest
+                oldest_fetched = slack_ts(page[-1]['ts'])
+                messages_with_files.extend(msg for msg in page if msg.get('files'))
+            if truncated:
+                # The history ceiling dropped the oldest messages of the
+                # slice. Only the part fetched is analyzed and cached, the
+                # next run fetches the rest.
+                if oldest_fetched is None:
+                    continue
+                range_start = ts_before(oldest_fetched)
+            new_ranges.append((range_start, range_end, stored_messages))
+
+        # Add a check to ensure we have messages to analyze
+        with stage('prompt'):
+            has_new_messages = any(format_messages(stored).strip()
+                                   for _, _, stored in new_ranges)
+        if not has_new_messages and not any(p.summary_text for p in cached_partials):
+            with stage('post'):
+                slack_client.send_message(
+                    channel=channel_id,
+                    text=f"⚠️ No user messages found in the last {hours} hour{'s' if hours > 1 else ''} to analyze."
+                )
             return {
                 "channel_id": channel_id,
                 "workspace_id": workspace_id,
@@ -106,75 +223,75 @@ def analyze_channel_sentiment(workspace_id, channel_id, hours=1):
 
         # Initialize analysis components
         image_analysis = ""
-        text_analysis = ""
-        
-        # Handle image analysis if present
-        if image_url:
-            # Use vision model for image analysis
-            vision_prompt = [{
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Analyze this image in the context of a Slack conversation that is expressing the sentiment of a given product. What do you see? Keep it concise and under 350 words"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": image_url
-                        }
-                    }
-                ]
-            }]
-            print(f"Vision prompt: {vision_prompt}")
-            image_analysis = groq_client.get_vision_response(vision_prompt)
-            print(f"Image analysis: {image_analysis}")
-
-        text_prompt = [{
-            "role": "system",
-            "content": "You are an expert at analyzing conversation sentiment. Analyze all messages in the following Slack conversation with equla importance and provide: \n1. Overall sentiment (positive/negative/neutral)\n2. Key themes or topics\n3. Any notable patterns in interaction\n4. Level of engagement\nBe concise but thorough."
-        }]
-
-        # If we have image analysis, include it in the context
-        if image_analysis:
-            text_prompt.append({
-                "role": "user",
-                "content": f"An image was shared in this conversation. Here's what was observed in the image:\n\n{image_analysis}\n\nNow, analyze the following conversation in this context:\n\n{formatted_messages}"
-            })
-        else:
-            text_prompt.append({
-                "role": "user",
-                "content": f"Here's the conversation to analyze:\n\n{formatted_messages}"
-            })
 
-        print(f"Text prompt: {text_prompt}")
-        text_analysis = groq_client.get_response(text_prompt)
+        # Handle images if present, all of them at once
+        if has_new_messages:
+            with stage('images'):
+                image_analysis = combine_image_analyses(analyze_slack_images(
+                    slack_client, groq_client, messages_with_files,
+                    workspace.bot_token))
 
-        # Combine analyses
-        final_analysis = text_analysis
-        if image_analysis:
-            final_analysis = f"📸 *Image Analysis*:\n{image_analysis}\n\n📊 *Conversation Analysis*:\n{text_analysis}"
+        # Split the new slices into token-bounded chunks. Empty chunks are
+        # cached right away so the next run doesn't fetch them again.
+        partials = list(cached_partials)
+        chunks = []
+        empty_chunks = []
+        with stage('prompt'):
+            for range_start, range_end, stored_messages in new_ranges:
+                for chunk_start, chunk_end, chunk_messages in split_into_chunks(
+                        range_start, range_end, stored_messages,
+                        settings.ANALYSIS_CHUNK_TOKENS):
+                    formatted_messages = format_messages(chunk_messages)
+                    if formatted_messages.strip():
+                        chunks.append((chunk_start, chunk_end, formatted_messages,
+                                       len(chunk_messages)))
+                    else:
+                        empty_chunks.append((chunk_start, chunk_end,
+                                             len(chunk_messages)))
+        with stage('persist'):
+            for chunk_start, chunk_end, message_count in empty_chunks:
+                partials.append(AnalysisPartial.objects.create(
+                    workspace=workspace,
+                    channel_id=channel_id,
+                    range_start=chunk_start,
+                    range_end=chunk_end,
+                    message_count=message_count))
 
-        # Store analysis
-        channel_analysis = ChannelAnalysis.objects.create(
-            workspace=workspace,
-            channel_id=channel_id,
-            analysis_text=final_analysis,
-            message_count=len(stored_messages),
-            time_window_hours=hours
-        )
+        if len(chunks) <= 1:
+            # Small enough for a single call, no need to fan out
+            for chunk_start, chunk_end, formatted_messages, message_count in chunks:
+                with stage('llm'):
+                    summary_text = analyze_messages(groq_client, formatted_messages,
+                                                    image_analysis)
+                with stage('persist'):
+                    partials.append(AnalysisPartial.objects.create(
+                        workspace=workspace,
+                        channel_id=channel_id,
+                        range_start=chunk_start,
+                        range_end=chunk_end,
+                        summary_text=summary_text,
+                        message_count=message_count))
+            return finish_channel_analysis(workspace, channel_id, hours, latest,
+                                           partials, image_analysis,
+                                           groq_client, slack_client)
 
-        # Send analysis to Slack
-        slack_client.send_message(
-            channel=channel_id,
-            text=f"*Channel Analysis (Last {hours} hour{'s' if hours > 1 else ''})* 📊\n\n{final_analysis}"
-        )
+        # Map: summarize the chunks in parallel on the workers.
+        # Reduce: merge them with the cached partials once all are done.
+        callback = reduce_channel_analysis.s(
+            workspace_id, channel_id, hours, str(latest), image_analysis,
+            [str(partial.uuid) for partial in partials])
+        result = chord(
+            summarize_chunk.s(workspace_id, channel_id, str(chunk_start),
+                              str(chunk_end), formatted_messages,
+                              message_count, image_analysis)
+            for chunk_start, chunk_end, formatted_messages, message_count in chunks
+        )(callback.on_error(notify_analysis_failed.s(workspace_id, channel_id)))
 
         return {
             "channel_id": channel_id,
             "workspace_id": workspace_id,
-            "analysis": final_analysis,
-            "message_count": len(stored_messages)
+            "analysis": f"Analyzing {len(chunks)} chunks in parallel",
+            "reduce_task_id": result.id
         }
         
     except Exception as e:
@@ -187,4 +304,133 @@ def analyze_channel_sentiment(workspace_id, channel_id, hours=1):
             )
         except:
             pass
-        raise 
\ No newline at end of file
+        raise 
+
+
+def finish_channel_analysis(workspace, channel_id, hours, latest, partials,
+                            image_analysis, groq_client, slack_client):
+    """Merge partials into the final ChannelAnalysis and post it to Slack"""
+    partials = sorted(partials, key=lambda p: p.range_start)
+    with stage('persist'):
+        advance_watermark(workspace, channel_id, latest)
+        prune_partials(workspace, channel_id)
+
+    with stage('llm'):
+        text_analysis = merge_partials(groq_client, partials)
+    message_count = sum(p.message_count for p in partials)
+
+    # Combine analyses
+    final_analysis = text_analysis
+    if image_analysis:
+        final_analysis = f"📸 *Image Analysis*:\n{image_analysis}\n\n📊 *Conversation Analysis*:\n{text_analysis}"
+
+    # Store analysis
+    with stage('persist'):
+        ChannelAnalysis.objects.create(
+            workspace=workspace,
+            channel_id=channel_id,
+            analysis_text=final_analysis,
+            message_count=message_count,
+            time_window_hours=hours
+        )
+
+    # Send analysis to Slack
+    with stage('post'):
+        slack_client.send_message(
+            channel=channel_id,
+            text=f"*Channel Analysis (Last {hours} hour{'s' if hours > 1 else ''})* 📊\n\n{final_analysis}"
+        )
+
+    return {
+        "channel_id": channel_id,
+        "workspace_id": str(workspace.uuid),
+        "analysis": final_analysis,
+        "message_count": message_count
+    }
+
+
+@shared_task
+def summarize_chunk(workspace_id, channel_id, range_start, range_end,
+                    formatted_messages, message_count, image_analysis=""):
+    """Map step of a channel analysis: analyze one chunk and cache it"""
+    workspace = get_workspace(uuid=workspace_id)
+    with stage('llm'):
+        summary_text = analyze_messages(GroqClient(), formatted_messages,
+                                        image_analysis)
+    with stage('persist'):
+        partial = AnalysisPartial.objects.create(
+            workspace=workspace,
+            channel_id=channel_id,
+            range_start=slack_ts(range_start),
+            range_end=slack_ts(range_end),
+            summary_text=summary_text,
+            message_count=message_count)
+    return str(partial.uuid)
+
+
+@shared_task
+def reduce_channel_analysis(partial_ids, workspace_id, channel_id, hours,
+                            latest, image_analysis="", cached_partial_ids=()):
+    """Reduce step of a channel analysis: merge the chunks and post the result"""
+    slack_client = None
+    try:
+        workspace = get_workspace(uuid=workspace_id)
+        slack_client = get_slack_client(workspace)
+        partials = AnalysisPartial.objects.filter(
+            uuid__in=list(partial_ids) + list(cached_partial_ids))
+        return finish_channel_analysis(workspace, channel_id, hours,
+                                       slack_ts(latest), list(partials),
+                                       image_analysis, GroqClient(),
+                                       slack_client)
+    except Exception as e:
+        logger.error(f"Error merging sentiment analysis: {e}")
+        if slack_client:
+            slack_client.send_message(
+                channel=channel_id,
+                text=f"❌ Error performing sentiment analysis: {str(e)}")
+        raise
+
+
+@shared_task
+def notify_analysis_failed(request, exc, traceback, workspace_id, channel_id,
+                           attempt=0):
+    """
+    Error callback for the chunk chord of a channel analysis.
+
+    Celery only passes (request, exc, traceback) to error callbacks that
+    aren't bound tasks. Out of Slack rate limit tokens, the notice is sent
+    again by a new task once they are available, at most max_retries times.
+    """
+    if not attempt:
+        logger.error(f"Error in sentiment analysis chunk: {exc}")
+    workspace = get_workspace(uuid=workspace_id)
+    try:
+        with rate_limit_wait(0):
+            get_slack_client(workspace).send_message(
+                channel=channel_id,
+                text=f"❌ Error performing sentiment analysis: {str(exc)}")
+    except RateLimitExceeded as e:
+        if attempt >= notify_analysis_failed.max_retries:
+            raise
+        # The failed task's request and traceback don't serialize
+        notify_analysis_failed.apply_async(
+            (None, str(exc), None, workspace_id, channel_id),
+            {'attempt': attempt + 1}, countdown=e.wait)
+
+
+@shared_task
+def archive_conversation_history(team_id=None, max_batches=None):
+    """
+    Archive conversation history past each workspace's retention horizon
+    (see chatbot.retention). Runs daily from Celery beat; a run cut short by
+    its time limit is picked up where it stopped by the next one.
+    """
+    workspaces = SlackWorkspace.objects.order_by('team_id')
+    if team_id:
+        workspaces = workspaces.filter(team_id=team_id)
+    archived = 0
+    for workspace in workspaces.iterator():
+        archived += sum(archive_workspace(workspace,
+                                          max_batches=max_batches).values())
+    logger.info(f"Archived {archived} conversation history rows")
+    return archived
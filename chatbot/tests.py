@@ -1,3 +1,1494 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import groq
+import redis
+from celery.app.task import Context
+from django.conf import settings
+from django.core.management import call_command
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from prometheus_client.values import MultiProcessValue
+from rest_framework.response import Response
+from slack_sdk.errors import SlackApiError
+
+from benchmarks.fakes import (FakeFileServer, FakeGroqClient, FakeGroqServer,
+                              FakeSlackClient, offline_celery,
+                              synthetic_channel_messages)
+from SlackChatbot.celery import (BATCH_QUEUE, INTERACTIVE_QUEUE, TASK_ROUTES,
+                                 app as celery_app)
+
+from .analysis import (ANALYSIS_SYSTEM_PROMPT, merge_summaries, slack_ts,
+                       split_into_chunks, ts_before)
+from .async_views import drain_mentions, handle_mention, lifespan, process_event
+from .cache import LocalCache, RedisCache, get_cache
+from .clients import (CacheStats, GroqClient, get_async_groq_client,
+                      get_groq_client, response_cache_key)
+from .context import build_mention_context, context_token_budget
+from .dedup import EventDeduplicator
+from .images import (analyze_slack_image, analyze_slack_images,
+                     combine_image_analyses, prepare_image)
+from .ingestion import store_slack_messages
+from .memory import fold_memory, needs_fold
+from .metrics import ContainersCollector
+from .middleware import verify_slack_request
+from .models import (AnalysisPartial, ChannelDailyRollup, ChannelWatermark,
+                     ConversationHistory, SlackWorkspace, ThreadSummary)
+from .ratelimit import RateLimitExceeded
+from .retention import archive_workspace
+from .routing import route
+from .stages import (add_stage_listener, current_stage, remove_stage_listener,
+                     stage)
+from .streaming import stream_reply
+from .tasks import (analyze_channel_sentiment, fold_conversation_memory,
+                    notify_analysis_failed, process_mention,
+                    schedule_memory_fold)
+from .tracing import finish_task_span, span, start_task_span
+from .views import SlackEventsView
+from .workspaces import WorkspaceCache, workspace_cache
+
+
+class EventDeduplicatorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.deduplicator = EventDeduplicator(store=LocalCache(), ttl=60)
+
+    def test_event_is_claimed_once(self):
+        self.assertTrue(self.deduplicator.claim('Ev1'))
+        self.assertFalse(self.deduplicator.claim('Ev1'))
+        self.assertTrue(self.deduplicator.claim('Ev2'))
+
+    def test_released_event_can_be_claimed_again(self):
+        self.assertTrue(self.deduplicator.claim('Ev1'))
+        self.deduplicator.release('Ev1')
+        self.assertTrue(self.deduplicator.claim('Ev1'))
+
+    def test_events_without_id_are_always_processed(self):
+        self.assertTrue(self.deduplicator.claim(None))
+        self.assertTrue(self.deduplicator.claim(None))
+
+
+def rate_limited_error(retry_after):
+    response = SimpleNamespace(status_code=429, headers={'Retry-After': str(retry_after)},
+                               data={'ok': False, 'error': 'ratelimited'})
+    return SlackApiError("ratelimited", response)
+
+
+@override_settings(RATE_LIMIT_ENABLED=False, SLACK_MAX_RATE_LIMIT_RETRIES=2)
+class HistoryPaginationTests(SimpleTestCase):
+
+    def setUp(self):
+        self.messages = synthetic_channel_messages(500, hours=1, seed=1)
+        self.slack_client = FakeSlackClient(self.messages)
+
+    def history(self, **kwargs):
+        return list(self.slack_client.iter_conversation_history(
+            'C1', oldest='0', **kwargs))
+
+    def test_follows_cursors_through_the_whole_window(self):
+        pages = self.history(page_size=100, max_messages=10000, max_bytes=2 ** 30)
+        self.assertEqual(sum(len(page) for page in pages), 500)
+        self.assertTrue(all(len(page) <= 100 for page in pages))
+        self.assertEqual(self.slack_client.client.calls['conversations.history'], 5)
+
+    def test_stops_at_max_messages(self):
+        pages = self.history(page_size=100, max_messages=250, max_bytes=2 ** 30)
+        self.assertEqual(sum(len(page) for page in pages), 250)
+        self.assertEqual(self.slack_client.client.calls['conversations.history'], 3)
+
+    def test_stops_at_max_bytes(self):
+        max_bytes = 2000
+        pages = self.history(page_size=100, max_messages=10000, max_bytes=max_bytes)
+        size = sum(len(msg['text'].encode()) for page in pages for msg in page)
+        self.assertLessEqual(size, max_bytes)
+        self.assertLess(sum(len(page) for page in pages), 500)
+
+    def test_waits_out_retry_after(self):
+        fetch = self.slack_client.client.conversations_history
+        errors = [rate_limited_error(3)]
+
+        def flaky(**kwargs):
+            if errors:
+                raise errors.pop()
+            return fetch(**kwargs)
+
+        self.slack_client.client.conversations_history = flaky
+        with mock.patch('chatbot.clients.time.sleep') as sleep:
+            pages = self.history(page_size=100, max_messages=150, max_bytes=2 ** 30)
+        sleep.assert_called_once_with(3.0)
+        self.assertEqual(sum(len(page) for page in pages), 150)
+
+    def test_gives_up_after_max_rate_limit_retries(self):
+        def limited(**kwargs):
+            raise rate_limited_error(1)
+
+        self.slack_client.client.conversations_history = limited
+        with mock.patch('chatbot.clients.time.sleep') as sleep, \
+                self.assertRaises(SlackApiError):
+            self.history()
+        self.assertEqual(sleep.call_count, 2)
+
+
+@override_settings(CACHE_BACKEND='local',
+                   RATE_LIMIT_ENABLED=False,
+                   GROQ_RESPONSE_CACHE_ENABLED=False,
+                   ANALYSIS_CHUNK_TOKENS=2000)
+class IncrementalAnalysisTests(TestCase):
+
+    def setUp(self):
+        workspace_cache.clear()
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TANALYSIS', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        # Two hours of history in a three hour window, so the window moving
+        # between runs doesn't reach a message. SQLite stores decimals as
+        # floats and reads 15 digits back, timestamps are whole seconds
+        # early enough to stay exact.
+        self.now = 10 ** 8
+        offset = self.now - time.time()
+        self.messages = [
+            dict(msg, ts=f"{round(float(msg['ts']) + offset)}.000000")
+            for msg in synthetic_channel_messages(200, hours=2, thread_ratio=0,
+                                                  image_ratio=0, seed=2)
+        ]
+        self.groq_client = FakeGroqClient()
+
+    def analyze(self, at):
+        """
+        Run an analysis at `at` seconds from now, returns the prompts of its
+        per-chunk Groq calls
+        """
+        slack_client = FakeSlackClient(self.messages)
+        with offline_celery(eager=True), \
+                mock.patch('chatbot.tasks.now_ts',
+                           return_value=slack_ts(self.now + at)), \
+                mock.patch('chatbot.analysis.now_ts',
+                           return_value=slack_ts(self.now + at)), \
+                mock.patch('chatbot.tasks.get_slack_client',
+                           return_value=slack_client), \
+                mock.patch('chatbot.tasks.GroqClient',
+                           return_value=self.groq_client), \
+                mock.patch.object(self.groq_client, 'get_response',
+                                  wraps=self.groq_client.get_response) as get_response:
+            analyze_channel_sentiment(str(self.workspace.uuid), 'C1', hours=3)
+        return [call.args[0][1]['content'] for call in get_response.call_args_list
+                if call.args[0][0]['content'] == ANALYSIS_SYSTEM_PROMPT]
+
+    def partials(self):
+        """Summarized partials, oldest first"""
+        return list(AnalysisPartial.objects.filter(
+            workspace=self.workspace, channel_id='C1').exclude(
+                summary_text='').order_by('range_start', 'created_at'))
+
+    def test_second_run_reuses_the_cached_partials(self):
+        first_prompts = self.analyze(at=0)
+        first = self.partials()
+        self.assertGreater(len(first_prompts), 2)
+        self.assertEqual(len(first), len(first_prompts))
+
+        # The window moved on, only its oldest slice is fetched and
+        # analyzed again. Everything after it comes from the cache.
+        prompts = self.analyze(at=60)
+        self.assertEqual(len(prompts), 1)
+        self.assertEqual(prompts[0], first_prompts[0])
+        reused = {partial.uuid for partial in first[1:]}
+        self.assertLessEqual(reused, {partial.uuid for partial in self.partials()})
+
+    def test_only_new_messages_are_analyzed(self):
+        self.analyze(at=0)
+        watermark = ChannelWatermark.objects.get(workspace=self.workspace,
+                                                 channel_id='C1').last_analyzed_ts
+        self.messages.append({'type': 'message', 'user': 'UNEW',
+                              'text': 'a brand new message',
+                              'ts': f"{self.now + 30}.000000"})
+
+        prompts = [prompt for prompt in self.analyze(at=60)
+                   if 'a brand new message' in prompt]
+        self.assertEqual(len(prompts), 1)
+        self.assertEqual(prompts[0].count('User '), 1)
+        new_partial = self.partials()[-1]
+        self.assertEqual(new_partial.range_start, watermark)
+        self.assertEqual(new_partial.message_count, 1)
+
+    def test_messages_past_the_history_ceiling_are_analyzed_next_time(self):
+        with override_settings(SLACK_HISTORY_MAX_MESSAGES=150):
+            self.analyze(at=0)
+        first = self.partials()
+        # Slack pages newest first, the 50 oldest messages weren't fetched
+        self.assertEqual(sum(partial.message_count for partial in first), 150)
+        self.assertEqual(first[0].range_start,
+                         ts_before(self.messages[149]['ts']))
+
+        oldest = next(msg for msg in reversed(self.messages) if 'user' in msg)
+        prompts = self.analyze(at=60)
+        self.assertTrue(any(oldest['text'] in prompt for prompt in prompts))
+        self.assertEqual(sum(partial.message_count for partial in self.partials()),
+                         200)
+
+
+@override_settings(ANALYSIS_CHUNK_TOKENS=100)
+class MapReduceAnalysisTests(SimpleTestCase):
+
+    def setUp(self):
+        self.groq_client = mock.Mock()
+        self.groq_client.get_response.return_value = "merged"
+
+    def message(self, ts, tokens, bot=False):
+        # "User U1: " counts 3 tokens
+        return SimpleNamespace(message_ts=ts, user_id='U1', is_bot_message=bot,
+                               message_text='x' * 4 * (tokens - 3))
+
+    def test_chunks_are_contiguous_and_token_bounded(self):
+        messages = [self.message(f"{ts}.000000", 40) for ts in range(10, 0, -1)]
+        messages.append(self.message('5.500000', 500, bot=True))
+        chunks = split_into_chunks(slack_ts(0), slack_ts(20), messages, 100)
+        self.assertEqual([(start, end) for start, end, _ in chunks],
+                         [(slack_ts(0), slack_ts(2)), (slack_ts(2), slack_ts(4)),
+                          (slack_ts(4), slack_ts(6)), (slack_ts(6), slack_ts(8)),
+                          (slack_ts(8), slack_ts(20))])
+        # Oldest first, bot messages don't count towards the budget
+        self.assertEqual([msg.message_ts for msg in chunks[2][2]],
+                         ['5.000000', '5.500000', '6.000000'])
+
+    def test_single_summary_needs_no_merge(self):
+        self.assertEqual(merge_summaries(self.groq_client, [(10, "only")]), "only")
+        self.groq_client.get_response.assert_not_called()
+
+    def test_summaries_that_fit_are_merged_at_once(self):
+        self.assertEqual(merge_summaries(self.groq_client, [(10, "a"), (20, "b")]),
+                         "merged")
+        prompt = self.groq_client.get_response.call_args.args[0][1]['content']
+        self.assertIn("Slice 1 (10 messages):\na", prompt)
+        self.assertIn("Slice 2 (20 messages):\nb", prompt)
+
+    def test_summaries_over_the_budget_are_merged_in_batches(self):
+        summaries = [(10, 'x' * 160) for _ in range(5)]
+        self.assertEqual(merge_summaries(self.groq_client, summaries), "merged")
+        # Two batches of two and a lone summary, then the three results
+        self.assertEqual(self.groq_client.get_response.call_count, 3)
+        prompt = self.groq_client.get_response.call_args.args[0][1]['content']
+        self.assertIn("Slice 2 (20 messages):\nmerged", prompt)
+        self.assertIn("Slice 3 (10 messages):\n" + 'x' * 160, prompt)
+
+
+@override_settings(INGESTION_BATCH_SIZE=40)
+class MessageIngestionTests(TestCase):
+
+    def setUp(self):
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TINGEST', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        self.messages = synthetic_channel_messages(100, hours=1, seed=3)
+
+    def test_storing_twice_keeps_one_row_per_message(self):
+        first = store_slack_messages(self.workspace, 'C1', self.messages)
+        second = store_slack_messages(self.workspace, 'C1', self.messages[:60])
+        self.assertEqual(ConversationHistory.objects.count(), 100)
+        self.assertEqual([row.pk for row in second], [row.pk for row in first[:60]])
+
+    def test_rows_come_back_in_message_order(self):
+        self.messages.insert(10, {'type': 'message', 'subtype': 'channel_join',
+                                  'ts': '1.000000', 'text': ''})
+        rows = store_slack_messages(self.workspace, 'C1', self.messages)
+        self.assertEqual([row.message_ts for row in rows],
+                         [msg['ts'] for msg in self.messages if msg['text']])
+        bots = [row.is_bot_message for row in rows]
+        self.assertEqual(bots, [bool(msg.get('bot_id')) for msg in self.messages
+                                if msg['text']])
+
+    def test_same_ts_in_another_channel_is_a_new_message(self):
+        store_slack_messages(self.workspace, 'C1', self.messages[:5])
+        rows = store_slack_messages(self.workspace, 'C2', self.messages[:5])
+        self.assertEqual({row.channel_id for row in rows}, {'C2'})
+        self.assertEqual(ConversationHistory.objects.count(), 10)
+
+    def test_bulk_queries(self):
+        # One insert and one lookup per batch of 40
+        with self.assertNumQueries(6):
+            store_slack_messages(self.workspace, 'C1', self.messages)
+
+
+SIGNING_SECRET = 'test-signing-secret'
+
+
+def sign(body, timestamp, secret=SIGNING_SECRET):
+    base = b"v0:" + timestamp.encode() + b":" + body
+    return f"v0={hmac.new(secret.encode(), base, hashlib.sha256).hexdigest()}"
+
+
+@override_settings(SLACK_SIGNING_SECRET=SIGNING_SECRET)
+class SlackSignatureTests(SimpleTestCase):
+
+    def setUp(self):
+        self.timestamp = str(int(time.time()))
+
+    def test_valid_signature(self):
+        body = b'{"type": "event_callback"}'
+        self.assertIsNone(verify_slack_request(body, self.timestamp,
+                                               sign(body, self.timestamp)))
+
+    def test_wrong_signature_is_rejected(self):
+        body = b'{"type": "event_callback"}'
+        self.assertEqual(
+            verify_slack_request(body, self.timestamp,
+                                 sign(body, self.timestamp, secret='other')),
+            "Invalid signature")
+
+    def test_tampered_body_is_rejected(self):
+        signature = sign(b'{"text": "hi"}', self.timestamp)
+        self.assertEqual(verify_slack_request(b'{"text": "bye"}', self.timestamp,
+                                              signature), "Invalid signature")
+
+    def test_stale_timestamp_is_rejected(self):
+        body = b'{}'
+        stale = str(int(time.time()) - 3600)
+        self.assertEqual(verify_slack_request(body, stale, sign(body, stale)),
+                         "Stale request")
+
+    def test_missing_headers_are_rejected(self):
+        self.assertEqual(verify_slack_request(b'{}', None, None),
+                         "Missing signature headers")
+        self.assertEqual(verify_slack_request(b'{}', 'soon', 'v0=abc'),
+                         "Invalid timestamp")
+
+    def test_body_is_verified_as_raw_bytes(self):
+        body = b'\xff\xfe not utf-8'
+        self.assertIsNone(verify_slack_request(body, self.timestamp,
+                                               sign(body, self.timestamp)))
+        self.assertEqual(verify_slack_request(body, self.timestamp, 'v0=abc'),
+                         "Invalid signature")
+
+    def test_non_ascii_signature_is_rejected(self):
+        self.assertEqual(verify_slack_request(b'{}', self.timestamp, 'v0=é'),
+                         "Invalid signature")
+
+
+@override_settings(SLACK_SIGNING_SECRET=SIGNING_SECRET,
+                   SLACK_VERIFY_SIGNATURES=True,
+                   CACHE_BACKEND='local',
+                   RATE_LIMIT_ENABLED=False)
+class SlackEventsEndpointTests(TestCase):
+
+    def setUp(self):
+        workspace_cache.clear()
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TTEST', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        self.client = Client()
+
+    def post(self, payload, signature=None):
+        body = json.dumps(payload).encode()
+        timestamp = str(int(time.time()))
+        return self.client.post(
+            '/api/slack/events/', body, content_type='application/json',
+            HTTP_X_SLACK_REQUEST_TIMESTAMP=timestamp,
+            HTTP_X_SLACK_SIGNATURE=signature or sign(body, timestamp))
+
+    def event(self, event_id, team_id='TTEST'):
+        return {'type': 'event_callback', 'event_id': event_id,
+                'team_id': team_id,
+                'event': {'type': 'message', 'channel': 'C1', 'ts': '1.0'}}
+
+    def test_bad_signature_gets_401(self):
+        response = self.post(self.event('EvSig'), signature='v0=abc')
+        self.assertEqual(response.status_code, 401)
+
+    def test_url_verification_is_answered(self):
+        response = self.post({'type': 'url_verification', 'challenge': 'c123'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'challenge': 'c123'})
+
+    def test_retried_event_is_processed_once(self):
+        with mock.patch.object(SlackEventsView, 'process_event',
+                               return_value=Response({'ok': True})) as process:
+            self.assertEqual(self.post(self.event('EvDup')).status_code, 200)
+            self.assertEqual(self.post(self.event('EvDup')).status_code, 200)
+        self.assertEqual(process.call_count, 1)
+
+    def test_failed_event_is_released_for_retries(self):
+        with mock.patch.object(SlackEventsView, 'process_event',
+                               side_effect=RuntimeError("boom")) as process:
+            self.assertEqual(self.post(self.event('EvFail')).status_code, 500)
+            self.assertEqual(self.post(self.event('EvFail')).status_code, 500)
+        self.assertEqual(process.call_count, 2)
+
+    def mention(self, event_id):
+        return dict(self.event(event_id),
+                    event={'type': 'app_mention', 'channel': 'C1', 'user': 'U1',
+                           'text': '<@UBOT> hi', 'ts': '1.0'})
+
+    def test_mention_is_acked_and_replied_to_from_celery(self):
+        payload = self.mention('EvMention')
+        with mock.patch('chatbot.views.process_mention') as process_mention:
+            response = self.post(payload)
+        self.assertEqual(response.status_code, 200)
+        process_mention.delay.assert_called_once_with(
+            workspace_id=str(self.workspace.uuid), event=payload['event'])
+        process_mention.assert_not_called()
+
+    @override_settings(SLACK_ASYNC_MENTIONS=False)
+    def test_mention_is_replied_to_inline_without_async_mentions(self):
+        payload = self.mention('EvInline')
+        with mock.patch('chatbot.views.process_mention') as process_mention:
+            response = self.post(payload)
+        self.assertEqual(response.status_code, 200)
+        process_mention.assert_called_once_with(str(self.workspace.uuid),
+                                                payload['event'])
+        process_mention.delay.assert_not_called()
+
+    def test_unknown_workspace_gets_404(self):
+        response = self.post(self.event('EvUnknown', team_id='TNOPE'))
+        self.assertEqual(response.status_code, 404)
+        # Still claimed, Slack's retries are dropped
+        self.assertEqual(self.post(self.event('EvUnknown', team_id='TNOPE')).status_code,
+                         200)
+
+
+# 40 tokens a row, 48 with the message overhead
+ROW_TEXT = 'x' * 160
+
+
+@override_settings(MENTION_CONTEXT_TOKEN_BUDGET=200, MEMORY_ENABLED=False,
+                   GROQ_MAX_COMPLETION_TOKENS=1024,
+                   GROQ_MODEL_CONTEXT_WINDOWS={'small-model': 1500},
+                   GROQ_DEFAULT_CONTEXT_WINDOW=8192)
+class MentionContextTests(TestCase):
+
+    def setUp(self):
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TCONTEXT', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        self.minute = 0
+
+    def add(self, ts, text=ROW_TEXT, thread_ts=None, response=""):
+        """Store a row one minute after the previous one, its text starting with ts"""
+        conv = ConversationHistory.objects.create(
+            workspace=self.workspace, channel_id='C1', message_ts=ts,
+            thread_ts=thread_ts, user_id='U1',
+            message_text=f"{ts} {text}"[:len(text)], response=response)
+        self.minute += 1
+        ConversationHistory.objects.filter(pk=conv.pk).update(
+            created_at=timezone.now() - timedelta(hours=1, minutes=-self.minute))
+        return conv
+
+    def history(self, messages):
+        """ts of the history rows in a prompt"""
+        return [message['content'][:3] for message in messages[1:-1]]
+
+    def test_budget_is_capped_by_the_model_context_window(self):
+        self.assertEqual(context_token_budget('small-model'), 200)
+        self.assertEqual(context_token_budget('unknown-model'), 200)
+        with self.settings(MENTION_CONTEXT_TOKEN_BUDGET=4000):
+            self.assertEqual(context_token_budget('small-model'), 1500 - 1024)
+            self.assertEqual(context_token_budget('unknown-model'), 4000)
+
+    def test_newest_history_that_fits_the_budget(self):
+        for ts in ['1.0', '2.0', '3.0', '4.0', '5.0']:
+            self.add(ts)
+        messages = build_mention_context(
+            self.workspace, {'channel': 'C1', 'ts': '9.0', 'text': 'hi'}, 'llama')
+        self.assertEqual(messages[0]['role'], 'system')
+        # Three rows fit, oldest first
+        self.assertEqual(self.history(messages), ['3.0', '4.0', '5.0'])
+        self.assertEqual(messages[-1], {"role": "user", "content": "hi"})
+
+    def test_thread_history_comes_first(self):
+        self.add('1.0', thread_ts='1.0')
+        self.add('2.0', thread_ts='1.0')
+        for ts in ['3.0', '4.0', '5.0', '6.0']:
+            self.add(ts)
+        messages = build_mention_context(
+            self.workspace, {'channel': 'C1', 'ts': '9.0', 'thread_ts': '1.0',
+                             'text': 'hi'}, 'llama')
+        self.assertEqual(self.history(messages), ['1.0', '2.0', '6.0'])
+
+    def test_responses_count_against_the_budget(self):
+        self.add('1.0')
+        self.add('2.0', text='x' * 40, response='y' * 480)
+        messages = build_mention_context(
+            self.workspace, {'channel': 'C1', 'ts': '9.0', 'text': 'hi'}, 'llama')
+        # 10 + 120 tokens plus overhead, the older row doesn't fit next to it
+        self.assertEqual([message['role'] for message in messages],
+                         ['system', 'user', 'assistant', 'user'])
+        self.assertEqual(messages[2]['content'], 'y' * 480)
+
+
+@override_settings(GROQ_API_KEY='fake-key',
+                   GROQ_MAX_RETRIES=0,
+                   GROQ_RESPONSE_CACHE_ENABLED=False,
+                   RATE_LIMIT_ENABLED=False,
+                   GROQ_HEDGE_ENABLED=False,
+                   GROQ_MODEL_ROUTES={'mention': ['small-model', 'big-model']},
+                   GROQ_MODEL_CONTEXT_WINDOWS={'small-model': 8192, 'big-model': 131072},
+                   GROQ_MODEL_MAX_PROMPT_TOKENS={'small-model': 1000})
+class ModelRoutingTests(SimpleTestCase):
+
+    messages = [{"role": "user", "content": "ping"}]
+
+    def test_route_skips_models_the_prompt_is_too_big_for(self):
+        self.assertEqual(route('mention', 100), ['small-model', 'big-model'])
+        self.assertEqual(route('mention', 5000), ['big-model'])
+        # Nothing fits, the API gets the whole chain
+        self.assertEqual(route('mention', 10 ** 6), ['small-model', 'big-model'])
+
+    def test_fails_over_to_the_next_model(self):
+        with FakeGroqServer(failing_models=['small-model']) as server, \
+                override_settings(GROQ_BASE_URL=server.url):
+            response = GroqClient().get_response(self.messages, task='mention')
+        self.assertEqual(response, FakeGroqServer.reply)
+        self.assertEqual(server.models, {'small-model': 1, 'big-model': 1})
+
+    def test_healthy_primary_answers_alone(self):
+        with FakeGroqServer() as server, override_settings(GROQ_BASE_URL=server.url):
+            GroqClient().get_response(self.messages, task='mention')
+        self.assertEqual(server.models, {'small-model': 1})
+
+    def test_error_of_the_last_model_is_raised(self):
+        with FakeGroqServer(failing_models=['small-model', 'big-model']) as server, \
+                override_settings(GROQ_BASE_URL=server.url):
+            with self.assertRaises(groq.InternalServerError):
+                GroqClient().get_response(self.messages, task='mention')
+        self.assertEqual(server.models, {'small-model': 1, 'big-model': 1})
+
+    def test_vision_reports_the_model_that_answered(self):
+        with override_settings(GROQ_MODEL_ROUTES={'vision': ['small-model', 'big-model']}), \
+                FakeGroqServer(failing_models=['small-model']) as server, \
+                override_settings(GROQ_BASE_URL=server.url):
+            model, response = GroqClient().get_vision_response(self.messages,
+                                                               with_model=True)
+        self.assertEqual(model, 'big-model')
+
+
+@override_settings(METRICS_ENABLED=True, METRICS_TOKEN='metrics-token')
+class MetricsEndpointTests(SimpleTestCase):
+
+    def get(self, authorization=None):
+        headers = {'HTTP_AUTHORIZATION': authorization} if authorization else {}
+        return Client().get('/api/metrics/', **headers)
+
+    def test_served_with_the_token(self):
+        response = self.get('Bearer metrics-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'slackbot_groq_request_seconds', response.content)
+
+    def test_wrong_token_gets_401(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get('Bearer nope').status_code, 401)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_not_served_without_a_token(self):
+        self.assertEqual(self.get().status_code, 404)
+
+
+class ContainersCollectorTests(SimpleTestCase):
+
+    def test_adds_up_the_directories_of_all_containers(self):
+        with tempfile.TemporaryDirectory() as root:
+            # Processes with the same pid in two containers
+            for container, amount in (('web', 2), ('celery-batch', 3)):
+                directory = os.path.join(root, container)
+                os.mkdir(directory)
+                with mock.patch.dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory):
+                    value = MultiProcessValue(process_identifier=lambda: 1)(
+                        'counter', 'test_requests', 'test_requests_total', (), (), '')
+                    value.inc(amount)
+
+            samples = [sample for metric in ContainersCollector(root).collect()
+                       for sample in metric.samples
+                       if sample.name == 'test_requests_total']
+        self.assertEqual([sample.value for sample in samples], [5])
+
+
+@override_settings(CACHE_BACKEND='local', RATE_LIMIT_ENABLED=False)
+class AnalysisFailureNotificationTests(TestCase):
+
+    def setUp(self):
+        workspace_cache.clear()
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TFAIL', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        self.errback = notify_analysis_failed.s(str(self.workspace.uuid), 'C1')
+
+    def call_errbacks(self, slack_client):
+        """Run the errback the way Celery does when a chunk of the chord fails"""
+        request = Context(id='chunk-id', errbacks=[self.errback],
+                          delivery_info={})
+        with offline_celery(eager=True), \
+                mock.patch('chatbot.tasks.get_slack_client',
+                           return_value=slack_client):
+            celery_app.backend._call_task_errbacks(
+                request, RuntimeError("chunk failed"), None)
+
+    def test_channel_is_notified(self):
+        slack_client = FakeSlackClient()
+        self.call_errbacks(slack_client)
+        posts = slack_client.client.posts
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0]['channel'], 'C1')
+        self.assertIn("chunk failed", posts[0]['text'])
+
+    def test_rate_limited_notice_is_rescheduled(self):
+        slack_client = mock.Mock()
+        slack_client.send_message.side_effect = RateLimitExceeded("busy", wait=5)
+        with mock.patch.object(notify_analysis_failed, 'apply_async') as apply_async:
+            self.call_errbacks(slack_client)
+        apply_async.assert_called_once_with(
+            (None, "chunk failed", None, str(self.workspace.uuid), 'C1'),
+            {'attempt': 1}, countdown=5)
+
+
+@override_settings(CACHE_BACKEND='local',
+                   RATE_LIMIT_ENABLED=False,
+                   GROQ_RESPONSE_CACHE_ENABLED=False,
+                   SLACK_STREAM_REPLIES=False,
+                   MEMORY_ENABLED=False)
+class MentionRetryTests(TestCase):
+
+    def setUp(self):
+        workspace_cache.clear()
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TMENTION', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        self.event = {'type': 'app_mention', 'channel': 'C1', 'user': 'U1',
+                      'text': '<@UBOT> hello', 'ts': '1700000000.000100'}
+        self.slack_client = mock.Mock()
+        self.groq_client = FakeGroqClient()
+
+    def mention(self):
+        with offline_celery(eager=True), \
+                mock.patch('chatbot.tasks.get_slack_client',
+                           return_value=self.slack_client), \
+                mock.patch('chatbot.tasks.GroqClient',
+                           return_value=self.groq_client):
+            return process_mention.apply(
+                (str(self.workspace.uuid), self.event))
+
+    def test_rate_limited_send_is_retried_with_the_saved_reply(self):
+        self.slack_client.send_message.side_effect = [
+            RateLimitExceeded("busy", wait=3), {'ok': True, 'ts': '2.0'}]
+        self.assertTrue(self.mention().successful())
+        self.assertEqual(self.groq_client.calls, 1)
+        self.assertEqual(self.slack_client.send_message.call_count, 2)
+        self.assertEqual(self.slack_client.send_message.call_args.kwargs['text'],
+                         FakeGroqClient.reply)
+        self.assertEqual(ConversationHistory.objects.filter(
+            workspace=self.workspace, message_ts=self.event['ts']).count(), 1)
+
+    @override_settings(SLACK_STREAM_REPLIES=True)
+    def test_busy_notice_once_out_of_retries(self):
+        self.slack_client.send_message.return_value = {'ok': True, 'ts': '2.0'}
+        with mock.patch.object(self.groq_client, 'stream_response',
+                               side_effect=RateLimitExceeded("busy", wait=3)):
+            result = self.mention()
+        self.assertIsInstance(result.result, RateLimitExceeded)
+        # The placeholder is posted once and reused by every retry
+        self.assertEqual(self.slack_client.send_message.call_count, 1)
+        self.slack_client.update_message.assert_called_once_with(
+            'C1', '2.0', "❌ Sorry, I'm too busy to reply right now.")
+
+
+@override_settings(TRACING_ENABLED=True, TRACING_SAMPLE_RATE=1.0)
+class WorkerTraceTests(SimpleTestCase):
+
+    def run_task(self, traceparent):
+        """Open a task span under traceparent, returns it with a span nested in it"""
+        task = SimpleNamespace(name='chatbot.tasks.process_mention',
+                               request=SimpleNamespace(traceparent=traceparent))
+        with mock.patch('chatbot.tracing.get_span_processor') as processor:
+            start_task_span(task=task)
+            with span('persist') as inner:
+                pass
+            task_span = task.request.trace_span[0]
+            finish_task_span(task=task, state='SUCCESS')
+        return task_span, inner, processor.return_value.submit
+
+    def test_spans_join_a_sampled_trace(self):
+        task_span, inner, submit = self.run_task(f"00-{'a' * 32}-{'b' * 16}-01")
+        self.assertEqual(task_span.trace_id, 'a' * 32)
+        self.assertEqual(task_span.parent_id, 'b' * 16)
+        self.assertEqual(inner.parent_id, task_span.span_id)
+        self.assertEqual(submit.call_count, 2)
+
+    def test_nothing_is_traced_under_an_unsampled_parent(self):
+        task_span, inner, submit = self.run_task(f"00-{'0' * 32}-{'0' * 16}-00")
+        self.assertIsNone(task_span)
+        self.assertIsNone(inner)
+        submit.assert_not_called()
+
+
+@override_settings(CACHE_BACKEND='local', MEMORY_ENABLED=True,
+                   MEMORY_FOLD_THRESHOLD_TOKENS=30, MEMORY_TAIL_TOKENS=20,
+                   MEMORY_FOLD_CHUNK_TOKENS=25, MENTION_CONTEXT_TOKEN_BUDGET=4000)
+class MemoryFoldTests(TestCase):
+
+    def setUp(self):
+        get_cache('memory-folds').clear()
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TMEMORY', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        self.event = {'channel': 'C1', 'ts': '2.0', 'thread_ts': '1.0'}
+        self.groq_client = mock.Mock()
+        self.groq_client.get_response.side_effect = [f"Summary {i}" for i in range(1, 10)]
+
+    def add_turns(self, count):
+        """count turns of 10 tokens in the thread, a minute apart"""
+        rows = []
+        for i in range(count):
+            conv = ConversationHistory.objects.create(
+                workspace=self.workspace, channel_id='C1', thread_ts='1.0',
+                message_ts=f"1.{i:06d}", user_id='U1', message_text=f"turn {i}",
+                response="ok", token_count=10)
+            created_at = timezone.now() - timedelta(hours=1, minutes=-i)
+            ConversationHistory.objects.filter(pk=conv.pk).update(created_at=created_at)
+            conv.created_at = created_at
+            rows.append(conv)
+        return rows
+
+    def test_all_but_the_tail_is_folded(self):
+        rows = self.add_turns(6)
+        self.assertTrue(needs_fold(self.workspace, 'C1', '1.0'))
+        self.assertEqual(fold_memory(self.groq_client, self.workspace, 'C1', '1.0'), 4)
+        # Two turns per chunk, each call rewriting the summary so far
+        self.assertEqual(self.groq_client.get_response.call_count, 2)
+        second_prompt = self.groq_client.get_response.call_args.args[0][1]['content']
+        self.assertIn("Current summary:\nSummary 1", second_prompt)
+        self.assertIn("User U1: turn 3", second_prompt)
+        summary = ThreadSummary.objects.get()
+        self.assertEqual((summary.summary_text, summary.summarized_until,
+                          summary.message_count),
+                         ("Summary 2", rows[3].created_at, 4))
+        self.assertFalse(needs_fold(self.workspace, 'C1', '1.0'))
+
+        # Prompts carry the summary instead of the folded turns
+        messages = build_mention_context(self.workspace, dict(self.event, text="hi"),
+                                         'llama')
+        self.assertEqual(messages[1]['content'],
+                         "Summary of the earlier conversation:\nSummary 2")
+        self.assertEqual([message['content'] for message in messages[2:-1:2]],
+                         ["turn 4", "turn 5"])
+
+    def test_fold_racing_another_one_is_dropped(self):
+        rows = self.add_turns(6)
+
+        def concurrent_fold(messages, **kwargs):
+            ThreadSummary.objects.update(summary_text="Theirs",
+                                         summarized_until=rows[1].created_at)
+            return "Ours"
+
+        self.groq_client.get_response.side_effect = concurrent_fold
+        self.assertEqual(fold_memory(self.groq_client, self.workspace, 'C1', '1.0'), 0)
+        self.assertEqual(ThreadSummary.objects.get().summary_text, "Theirs")
+
+    def test_nothing_to_fold_within_the_tail(self):
+        self.add_turns(2)
+        self.assertFalse(needs_fold(self.workspace, 'C1', '1.0'))
+        self.assertEqual(fold_memory(self.groq_client, self.workspace, 'C1', '1.0'), 0)
+        self.groq_client.get_response.assert_not_called()
+
+    def test_one_fold_per_thread_is_queued_at_a_time(self):
+        with mock.patch('chatbot.tasks.needs_fold', return_value=True), \
+                mock.patch.object(fold_conversation_memory, 'delay') as delay:
+            schedule_memory_fold(self.workspace, self.event)
+            schedule_memory_fold(self.workspace, self.event)
+            schedule_memory_fold(self.workspace, dict(self.event, thread_ts='3.0'))
+            self.assertEqual(delay.call_count, 2)
+
+            with mock.patch('chatbot.tasks.GroqClient'), \
+                    mock.patch('chatbot.tasks.fold_memory', return_value=0):
+                fold_conversation_memory(str(self.workspace.uuid), 'C1', '1.0')
+            schedule_memory_fold(self.workspace, self.event)
+            self.assertEqual(delay.call_count, 3)
+
+
+class AsyncMentionTests(SimpleTestCase):
+
+    def setUp(self):
+        self.workspace = SimpleNamespace(bot_token='xoxb-test', team_id='TASYNC')
+        self.event = {'type': 'app_mention', 'channel': 'C1', 'user': 'U1',
+                      'text': '<@UBOT> hello', 'ts': '5.0', 'thread_ts': '4.0'}
+        self.slack_service = mock.Mock(send_message=mock.AsyncMock())
+        self.groq_client = mock.Mock(get_response=mock.AsyncMock())
+        self.deduplicator = EventDeduplicator(store=LocalCache(), ttl=60)
+        for target, value in (
+                ('AsyncSlackClient', self.slack_service),
+                ('AsyncGroqClient', self.groq_client),
+                ('abuild_mention_context', []),
+                ('aget_workspace', self.workspace),
+                ('get_event_deduplicator', self.deduplicator)):
+            patcher = mock.patch(f"chatbot.async_views.{target}",
+                                 return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('chatbot.async_views.ConversationHistory')
+        self.history = patcher.start()
+        self.history.objects.aupdate_or_create = mock.AsyncMock()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('chatbot.async_views.schedule_memory_fold')
+        self.schedule_memory_fold = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def slow_reply(self, messages, task):
+        await asyncio.sleep(10)
+
+    async def test_reply_is_posted_in_the_thread(self):
+        self.groq_client.get_response.return_value = "Hi there"
+        self.deduplicator.claim('EvAsync')
+        await handle_mention(self.event, self.workspace, 'EvAsync')
+        self.slack_service.send_message.assert_awaited_once_with(
+            channel='C1', text="Hi there", thread_ts='4.0')
+        defaults = self.history.objects.aupdate_or_create.call_args.kwargs['defaults']
+        self.assertEqual(defaults['response'], "Hi there")
+        self.schedule_memory_fold.assert_called_once_with(self.workspace, self.event)
+        self.assertFalse(self.deduplicator.claim('EvAsync'))
+
+    async def test_failure_after_the_reply_keeps_the_claim(self):
+        self.groq_client.get_response.return_value = "Hi there"
+        self.schedule_memory_fold.side_effect = RuntimeError("broker is down")
+        self.deduplicator.claim('EvAsync')
+        await handle_mention(self.event, self.workspace, 'EvAsync')
+        self.slack_service.send_message.assert_awaited_once()
+        self.assertFalse(self.deduplicator.claim('EvAsync'))
+
+    async def test_failure_is_answered_in_the_thread(self):
+        self.groq_client.get_response.side_effect = RuntimeError("groq is down")
+        self.deduplicator.claim('EvAsync')
+        await handle_mention(self.event, self.workspace, 'EvAsync')
+        self.slack_service.send_message.assert_awaited_once_with(
+            channel='C1', text="❌ Sorry, something went wrong generating a reply.",
+            thread_ts='4.0')
+        self.assertTrue(self.deduplicator.claim('EvAsync'))
+
+    async def test_mentions_are_acked_before_the_reply(self):
+        self.groq_client.get_response.side_effect = self.slow_reply
+        response = await process_event({'team_id': 'TASYNC', 'event': self.event,
+                                        'event_id': 'EvAsync'})
+        self.assertEqual(json.loads(response.content), {'ok': True})
+        self.slack_service.send_message.assert_not_awaited()
+        self.assertEqual(await drain_mentions(0), 1)
+
+    async def test_drain_waits_for_running_mentions(self):
+        self.groq_client.get_response.return_value = "Hi there"
+        await process_event({'team_id': 'TASYNC', 'event': self.event,
+                             'event_id': 'EvAsync'})
+        self.assertEqual(await drain_mentions(5), 0)
+        self.slack_service.send_message.assert_awaited_once()
+
+    async def test_drain_cancels_late_mentions_and_releases_them(self):
+        self.groq_client.get_response.side_effect = self.slow_reply
+        self.deduplicator.claim('EvAsync')
+        await process_event({'team_id': 'TASYNC', 'event': self.event,
+                             'event_id': 'EvAsync'})
+        await asyncio.sleep(0)
+        self.assertEqual(await drain_mentions(0.01), 1)
+        self.slack_service.send_message.assert_not_awaited()
+        self.assertTrue(self.deduplicator.claim('EvAsync'))
+        self.assertEqual(await drain_mentions(0.01), 0)
+
+    @override_settings(ASYNC_MENTION_DRAIN_TIMEOUT=0.01)
+    async def test_lifespan_shutdown_drains_mentions(self):
+        self.groq_client.get_response.side_effect = self.slow_reply
+        await process_event({'team_id': 'TASYNC', 'event': self.event,
+                             'event_id': 'EvAsync'})
+        messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        with mock.patch('chatbot.async_views.aclose_async_groq_clients') as aclose:
+            await lifespan({'type': 'lifespan'}, receive, send)
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+        aclose.assert_awaited_once()
+        self.assertEqual(await drain_mentions(0), 0)
+
+
+class WorkspaceCacheTests(TestCase):
+
+    def setUp(self):
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TCACHE', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-old')
+        # Two processes sharing the version store
+        self.versions = LocalCache()
+        self.cache = WorkspaceCache(versions=self.versions)
+        self.other = WorkspaceCache(versions=self.versions)
+
+    def test_cached_by_team_id_and_uuid(self):
+        workspace = self.cache.get(team_id='TCACHE')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get(team_id='TCACHE'), workspace)
+            self.assertEqual(self.cache.get(uuid=workspace.uuid), workspace)
+            self.assertIs(self.cache.get_slack_client(workspace),
+                          self.cache.get_slack_client(workspace))
+
+    def test_unknown_team_raises(self):
+        with self.assertRaises(SlackWorkspace.DoesNotExist):
+            self.cache.get(team_id='TNOPE')
+
+    def test_invalidation_reaches_every_process(self):
+        self.cache.get(team_id='TCACHE')
+        self.other.get(team_id='TCACHE')
+
+        # An OAuth re-install in the first process
+        SlackWorkspace.objects.filter(pk=self.workspace.pk).update(bot_token='xoxb-new')
+        self.cache.invalidate(self.workspace)
+
+        self.assertEqual(self.other.get(team_id='TCACHE').bot_token, 'xoxb-new')
+        self.assertEqual(self.other.get(uuid=self.workspace.uuid).bot_token,
+                         'xoxb-new')
+        with self.assertNumQueries(0):
+            self.other.get(team_id='TCACHE')
+
+    def test_slack_client_follows_a_new_token(self):
+        old_client = self.cache.get_slack_client(self.workspace)
+        self.workspace.bot_token = 'xoxb-new'
+        new_client = self.cache.get_slack_client(self.workspace)
+        self.assertIsNot(new_client, old_client)
+        self.assertIs(self.cache.get_slack_client(self.workspace), new_client)
+
+
+@override_settings(GROQ_API_KEY='fake-key',
+                   GROQ_RESPONSE_CACHE_ENABLED=False,
+                   RATE_LIMIT_ENABLED=False,
+                   GROQ_HEDGE_ENABLED=False)
+class GroqClientPoolTests(SimpleTestCase):
+
+    def test_one_client_per_process(self):
+        client = get_groq_client()
+        self.assertIs(get_groq_client(), client)
+        # A forked child doesn't reuse its parent's sockets
+        with mock.patch('chatbot.clients.os.getpid', return_value=-1):
+            child = get_groq_client()
+        self.assertIsNot(child, client)
+        self.assertIs(get_groq_client(), client)
+
+    def test_calls_reuse_a_kept_alive_connection(self):
+        with FakeGroqServer() as server, override_settings(GROQ_BASE_URL=server.url):
+            for _ in range(5):
+                GroqClient().get_response([{"role": "user", "content": "ping"}])
+        self.assertEqual(server.requests, 5)
+        self.assertEqual(len(server.connections), 1)
+
+    def test_one_async_client_per_event_loop(self):
+        async def clients():
+            return get_async_groq_client(), get_async_groq_client()
+
+        first, again = asyncio.run(clients())
+        self.assertIs(first, again)
+        other, _ = asyncio.run(clients())
+        self.assertIsNot(other, first)
+
+
+@override_settings(SLACK_STREAM_UPDATE_INTERVAL=1.5,
+                   SLACK_STREAM_PLACEHOLDER='Thinking...')
+class StreamReplyTests(SimpleTestCase):
+
+    def setUp(self):
+        self.slack_client = mock.Mock()
+        self.slack_client.send_message.return_value = {'ok': True, 'ts': 'P1'}
+        self.groq_client = mock.Mock()
+        self.groq_client.stream_response.return_value = iter(
+            ['one ', 'two ', 'three ', 'four ', 'five ', 'six ', 'seven ', 'eight'])
+
+    def stream(self):
+        # A delta every half second
+        clock = itertools.chain([0], (i * 0.5 for i in range(8)), itertools.repeat(4))
+        with mock.patch('chatbot.streaming.time.monotonic', side_effect=clock), \
+                mock.patch('chatbot.streaming.time.sleep') as sleep:
+            text = stream_reply(self.slack_client, self.groq_client,
+                                [{"role": "user", "content": "hi"}], channel='C1',
+                                thread_ts='1.0')
+        return text, sleep
+
+    def updates(self):
+        return [call.args[2] for call in self.slack_client.update_message.call_args_list]
+
+    def test_updates_at_most_every_interval(self):
+        text, _ = self.stream()
+        self.assertEqual(text, 'one two three four five six seven eight')
+        self.slack_client.send_message.assert_called_once_with(
+            channel='C1', text='Thinking...', thread_ts='1.0')
+        # At 0s, 1.5s and 3s, then the complete text
+        self.assertEqual(self.updates(), ['one  ▍', 'one two three four  ▍',
+                                          'one two three four five six seven  ▍',
+                                          text])
+
+    def test_slack_rate_limit_pushes_the_next_update_back(self):
+        def update(channel, ts, text):
+            if update.calls == 0:
+                update.calls += 1
+                raise rate_limited_error(3)
+        update.calls = 0
+        self.slack_client.update_message.side_effect = update
+        text, sleep = self.stream()
+        # Nothing before 3s, Slack asked to wait that long
+        self.assertEqual(self.updates(), ['one  ▍', 'one two three four five six seven  ▍',
+                                          text])
+        sleep.assert_not_called()
+
+    def test_reused_placeholder_isnt_posted_again(self):
+        stream_reply(self.slack_client, self.groq_client, [], channel='C1',
+                     placeholder_ts='P0')
+        self.slack_client.send_message.assert_not_called()
+        self.assertEqual(self.slack_client.update_message.call_args.args[1], 'P0')
+
+
+@override_settings(RATE_LIMIT_ENABLED=False, VISION_IMAGE_MAX_DIMENSION=512,
+                   GROQ_MODEL_ROUTES={'vision': ['vision-a', 'vision-b']})
+class ImageAnalysisTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeFileServer(width=1600, height=1200).start()
+        cls.addClassCleanup(cls.server.stop)
+
+    def setUp(self):
+        self.server.requests = 0
+        self.slack_client = FakeSlackClient(file_url=self.server.url)
+        self.groq_client = mock.Mock()
+        self.groq_client.get_vision_response.return_value = ('vision-a', "A chart")
+        self.cache = LocalCache()
+        patcher = mock.patch('chatbot.images.vision_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def analyze(self, file_id):
+        return analyze_slack_image(self.slack_client, self.groq_client,
+                                   {'id': file_id}, 'xoxb-test')
+
+    def test_images_are_downscaled_to_jpeg(self):
+        url = prepare_image(self.server.png)
+        header, encoded = url.split(',', 1)
+        self.assertEqual(header, 'data:image/jpeg;base64')
+        image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+        self.assertEqual((image.format, image.size), ('JPEG', (512, 384)))
+
+    def test_seen_file_costs_no_download_or_vision_call(self):
+        self.assertEqual(self.analyze('F1'), "A chart")
+        self.assertEqual(self.analyze('F1'), "A chart")
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.slack_client.client.calls['files.info'], 1)
+        self.groq_client.get_vision_response.assert_called_once()
+        content_hash = hashlib.sha256(self.server.png).hexdigest()
+        self.assertEqual(self.cache.get('file:F1'), content_hash)
+        self.assertEqual(self.cache.get(f"result:vision-a:{content_hash}"), "A chart")
+
+    def test_reupload_costs_only_the_download(self):
+        self.analyze('F1')
+        self.assertEqual(self.analyze('F2'), "A chart")
+        self.assertEqual(self.server.requests, 2)
+        self.groq_client.get_vision_response.assert_called_once()
+
+    def test_fallback_model_answers_arent_cached(self):
+        self.groq_client.get_vision_response.return_value = ('vision-b', "A graph")
+        self.assertEqual(self.analyze('F1'), "A graph")
+        self.groq_client.get_vision_response.return_value = ('vision-a', "A chart")
+        self.assertEqual(self.analyze('F1'), "A chart")
+        self.assertEqual(self.groq_client.get_vision_response.call_count, 2)
+
+
+@override_settings(VISION_MAX_IMAGES=3, VISION_MAX_CONCURRENCY=3)
+class MultiImageAnalysisTests(SimpleTestCase):
+
+    def setUp(self):
+        self.messages = [
+            {'ts': '1.0', 'files': [{'id': 'F1', 'filetype': 'png'}]},
+            {'ts': '3.0', 'files': [{'id': 'F3', 'filetype': 'jpg'},
+                                    {'id': 'F4', 'filetype': 'pdf'}]},
+            {'ts': '2.0', 'files': [{'id': 'F2', 'filetype': 'png'}]},
+            {'ts': '4.0', 'files': [{'id': 'F3', 'filetype': 'jpg'}]},
+            {'ts': '5.0', 'text': "no files"},
+        ]
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def analyze_image(self, slack_client, groq_client, file, bot_token):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        if file['id'] == 'F2':
+            raise RuntimeError("download failed")
+        return f"Analysis of {file['id']}"
+
+    def analyze(self):
+        with mock.patch('chatbot.images.analyze_slack_image',
+                        side_effect=self.analyze_image):
+            return analyze_slack_images(None, None, self.messages, 'xoxb-test')
+
+    def test_recent_images_are_analyzed_concurrently(self):
+        results = self.analyze()
+        # Most recent first, each file once, failures skipped
+        self.assertEqual([(file['id'], analysis) for file, analysis in results],
+                         [('F3', "Analysis of F3"), ('F1', "Analysis of F1")])
+        self.assertEqual(self.most_active, 3)
+
+    def test_at_most_vision_max_images(self):
+        self.messages.append({'ts': '6.0', 'files': [{'id': 'F6', 'filetype': 'png'}]})
+        results = self.analyze()
+        self.assertEqual([file['id'] for file, _ in results], ['F6', 'F3'])
+
+    def test_no_images(self):
+        with mock.patch('chatbot.images.analyze_slack_image') as analyze_image:
+            self.assertEqual(analyze_slack_images(None, None, self.messages[4:], ''), [])
+        analyze_image.assert_not_called()
+
+    def test_analyses_are_combined_per_image(self):
+        self.assertEqual(combine_image_analyses([({'id': 'F1'}, "A chart")]), "A chart")
+        self.assertEqual(
+            combine_image_analyses([({'id': 'F1', 'name': 'chart.png'}, "A chart"),
+                                    ({'id': 'F2'}, "A table")]),
+            "Image 1 (chart.png):\nA chart\n\nImage 2 (F2):\nA table")
+
+
+class InMemoryRedis:
+    """The Redis commands RedisCache uses, on dicts"""
+
+    def __init__(self):
+        self.values = {}
+        self.sorted_sets = {}
+
+    def pipeline(self, transaction=True):
+        redis_client = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.calls.append(
+                    (getattr(redis_client, name), args, kwargs))
+
+            def execute(self):
+                return [call(*args, **kwargs) for call, args, kwargs in self.calls]
+
+        return Pipeline()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def delete(self, *keys):
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    def expire(self, key, ttl):
+        return True
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.sorted_sets.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.sorted_sets.get(key, {})
+        for member, score in list(members.items()):
+            if score <= high:
+                del members[member]
+
+    def zcard(self, key):
+        return len(self.sorted_sets.get(key, {}))
+
+    def zpopmin(self, key, count):
+        members = self.sorted_sets.get(key, {})
+        popped = sorted(members.items(), key=lambda item: item[1])[:count]
+        for member, _ in popped:
+            del members[member]
+        return popped
+
+
+class BoundedCacheTests(SimpleTestCase):
+
+    def redis_cache(self):
+        cache = RedisCache('redis://127.0.0.1:1/0', 'test', max_entries=3,
+                           default_ttl=100)
+        cache.client = InMemoryRedis()
+        return cache
+
+    def test_local_cache_evicts_least_recently_used(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual([cache.get(key) for key in 'abc'], [1, None, 3])
+        self.assertEqual(len(cache), 2)
+
+    def test_local_cache_entries_expire(self):
+        cache = LocalCache(default_ttl=10)
+        with mock.patch('chatbot.cache.time.monotonic', return_value=0):
+            cache.set('a', 1)
+            self.assertFalse(cache.add('a', 2))
+        with mock.patch('chatbot.cache.time.monotonic', return_value=10):
+            self.assertIsNone(cache.get('a'))
+            self.assertTrue(cache.add('a', 2))
+
+    def test_redis_cache_evicts_the_keys_closest_to_expiring(self):
+        cache = self.redis_cache()
+        cache.set('a', 1, ttl=100)
+        cache.set('b', 2, ttl=10)
+        cache.set('c', 3, ttl=200)
+        cache.set('d', {'n': 4}, ttl=300)
+        self.assertEqual([cache.get(key) for key in 'abcd'], [1, None, 3, {'n': 4}])
+        self.assertEqual(cache.client.zcard(cache._index()), 3)
+
+    def test_redis_cache_delete_leaves_the_index(self):
+        cache = self.redis_cache()
+        cache.set('a', 1)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.client.zcard(cache._index()), 0)
+
+    def test_redis_outage_falls_back_to_a_local_cache(self):
+        cache = self.redis_cache()
+        cache.client = mock.Mock(**{
+            'get.side_effect': redis.ConnectionError("down"),
+            'pipeline.side_effect': redis.ConnectionError("down"),
+        })
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        # Redis isn't tried again before the backoff is over
+        cache.client.get.assert_called_once()
+
+
+@override_settings(GROQ_RESPONSE_CACHE_ENABLED=True)
+class ResponseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.groq_client = FakeGroqClient()
+        self.cache = LocalCache()
+        patcher = mock.patch('chatbot.clients.response_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('chatbot.clients.response_cache_stats', CacheStats())
+        self.stats = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def key(self, content, **params):
+        params = dict({'model': 'm1', 'temperature': 0.7}, **params)
+        return response_cache_key(dict(params, messages=[{"role": "user",
+                                                          "content": content}]))
+
+    def test_key_ignores_whitespace(self):
+        self.assertEqual(self.key("How is the\n  release  going?"),
+                         self.key("How is the release going? "))
+        self.assertEqual(self.key([{'type': 'text', 'text': "a  b"}]),
+                         self.key([{'type': 'text', 'text': "a b"}]))
+
+    def test_key_covers_model_and_sampling_params(self):
+        self.assertNotEqual(self.key("hi"), self.key("hi", model='m2'))
+        self.assertNotEqual(self.key("hi"), self.key("hi", temperature=0))
+        self.assertNotEqual(self.key("hi"), self.key("hi", max_tokens=10))
+
+    def test_repeated_prompt_is_served_from_the_cache(self):
+        for text in ["Summarize  this", "Summarize this"]:
+            self.assertEqual(
+                self.groq_client.get_response([{"role": "user", "content": text}],
+                                              model='m1'),
+                FakeGroqClient.reply)
+        self.assertEqual(self.groq_client.calls, 1)
+        self.assertEqual(self.stats.as_dict(),
+                         {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    def test_cache_is_opt_in(self):
+        with self.settings(GROQ_RESPONSE_CACHE_ENABLED=False):
+            for _ in range(2):
+                self.groq_client.get_response([{"role": "user", "content": "hi"}],
+                                              model='m1')
+        self.assertEqual(self.groq_client.calls, 2)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.stats.as_dict()['misses'], 0)
+
+
+class QueueRoutingTests(SimpleTestCase):
+
+    def published(self, task, *args):
+        """(queue, priority) a task is published with"""
+        with offline_celery(eager=False), \
+                mock.patch.object(celery_app.amqp, 'send_task_message') as send:
+            task.apply_async(args)
+        return send.call_args.kwargs['queue'].name, send.call_args.kwargs['priority']
+
+    def test_every_task_is_routed(self):
+        names = {name for name in celery_app.tasks if name.startswith('chatbot.')}
+        self.assertTrue(names)
+        self.assertEqual(names - set(TASK_ROUTES), set())
+
+    def test_mentions_go_to_the_interactive_queue_first(self):
+        self.assertEqual(self.published(process_mention, 'W', {}),
+                         (INTERACTIVE_QUEUE, 0))
+        self.assertEqual(self.published(analyze_channel_sentiment, 'W', 'C1'),
+                         (BATCH_QUEUE, 6))
+
+    def test_runs_under_way_come_before_new_ones(self):
+        priorities = {name: options['priority'] for name, options in TASK_ROUTES.items()}
+        new_runs = priorities['chatbot.tasks.analyze_channel_sentiment']
+        for name in ['chatbot.tasks.summarize_chunk', 'chatbot.tasks.reduce_channel_analysis',
+                     'celery.chord_unlock']:
+            self.assertLess(priorities[name], new_runs, name)
+
+    def test_tasks_carry_their_route_priority_and_queue_time_limits(self):
+        for name, options in TASK_ROUTES.items():
+            if not name.startswith('chatbot.'):
+                continue
+            task = celery_app.tasks[name]
+            soft, hard = settings.CELERY_QUEUE_TIME_LIMITS[options['queue']]
+            self.assertEqual((task.priority, task.soft_time_limit, task.time_limit),
+                             (options['priority'], soft, hard), name)
+
+
+class AnalysisBenchmarkTests(TestCase):
+
+    def benchmark(self, *args):
+        out = io.StringIO()
+        call_command('benchmark_analysis', '--image-ratio', '0', *args, stdout=out)
+        return out.getvalue()
+
+    def test_reports_every_stage_of_a_run(self):
+        report, = json.loads(self.benchmark('--messages', '60', '--json'))
+        self.assertEqual((report['messages'], report['analyzed_messages']), (60, 60))
+        self.assertLessEqual({'fetch', 'persist', 'prompt', 'llm', 'post'},
+                             set(report['stages']))
+        self.assertEqual(report['queries'],
+                         sum(stats['queries'] for stats in report['stages'].values()))
+        self.assertGreater(report['stages']['persist']['queries'], 0)
+        self.assertGreater(report['groq_calls'], 0)
+        self.assertEqual(report['slack_calls']['chat.postMessage'], 1)
+        # Each run cleans up after itself
+        self.assertFalse(SlackWorkspace.objects.exists())
+
+    def test_sizes_run_smallest_first(self):
+        output = self.benchmark('--messages', '40', '20')
+        self.assertLess(output.index("20 messages"), output.index("40 messages"))
+        self.assertIn("persist", output)
+
+    def test_stages_are_reported_to_listeners(self):
+        seen = []
+
+        def listener(name, started, duration):
+            seen.append((name, current_stage()))
+
+        add_stage_listener(listener)
+        try:
+            with stage('fetch'):
+                self.assertEqual(current_stage(), 'fetch')
+                with stage('persist'):
+                    self.assertEqual(current_stage(), 'persist')
+        finally:
+            remove_stage_listener(listener)
+        with stage('llm'):
+            pass
+        self.assertEqual(seen, [('persist', 'fetch'), ('fetch', None)])
+
+
+# Two UTC days of Slack timestamps
+DAY_ONE = 100 * 86400
+DAY_TWO = 101 * 86400
+
+
+@override_settings(RETENTION_DAYS=30, RETENTION_BATCH_SIZE=3)
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.archive_dir = archive_dir.name
+        patcher = override_settings(RETENTION_ARCHIVE_DIR=self.archive_dir)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        self.workspace = SlackWorkspace.objects.create(
+            team_id='TRETAIN', team_name='Test', bot_user_id='UBOT',
+            bot_token='xoxb-test')
+        self.now = timezone.now()
+        # Five old messages over two days, one recent one
+        for i, (ts, user, bot) in enumerate([(DAY_ONE + 10, 'U1', False),
+                                             (DAY_ONE + 20, 'U2', False),
+                                             (DAY_ONE + 30, '', True),
+                                             (DAY_TWO + 10, 'U1', False),
+                                             (DAY_TWO + 20, 'U3', False)]):
+            self.add(f"{ts}.000000", user, bot, days_ago=40 - i / 10)
+        self.add(f"{DAY_TWO + 30}.000000", 'U1', False, days_ago=1)
+
+    def add(self, ts, user, bot, days_ago):
+        conv = ConversationHistory.objects.create(
+            workspace=self.workspace, channel_id='C1', message_ts=ts, user_id=user,
+            message_text="hello", is_bot_message=bot, token_count=2)
+        ConversationHistory.objects.filter(pk=conv.pk).update(
+            created_at=self.now - timedelta(days=days_ago))
+
+    def archived_rows(self):
+        rows = []
+        for root, _, files in sorted(os.walk(self.archive_dir)):
+            for name in sorted(files):
+                with gzip.open(os.path.join(root, name), 'rt') as f:
+                    rows.extend(json.loads(line) for line in f)
+        return rows
+
+    def rollups(self):
+        return [(str(rollup.day), rollup.message_count, rollup.bot_message_count,
+                 rollup.token_count, rollup.participants)
+                for rollup in ChannelDailyRollup.objects.order_by('day')]
+
+    def test_old_history_is_archived_and_rolled_up(self):
+        self.assertEqual(archive_workspace(self.workspace, now=self.now), {'C1': 5})
+        self.assertEqual(list(ConversationHistory.objects.values_list(
+            'message_ts', flat=True)), [f"{DAY_TWO + 30}.000000"])
+        self.assertEqual([row['message_ts'] for row in self.archived_rows()],
+                         [f"{ts}.000000" for ts in [DAY_ONE + 10, DAY_ONE + 20,
+                                                    DAY_ONE + 30, DAY_TWO + 10,
+                                                    DAY_TWO + 20]])
+        self.assertEqual(self.rollups(), [('1970-04-11', 3, 1, 6, ['U1', 'U2']),
+                                          ('1970-04-12', 2, 0, 4, ['U1', 'U3'])])
+
+    def test_runs_cut_short_resume_where_they_stopped(self):
+        self.assertEqual(archive_workspace(self.workspace, now=self.now,
+                                           max_batches=1), {'C1': 3})
+        self.assertEqual(archive_workspace(self.workspace, now=self.now), {'C1': 2})
+        self.assertEqual(len(self.archived_rows()), 5)
+        self.assertEqual(self.rollups()[0][1:4], (3, 1, 6))
+
+    def test_failed_batch_is_rewritten_not_duplicated(self):
+        with mock.patch('chatbot.retention.add_to_rollups',
+                        side_effect=RuntimeError("db went away")):
+            with self.assertRaises(RuntimeError):
+                archive_workspace(self.workspace, now=self.now)
+        self.assertEqual(ConversationHistory.objects.count(), 6)
+        archive_workspace(self.workspace, now=self.now)
+        self.assertEqual(len(self.archived_rows()), 5)
+        self.assertEqual(ChannelDailyRollup.objects.count(), 2)
+
+    def test_retention_per_workspace(self):
+        self.workspace.retention_days = 0
+        self.assertEqual(archive_workspace(self.workspace, now=self.now), {})
+        self.workspace.retention_days = 60
+        self.assertEqual(archive_workspace(self.workspace, now=self.now), {})
+        self.assertEqual(ConversationHistory.objects.count(), 6)
@@ -0,0 +1,332 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from contextvars import ContextVar
+
+import requests
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# A parent received from another process, see inject() and extract()
+SpanContext = namedtuple('SpanContext', ['trace_id', 'span_id'])
+
+# Set while inside a trace that wasn't sampled, so nested spans and the
+# tasks it queues are skipped without another sampling decision
+_UNSAMPLED = object()
+
+_current = ContextVar('slackbot_span', default=None)
+
+# TRACING_ENABLED, read once: settings lookups are the bulk of the cost of
+# an untraced span
+_enabled = None
+
+
+def tracing_enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = settings.TRACING_ENABLED
+    return _enabled
+
+
+@receiver(setting_changed)
+def reset_tracing(setting=None, **kwargs):
+    global _enabled, _processor
+    if setting == 'TRACING_ENABLED':
+        _enabled = None
+    elif setting and setting.startswith('TRACING_'):
+        _processor = None
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns',
+                 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start_ns / 1e9,
+            'duration_ms': (self.end_ns - self.start_ns) / 1e6,
+            'attributes': self.attributes,
+            'error': self.error,
+            'service': settings.TRACING_SERVICE_NAME,
+        }
+
+
+def current_span():
+    """The span open in this context, or None"""
+    span = _current.get()
+    return span if isinstance(span, Span) else None
+
+
+def start_span(name, parent=None, **attributes):
+    """
+    Open a span as a child of parent (default: the current span) and make
+    it current. Returns (span, token) to pass to finish_span(); span is
+    None when nothing is traced.
+
+    A new trace is started, and sampled at TRACING_SAMPLE_RATE, only when
+    there's no parent and TRACING_ENABLED is on.
+    """
+    if parent is None:
+        parent = _current.get()
+    if parent is _UNSAMPLED:
+        # Also when the unsampled parent came from another process
+        return None, _current.set(_UNSAMPLED)
+    if parent is None:
+        if not tracing_enabled():
+            return None, None
+        if random.random() >= settings.TRACING_SAMPLE_RATE:
+            return None, _current.set(_UNSAMPLED)
+        span = Span(name, f"{random.getrandbits(128):032x}", None, attributes)
+    else:
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+    return span, _current.set(span)
+
+
+def finish_span(span, token, error=None):
+    if token is not None:
+        _current.reset(token)
+    if span is None:
+        return
+    span.end_ns = time.time_ns()
+    if error is not None:
+        span.error = f"{type(error).__name__}: {error}"
+    get_span_processor().submit(span)
+
+
+class span:
+    """
+    Trace the enclosed block as a span, a no-op when not tracing. Used as
+    `with span('history') as current:`, current being None when not traced.
+    A class rather than a generator to keep the untraced path cheap.
+    """
+
+    __slots__ = ('name', 'attributes', 'current', 'token')
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.current, self.token = start_span(self.name, **self.attributes)
+        return self.current
+
+    def __exit__(self, exc_type, exc, traceback):
+        finish_span(self.current, self.token, error=exc)
+        return False
+
+
+def inject():
+    """A W3C traceparent header value for the current span, or None"""
+    parent = _current.get()
+    if parent is _UNSAMPLED:
+        return f"00-{'0' * 32}-{'0' * 16}-00"
+    if parent is None:
+        return None
+    return f"00-{parent.trace_id}-{parent.span_id}-01"
+
+
+def extract(traceparent):
+    """The parent for a traceparent header value from inject()"""
+    try:
+        _, trace_id, span_id, flags = traceparent.split('-')
+    except (AttributeError, ValueError):
+        return None
+    if flags != '01':
+        return _UNSAMPLED
+    return SpanContext(trace_id, span_id)
+
+
+class JsonlSpanExporter:
+    """Appends spans to a file, one JSON object per line"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.as_dict(), default=str) + '\n'
+                        for span in spans)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class OtlpHttpSpanExporter:
+    """Posts spans to an OTLP/HTTP collector, JSON encoded"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.session = requests.Session()
+
+    def payload(self, spans):
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{
+                'key': 'service.name',
+                'value': {'stringValue': settings.TRACING_SERVICE_NAME},
+            }]},
+            'scopeSpans': [{
+                'scope': {'name': 'chatbot'},
+                'spans': [{
+                    'traceId': span.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': span.parent_id or '',
+                    'name': span.name,
+                    'kind': 1,
+                    'startTimeUnixNano': str(span.start_ns),
+                    'endTimeUnixNano': str(span.end_ns),
+                    'attributes': [{'key': key, 'value': _otlp_value(value)}
+                                   for key, value in span.attributes.items()],
+                    'status': ({'code': 2, 'message': span.error}
+                               if span.error else {'code': 1}),
+                } for span in spans],
+            }],
+        }]}
+
+    def export(self, spans):
+        response = self.session.post(self.endpoint, json=self.payload(spans),
+                                     timeout=5)
+        response.raise_for_status()
+
+
+class BatchSpanProcessor:
+    """
+    Hands finished spans to an exporter from a background thread, in
+    batches, so requests never wait on the file or collector. Spans are
+    dropped rather than queued without bound.
+    """
+
+    def __init__(self, exporter, max_batch=256, interval=1.0, max_queue=10000):
+        self.exporter = exporter
+        self.max_batch = max_batch
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, span):
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork into gunicorn or Celery workers
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._thread = threading.Thread(target=self._run,
+                                                    daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _drain(self, first=None):
+        batch = [first] if first is not None else []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch):
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            logger.warning(f"Dropped {len(batch)} spans, export failed: {e}")
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            self._export(self._drain(first))
+
+    def flush(self):
+        """Export everything queued, from the calling thread"""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self._export(batch)
+
+
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def get_span_processor():
+    global _processor
+    with _processor_lock:
+        if _processor is None:
+            if settings.TRACING_EXPORTER == 'otlp':
+                exporter = OtlpHttpSpanExporter(settings.TRACING_OTLP_ENDPOINT)
+            else:
+                exporter = JsonlSpanExporter(settings.TRACING_JSONL_PATH)
+            _processor = BatchSpanProcessor(exporter)
+            atexit.register(_processor.flush)
+        return _processor
+
+
+@before_task_publish.connect
+def inject_trace_header(headers=None, **kwargs):
+    traceparent = inject()
+    if headers is not None and traceparent:
+        headers['traceparent'] = traceparent
+
+
+@task_prerun.connect
+def start_task_span(task=None, **kwargs):
+    # Eager tasks run inside the caller's span and get no header
+    parent = extract(getattr(task.request, 'traceparent', None))
+    task.request.trace_span = start_span(f"task {task.name}", parent=parent)
+
+
+@task_postrun.connect
+def finish_task_span(task=None, state=None, **kwargs):
+    started = getattr(task.request, 'trace_span', None)
+    if started is None:
+        return
+    current, token = started
+    if current is not None:
+        current.set_attribute('celery.state', state)
+    finish_span(current, token)
@@ -1,5 +1,8 @@
+from django.conf import settings
 from django.urls import path
+from .async_views import slack_events_async
 from .views import (
+    MetricsView,
     SlackEventsView,
     SlackOAuthView,
 )
@@ -7,4 +10,10 @@ from .views import (
 urlpatterns = [
     path('slack/events/', SlackEventsView.as_view(), name='slack_events'),
     path('slack/oauth/', SlackOAuthView.as_view(), name='slack_oauth'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
+
+if settings.SERVER_MODE == 'asgi':
+    # Needs an ASGI server (see SERVER_MODE in entrypoint.sh)
+    urlpatterns.append(
+        path('slack/events/async/', slack_events_async, name='slack_events_async'))
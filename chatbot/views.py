@@ -2,12 +2,18 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.conf import settings, time
-from .clients import GroqClient, SlackClient
+from django.http import HttpResponse
+import hmac
+from .dedup import get_event_deduplicator
+from .metrics import render_metrics
 from .models import SlackWorkspace, ConversationHistory, ChannelAnalysis
+from .ratelimit import RateLimitExceeded, rate_limit_wait
 from slack_sdk import WebClient
 from rest_framework.renderers import JSONRenderer
 import logging
-from .tasks import analyze_channel_sentiment
+from .tasks import analyze_channel_sentiment, process_mention
+from .tracing import span
+from .workspaces import get_workspace, get_slack_client, invalidate_workspace
 
 logger = logging.getLogger(__name__)
 
@@ -18,12 +24,11 @@ class SlackEventsView(APIView):
 
     def post(self, request, *args, **kwargs):
         try:
-            # Get request data
-            event_data = request.data
-
-            # Verify Slack request signature
-            timestamp = request.headers.get('X-Slack-Request-Timestamp')
-            signature = request.headers.get('X-Slack-Signature')
+            # SlackIngressMiddleware has verified the signature and parsed
+            # the body already
+            event_data = getattr(request, 'slack_payload', None)
+            if event_data is None:
+                event_data = request.data
 
             # Handle different types of requests
             if event_data.get('type') == 'url_verification':
@@ -35,8 +40,25 @@ class SlackEventsView(APIView):
                 return self.handle_analyze_command(event_data)
             
             elif event_data.get('type') == 'event_callback':
+                # Drop Slack retries of events we have already taken,
+                # before any DB or LLM work
+                event_id = event_data.get('event_id')
+                deduplicator = get_event_deduplicator()
+                if not deduplicator.claim(event_id):
+                    logger.info(
+                        f"Dropping duplicate event {event_id} "
+                        f"(retry {request.headers.get('X-Slack-Retry-Num')}, "
+                        f"reason {request.headers.get('X-Slack-Retry-Reason')})"
+                    )
+                    return Response({'ok': True})
+
                 # Handle regular events (like mentions)
-                return self.process_event(event_data)
+                try:
+                    return self.process_event(event_data)
+                except Exception:
+                    # Let Slack's retry through since we never handled it
+                    deduplicator.release(event_id)
+                    raise
             
             return Response({'ok': True})
 
@@ -52,8 +74,8 @@ class SlackEventsView(APIView):
         try:
             team_id = command_data['team_id']
             channel_id = command_data['channel_id']
-            workspace = SlackWorkspace.objects.get(team_id=team_id)
-            slack_service = SlackClient(workspace.bot_token)
+            workspace = get_workspace(team_id=team_id)
+            slack_service = get_slack_client(workspace)
         except SlackWorkspace.DoesNotExist:
             return Response(
                 {"error": "Workspace not found"},
@@ -78,18 +100,29 @@ class SlackEventsView(APIView):
                 hours=hours
             )
             
-            # Send immediate response to Slack
-            slack_service.send_message(channel=channel_id,
-                                   text=f"🔄 Analyzing channel messages from the last {hours} hour{'s' if hours > 1 else ''}... I'll post the results here shortly!",
-                                   thread_ts=command_data.get('thread_ts'))
+            # Send immediate response to Slack, or answer the command with
+            # it when out of chat.postMessage tokens rather than wait
+            text = f"🔄 Analyzing channel messages from the last {hours} hour{'s' if hours > 1 else ''}... I'll post the results here shortly!"
+            try:
+                with rate_limit_wait(0):
+                    slack_service.send_message(channel=channel_id,
+                                               text=text,
+                                               thread_ts=command_data.get('thread_ts'))
+            except RateLimitExceeded:
+                return Response({'response_type': 'in_channel', 'text': text})
             
             return Response({'ok': True})
 
         except Exception as e:
             logger.error(f"Error processing analyze command: {e}")
-            slack_service.send_message(channel=channel_id,
-                                    text=f"Error starting analysis: {str(e)}",
-                                    thread_ts=command_data.get('thread_ts'))
+            text = f"Error starting analysis: {str(e)}"
+            try:
+                with rate_limit_wait(0):
+                    slack_service.send_message(channel=channel_id,
+                                               text=text,
+                                               thread_ts=command_data.get('thread_ts'))
+            except RateLimitExceeded:
+                return Response({'text': text})
         
 
     def process_event(self, event_data):
@@ -98,15 +131,17 @@ class SlackEventsView(APIView):
             event = event_data['event']
             team_id = event_data['team_id']
 
-            # Get workspace
-            workspace = SlackWorkspace.objects.get(team_id=team_id)
-
-            # Initialize services
-            slack_service = SlackClient(workspace.bot_token)
-            groq_service = GroqClient()
+            # Get workspace, events of unknown workspaces are not an error
+            # of ours (and keep their claim, so retries are dropped)
+            try:
+                workspace = get_workspace(team_id=team_id)
+            except SlackWorkspace.DoesNotExist:
+                logger.warning(f"Event for unknown workspace {team_id}")
+                return Response({"error": "Workspace not found"},
+                                status=status.HTTP_404_NOT_FOUND)
 
             if event.get('type') == 'app_mention':
-                self.handle_mention(event, workspace, slack_service, groq_service)
+                self.handle_mention(event, workspace)
 
             return Response({'ok': True})
 
@@ -114,44 +149,15 @@ class SlackEventsView(APIView):
             logger.error(f"Error processing event: {e}")
             raise
 
-    def handle_mention(self, event, workspace, slack_service, groq_service):
-        # Get conversation history
-        conversations = ConversationHistory.objects.filter(
-            workspace=workspace,
-            channel_id=event['channel']).order_by('-created_at')[:5]
-
-        message_type = event.get('subtype', 'text')
-        # Prepare messages for Groq
-        messages = [{
-            "role": "system",
-            "content": "You are a helpful assistant."
-        }]
-        for conv in reversed(conversations):
-            messages.append({"role": "user", "content": conv.message_text})
-            if conv.response:
-                messages.append({
-                    "role": "assistant",
-                    "content": conv.response
-                })
-
-        messages.append({"role": "user", "content": event['text']})
-
-        response = groq_service.get_response(messages)
-
-        # Save conversation
-        print(f"Event is {event}")
-        ConversationHistory.objects.create(workspace=workspace,
-                                           channel_id=event['channel'],
-                                           thread_ts=event.get('thread_ts'),
-                                           message_text=event['text'],
-                                           message_ts='text',
-                                           message_type=message_type,
-                                           response=response)
-
-        # Send response to Slack
-        slack_service.send_message(channel=event['channel'],
-                                   text=response,
-                                   thread_ts=event.get('thread_ts'))
+    def handle_mention(self, event, workspace):
+        """Reply to a mention, in a Celery task unless async mentions are off"""
+        with span('handle_mention', channel=event.get('channel')):
+            if settings.SLACK_ASYNC_MENTIONS:
+                # Ack Slack right away, the worker builds context and replies
+                process_mention.delay(workspace_id=str(workspace.uuid),
+                                      event=event)
+            else:
+                process_mention(str(workspace.uuid), event)
 
 
 class SlackInstallView(APIView):
@@ -180,12 +186,15 @@ class SlackOAuthView(APIView):
                 client_secret=settings.SLACK_CLIENT_SECRET,
                 code=code)
 
-            # Store workspace credentials
-            SlackWorkspace.objects.update_or_create(
+            # Store workspace credentials, a re-install replaces the token
+            workspace, _ = SlackWorkspace.objects.update_or_create(
                 team_id=response['team']['id'],
-                bot_token=response['access_token'],
-                team_name=response['team']['name'],
-                bot_user_id=response['bot_user_id'])
+                defaults={
+                    'bot_token': response['access_token'],
+                    'team_name': response['team']['name'],
+                    'bot_user_id': response['bot_user_id'],
+                })
+            invalidate_workspace(workspace)
 
             return Response({'message': 'Installation successful!'})
         except Exception as e:
@@ -208,7 +217,7 @@ class ChannelSentimentAnalysisView(APIView):
             
             # Verify workspace exists
             try:
-                workspace = SlackWorkspace.objects.get(uuid=workspace_id)
+                workspace = get_workspace(uuid=workspace_id)
             except SlackWorkspace.DoesNotExist:
                 return Response(
                     {"error": "Workspace not found"},
@@ -232,3 +241,20 @@ class ChannelSentimentAnalysisView(APIView):
                 {"error": str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+
+
+class MetricsView(APIView):
+    """Prometheus scrape endpoint"""
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, request):
+        # Not served without a token to check
+        if not settings.METRICS_ENABLED or not settings.METRICS_TOKEN:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        if not hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                f"Bearer {settings.METRICS_TOKEN}"):
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        data, content_type = render_metrics()
+        return HttpResponse(data, content_type=content_type)
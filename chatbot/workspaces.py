@@ -0,0 +1,138 @@
+import threading
+import uuid as uuid_lib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .cache import LocalCache, get_cache
+from .clients import SlackClient
+from .models import SlackWorkspace
+from .tracing import span
+
+
+class WorkspaceCache:
+    """
+    Per-process cache of SlackWorkspace rows and their SlackClient.
+
+    Entries are reachable by both team_id and uuid, expire after a TTL and
+    are evicted LRU past max_entries. Call invalidate() whenever a
+    workspace row changes (e.g. on OAuth re-install): it bumps the team's
+    version in the shared cache, and every process drops an entry whose
+    version no longer matches on its next lookup.
+    """
+
+    # Versions outlive the entries they invalidate. An expired version only
+    # costs the entries cached under it one reload.
+    version_ttl = 24 * 3600
+
+    def __init__(self, max_entries=None, ttl=None, versions=None):
+        self._entries = LocalCache(
+            max_entries=max_entries or settings.WORKSPACE_CACHE_MAX_ENTRIES,
+            default_ttl=settings.WORKSPACE_CACHE_TTL if ttl is None else ttl)
+        self._lock = threading.Lock()
+        self._version_store = versions
+
+    @property
+    def versions(self):
+        if self._version_store is None:
+            self._version_store = get_cache(
+                'workspace-versions',
+                max_entries=settings.WORKSPACE_CACHE_MAX_ENTRIES,
+                default_ttl=self.version_ttl)
+        return self._version_store
+
+    def _remember(self, workspace, version, slack_client=None):
+        entry = (workspace, slack_client or
+                 SlackClient(workspace.bot_token, team_id=workspace.team_id),
+                 version)
+        self._entries.set(f"team:{workspace.team_id}", entry)
+        self._entries.set(f"uuid:{workspace.uuid}", entry)
+        return entry
+
+    def _cached(self, key, team_id=None):
+        """
+        The entry under key if it's still current. Also returns the version
+        to cache a reloaded row under, read before the row is.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            team_id = entry[0].team_id
+        version = self.versions.get(team_id) if team_id else None
+        if entry is not None and entry[2] != version:
+            self._entries.delete(f"team:{entry[0].team_id}")
+            self._entries.delete(f"uuid:{entry[0].uuid}")
+            entry = None
+        return entry, version
+
+    def _entry(self, team_id=None, uuid=None):
+        key = f"team:{team_id}" if team_id else f"uuid:{uuid}"
+        with span('workspace', cached=True) as current:
+            entry, version = self._cached(key, team_id)
+            if entry is None:
+                if current is not None:
+                    current.set_attribute('cached', False)
+                if team_id:
+                    workspace = SlackWorkspace.objects.get(team_id=team_id)
+                else:
+                    workspace = SlackWorkspace.objects.get(uuid=uuid)
+                    version = self.versions.get(workspace.team_id)
+                with self._lock:
+                    entry = self._remember(workspace, version)
+        return entry
+
+    def get(self, team_id=None, uuid=None):
+        """Get a workspace by team_id or uuid, raises SlackWorkspace.DoesNotExist"""
+        return self._entry(team_id=team_id, uuid=uuid)[0]
+
+    async def aget(self, team_id=None, uuid=None):
+        """get() with async ORM access"""
+        key = f"team:{team_id}" if team_id else f"uuid:{uuid}"
+        with span('workspace', cached=True) as current:
+            entry, version = await sync_to_async(self._cached)(key, team_id)
+            if entry is None:
+                if current is not None:
+                    current.set_attribute('cached', False)
+                if team_id:
+                    workspace = await SlackWorkspace.objects.aget(team_id=team_id)
+                else:
+                    workspace = await SlackWorkspace.objects.aget(uuid=uuid)
+                    version = await sync_to_async(self.versions.get)(workspace.team_id)
+                with self._lock:
+                    entry = self._remember(workspace, version)
+        return entry[0]
+
+    def get_slack_client(self, workspace):
+        """Get the shared SlackClient for a workspace"""
+        cached, slack_client, version = self._entry(uuid=workspace.uuid)
+        if cached.bot_token != workspace.bot_token:
+            with self._lock:
+                cached, slack_client, version = self._remember(workspace, version)
+        return slack_client
+
+    def invalidate(self, workspace):
+        """Drop a workspace from this and every other process's cache"""
+        self.versions.set(workspace.team_id, uuid_lib.uuid4().hex)
+        self._entries.delete(f"team:{workspace.team_id}")
+        self._entries.delete(f"uuid:{workspace.uuid}")
+
+    def clear(self):
+        self._entries.clear()
+
+
+workspace_cache = WorkspaceCache()
+
+
+def get_workspace(team_id=None, uuid=None):
+    return workspace_cache.get(team_id=team_id, uuid=uuid)
+
+
+async def aget_workspace(team_id=None, uuid=None):
+    return await workspace_cache.aget(team_id=team_id, uuid=uuid)
+
+
+def get_slack_client(workspace):
+    return workspace_cache.get_slack_client(workspace)
+
+
+def invalidate_workspace(workspace):
+    workspace_cache.invalidate(workspace)
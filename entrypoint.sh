@@ -13,7 +13,11 @@ echo "Making migrations and migrating the database. "
 python manage.py makemigrations --noinput
 python manage.py migrate --noinput
 python manage.py collectstatic --noinput
-# Start Gunicorn
-exec gunicorn SlackChatbot.wsgi:application --bind 0.0.0.0:8000 --workers=4 --timeout=3600
+. ./metrics_dir.sh
+# Start Gunicorn, with uvicorn workers when serving the async endpoints
+if [ "$SERVER_MODE" = "asgi" ]; then
+    exec gunicorn SlackChatbot.asgi:application -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 --workers=4 --timeout=3600
+fi
+exec gunicorn SlackChatbot.wsgi:application -c gunicorn.conf.py --bind 0.0.0.0:8000 --workers=4 --timeout=3600
 
 exec "$@"
\ No newline at end of file
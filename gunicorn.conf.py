@@ -0,0 +1,16 @@
+import os
+
+from prometheus_client import multiprocess
+
+# Loaded by gunicorn from the working directory (or with -c gunicorn.conf.py).
+# With PROMETHEUS_MULTIPROC_DIR set, each worker writes its metrics to files
+# in that directory and /api/metrics/ serves their sum. The directory must
+# be emptied before the server starts, and not shared with other containers
+# (see metrics_dir.sh).
+
+
+def child_exit(server, worker):
+    # Keep the gauges of dead workers out of the totals; counters and
+    # histograms are kept so they don't go backwards
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
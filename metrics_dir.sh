@@ -0,0 +1,19 @@
+#!/bin/sh
+# Sourced before starting gunicorn or a Celery worker. Containers share the
+# PROMETHEUS_MULTIPROC_ROOT volume but not their PID namespace, so each one
+# writes its metrics files to a directory of its own, named after its
+# hostname, and only empties that one: files of a previous run would be
+# added to the new totals. The metrics endpoint adds up all directories.
+if [ -n "$PROMETHEUS_MULTIPROC_ROOT" ]; then
+    export PROMETHEUS_MULTIPROC_DIR="$PROMETHEUS_MULTIPROC_ROOT/$(hostname)"
+fi
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    if mkdir -p "$PROMETHEUS_MULTIPROC_DIR" && [ -w "$PROMETHEUS_MULTIPROC_DIR" ]; then
+        rm -f "$PROMETHEUS_MULTIPROC_DIR"/*.db
+    else
+        # prometheus_client would fail every metric update, fall back to
+        # per-process metrics
+        echo "Can't write to $PROMETHEUS_MULTIPROC_DIR, metrics are per process" >&2
+        unset PROMETHEUS_MULTIPROC_DIR PROMETHEUS_MULTIPROC_ROOT
+    fi
+fi